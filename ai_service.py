@@ -1,13 +1,17 @@
 import os
 import json
+import sqlite3
+import hashlib
 import logging
+import time
 import random
 import aiohttp
 import asyncio
 import traceback
-from typing import Optional, List, Dict
-from datetime import datetime
+from typing import Optional, List, Dict, Tuple
 from aiogram import Bot
+from http_client import get_http_session
+from db import db
 
 # Настраиваем логирование
 logger = logging.getLogger(__name__)
@@ -73,294 +77,950 @@ def get_user_model(user_id: int) -> str:
 def get_user_model_service(user_id: int) -> str:
     """Получение сервиса модели пользователя (monica или openrouter)"""
     # Определяем сервис на основе выбранной модели
-    model = get_user_model(user_id)
-    if model in MONICA_MODELS:
-        return "monica"
-    elif model in OPENROUTER_MODELS:
+    return get_model_service(get_user_model(user_id))
+
+# Системный промпт для всех запросов
+SYSTEM_PROMPT = "Ты мой личный ассистент для анализа данных. Ты всегда отвечаешь кратко и по делу, без лишних слов."
+
+# Разделитель постов в posts_text (по нему данные режутся на части)
+POSTS_SEPARATOR = "\n\n---\n\n"
+
+# Грубая оценка: сколько символов текста приходится на один токен (латиница и кириллица
+# токенизируются по-разному, поэтому для не-ASCII символов берется отдельная оценка)
+CHARS_PER_TOKEN = float(os.getenv("CHARS_PER_TOKEN", "3"))
+NON_ASCII_CHARS_PER_TOKEN = float(os.getenv("NON_ASCII_CHARS_PER_TOKEN", "2"))
+# Потоковая выдача ответа с обновлением сообщения о статусе
+LLM_STREAMING = os.getenv("LLM_STREAMING", "1") == "1"
+# Как часто (в секундах) обновляется сообщение с ответом во время потока
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "3"))
+# Сколько последних символов ответа показывать в сообщении о статусе
+STREAM_PREVIEW_CHARS = 3000
+
+# Сколько частей обрабатывается одновременно на этапе map
+MAP_CONCURRENCY = int(os.getenv("LLM_MAP_CONCURRENCY", "4"))
+
+MAP_PROMPT = (
+    "Ниже часть {index} из {total} данных для анализа. "
+    "Выпиши из нее сжатый конспект: ключевые факты, темы, цифры и даты, "
+    "которые понадобятся для итоговой задачи. Не делай выводов по всем данным сразу.\n\n"
+    "Итоговая задача: {prompt}"
+)
+
+REDUCE_PROMPT = (
+    "{prompt}\n\n"
+    "Данные слишком большие и были предварительно сжаты: ниже конспекты их частей."
+)
+
+def get_model_info(model: str) -> dict:
+    """Получение описания модели из MONICA_MODELS или OPENROUTER_MODELS"""
+    return get_available_models()[model]
+
+def get_model_service(model: str) -> str:
+    """Определение сервиса (monica или openrouter) по модели"""
+    if model in OPENROUTER_MODELS:
         return "openrouter"
     # По умолчанию используем Monica AI
     return "monica"
 
+def get_model_context_tokens(model: str) -> int:
+    """Размер контекста модели в токенах (из поля max_tokens)"""
+    return int(get_model_info(model)["max_tokens"].replace(",", "").replace(" ", ""))
+
+def estimate_tokens(text: str) -> int:
+    """Приблизительная оценка количества токенов в тексте"""
+    ascii_chars = len(text.encode('ascii', 'ignore'))
+    non_ascii_chars = len(text) - ascii_chars
+    return int(ascii_chars / CHARS_PER_TOKEN + non_ascii_chars / NON_ASCII_CHARS_PER_TOKEN) + 1
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Обрезаем текст так, чтобы он занимал не больше max_tokens по оценке estimate_tokens"""
+    end = min(len(text), int(max_tokens * max(CHARS_PER_TOKEN, NON_ASCII_CHARS_PER_TOKEN)))
+    while end > 0 and estimate_tokens(text[:end]) > max_tokens:
+        end = min(end - 1, int(end * max_tokens / estimate_tokens(text[:end])))
+    return text[:end]
+
+def get_input_token_budget(model: str, prompt: str) -> int:
+    """Сколько токенов данных помещается в один запрос к модели"""
+    context_tokens = get_model_context_tokens(model)
+    # Оставляем четверть контекста (но не больше 4000 токенов) под ответ модели
+    response_reserve = min(context_tokens // 4, 4000)
+    overhead = estimate_tokens(SYSTEM_PROMPT) + estimate_tokens(prompt) + 50
+    return max(context_tokens - response_reserve - overhead, 256)
+
+def split_into_chunks(text: str, max_tokens: int, separator: str = POSTS_SEPARATOR) -> List[str]:
+    """Разбиваем текст на части не больше max_tokens, не разрывая посты без необходимости"""
+    # Длинные строки режем с запасом, как будто весь текст не-ASCII
+    max_chars = max(int((max_tokens - 1) * min(CHARS_PER_TOKEN, NON_ASCII_CHARS_PER_TOKEN)), 1)
+    separator_tokens = estimate_tokens(separator)
+    pieces = []
+    for piece in text.split(separator):
+        # Слишком длинный пост режем по строкам, а строки - по символам
+        if estimate_tokens(piece) > max_tokens:
+            for line in piece.split("\n"):
+                for i in range(0, max(len(line), 1), max_chars):
+                    pieces.append(line[i:i + max_chars])
+        else:
+            pieces.append(piece)
+
+    chunks = []
+    current: List[str] = []
+    current_tokens = 0
+    for piece in pieces:
+        piece_tokens = estimate_tokens(piece)
+        added_tokens = piece_tokens + (separator_tokens if current else 0)
+        if current and current_tokens + added_tokens > max_tokens:
+            chunks.append(separator.join(current))
+            current, current_tokens = [], 0
+            added_tokens = piece_tokens
+        current.append(piece)
+        current_tokens += added_tokens
+    if current:
+        chunks.append(separator.join(current))
+    return chunks
+
+def _build_messages(service: str, prompt: str, posts_text: str) -> list:
+    """Формируем сообщения в формате выбранного сервиса"""
+    user_text = f"{prompt}\n\nДанные для анализа:\n{posts_text}"
+    if service == "monica":
+        return [
+            {"role": "system", "content": [{"type": "text", "text": SYSTEM_PROMPT}]},
+            {"role": "user", "content": [{"type": "text", "text": user_text}]}
+        ]
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": user_text}
+    ]
+
+def _openrouter_error_message(status: int, response_text: str) -> str:
+    """Формируем понятное сообщение об ошибке OpenRouter по коду ответа"""
+    try:
+        error_data = json.loads(response_text) if response_text else {}
+    except json.JSONDecodeError:
+        error_data = {}
+    error_message = error_data.get('error', {}).get('message', 'Неизвестная ошибка')
+    error_code = error_data.get('error', {}).get('code', status)
+
+    if error_code == 400:
+        return "❌ Некорректный запрос к API. Пожалуйста, попробуйте позже."
+    elif error_code == 401:
+        if "No auth credentials found" in error_message:
+            return "❌ Ошибка авторизации: API ключ не найден или некорректен."
+        return "❌ Ошибка авторизации: закончились кредиты или API ключ устарел."
+    elif error_code == 403:
+        return "❌ Доступ запрещен: контент не прошел модерацию."
+    elif error_code == 408:
+        return "❌ Превышено время ожидания ответа от ИИ. OpenRouter прервал соединение."
+    elif error_code == 429:
+        return "❌ Нет доступа к API. Возможно, вы используете API из неподдерживаемого региона."
+    elif error_code == 502:
+        return "❌ Некорректный ответ от ИИ. Попробуйте повторить запрос."
+    elif error_code == 503:
+        return "❌ Выбранная модель ИИ больше не доступна в OpenRouter."
+    return f"❌ Ошибка OpenRouter API ({error_code}): {error_message}"
+
+# Коды ответа, при которых запрос имеет смысл повторить
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+
+class ProviderError(Exception):
+    """Ошибка запроса к сервису ИИ с кодом ответа и признаком временной ошибки"""
+
+    def __init__(self, message: str, status: Optional[int] = None, retryable: bool = False,
+                 retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status = status
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+def _parse_retry_after(response: aiohttp.ClientResponse) -> Optional[float]:
+    """Читаем заголовок Retry-After (в секундах), если сервис его прислал"""
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+async def _read_sse_completion(response: aiohttp.ClientResponse, on_delta) -> str:
+    """Читаем потоковый ответ (Server-Sent Events) и передаем фрагменты в on_delta"""
+    parts = []
+    async for raw_line in response.content:
+        line = raw_line.decode('utf-8').strip()
+        # Пустые строки разделяют события, строки с ":" - комментарии (keep-alive)
+        if not line or line.startswith(':') or not line.startswith('data:'):
+            continue
+        payload = line[len('data:'):].strip()
+        if payload == '[DONE]':
+            break
+        try:
+            chunk = json.loads(payload)
+        except json.JSONDecodeError:
+            logger.warning(f"Не удалось разобрать фрагмент потока: {payload[:200]}")
+            continue
+        if chunk.get('error'):
+            raise ProviderError(f"❌ Ошибка в потоке ответа: {chunk['error'].get('message', chunk['error'])}",
+                                retryable=True)
+        choices = chunk.get('choices') or []
+        delta = choices[0].get('delta', {}).get('content') if choices else None
+        if delta:
+            parts.append(delta)
+            await on_delta(delta)
+    return "".join(parts)
+
+async def _monica_completion(model: str, prompt: str, posts_text: str, on_delta=None) -> str:
+    """Запрос к Monica AI API без взаимодействия с пользователем
+
+    Если передан on_delta, ответ запрашивается потоком и каждый фрагмент
+    передается в on_delta по мере поступления.
+    """
+    api_key = os.getenv("MONICA_API_KEY")
+    if not api_key:
+        raise ProviderError("❌ API ключ Monica не найден в .env файле")
+
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {api_key}"
+    }
+    data = {
+        "model": model,
+        "messages": _build_messages("monica", prompt, posts_text)
+    }
+    if on_delta:
+        data["stream"] = True
+    logger.info(f"Отправляем запрос к Monica API, модель: {model}, размер данных: {len(posts_text)}")
+
+    try:
+        session = get_http_session()
+        async with session.post(
+            "https://openapi.monica.im/v1/chat/completions",
+            headers=headers,
+            json=data,
+            timeout=None  # Убираем таймаут полностью
+        ) as response:
+            logger.info(f"Получен ответ от Monica API, статус: {response.status}")
+            if response.status == 200 and on_delta:
+                return await _read_sse_completion(response, on_delta)
+
+            response_text = await response.text()
+            if response.status != 200:
+                raise ProviderError(f"❌ Ошибка Monica API ({response.status}): {response_text[:200]}...",
+                                    status=response.status,
+                                    retryable=response.status in RETRYABLE_STATUSES,
+                                    retry_after=_parse_retry_after(response))
+            try:
+                result = json.loads(response_text)
+                # Извлекаем только текстовый ответ
+                return result['choices'][0]['message']['content']
+            except (json.JSONDecodeError, KeyError, IndexError) as e:
+                raise ProviderError(f"❌ Ошибка при обработке ответа от Monica AI: {str(e)}, ответ: {response_text[:200]}...",
+                                    status=response.status, retryable=True)
+    except asyncio.TimeoutError:
+        raise ProviderError("❌ Превышено время ожидания ответа от Monica AI. Возможно, запрос слишком большой или сервер перегружен.",
+                            retryable=True)
+    except aiohttp.ClientError as e:
+        raise ProviderError(f"❌ Ошибка соединения с Monica AI: {str(e) or 'Неизвестная ошибка соединения'}",
+                            retryable=True)
+
+async def _openrouter_completion(model: str, prompt: str, posts_text: str, on_delta=None) -> str:
+    """Запрос к OpenRouter API без взаимодействия с пользователем
+
+    Если передан on_delta, ответ запрашивается потоком и каждый фрагмент
+    передается в on_delta по мере поступления.
+    """
+    api_key = os.getenv("OPENROUTER_API_KEY")
+    if not api_key:
+        raise ProviderError("❌ API ключ OpenRouter не найден в .env файле")
+
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {api_key}",
+        "HTTP-Referer": "https://t.me",  # Указываем источник запроса
+        "X-Title": "Telegram Bot Analyzer"  # Название приложения
+    }
+    data = {
+        "model": model,
+        "messages": _build_messages("openrouter", prompt, posts_text)
+    }
+    if on_delta:
+        data["stream"] = True
+    logger.info(f"Отправляем запрос к OpenRouter API, модель: {model}, размер данных: {len(posts_text)}")
+
+    try:
+        session = get_http_session()
+        async with session.post(
+            "https://openrouter.ai/api/v1/chat/completions",
+            headers=headers,
+            json=data,
+            timeout=None  # Убираем таймаут полностью
+        ) as response:
+            logger.info(f"Получен ответ от OpenRouter API, статус: {response.status}")
+            if response.status == 200 and on_delta:
+                return await _read_sse_completion(response, on_delta)
+
+            response_text = await response.text()
+            if response.status != 200:
+                error_msg = _openrouter_error_message(response.status, response_text)
+                logger.error(f"{error_msg}\nПолный ответ: {response_text[:200]}...")
+                raise ProviderError(error_msg,
+                                    status=response.status,
+                                    retryable=response.status in RETRYABLE_STATUSES,
+                                    retry_after=_parse_retry_after(response))
+            try:
+                result = json.loads(response_text)
+                # Извлекаем только текстовый ответ
+                return result['choices'][0]['message']['content']
+            except (json.JSONDecodeError, KeyError, IndexError) as e:
+                raise ProviderError(f"❌ Ошибка при обработке ответа от OpenRouter: {str(e)}, ответ: {response_text[:200]}...",
+                                    status=response.status, retryable=True)
+    except asyncio.TimeoutError:
+        raise ProviderError("❌ Превышено время ожидания ответа от OpenRouter. Возможно, запрос слишком большой или сервер перегружен.",
+                            retryable=True)
+    except aiohttp.ClientError as e:
+        raise ProviderError(f"❌ Ошибка соединения с OpenRouter: {str(e) or 'Неизвестная ошибка соединения'}",
+                            retryable=True)
+
+# Модели другого сервиса, на которые можно переключиться при сбое (в порядке приоритета)
+MODEL_EQUIVALENTS = {
+    "gpt-4o": ["anthropic/claude-3-7-sonnet"],
+    "claude-3-5-sonnet-20241022": ["anthropic/claude-3-7-sonnet"],
+    "claude-3-haiku-20240307": ["anthropic/claude-3-7-sonnet"],
+    "o1-mini": ["anthropic/claude-3-7-sonnet"],
+    "anthropic/claude-3-7-sonnet": ["claude-3-5-sonnet-20241022", "gpt-4o"],
+    "anthropic/claude-3-7-sonnet:thinking": ["anthropic/claude-3-7-sonnet", "claude-3-5-sonnet-20241022"],
+    "anthropic/claude-3-7-sonnet:beta": ["anthropic/claude-3-7-sonnet", "claude-3-5-sonnet-20241022"]
+}
+
+# Настройки повторов и переключения между сервисами
+LLM_FAILOVER = os.getenv("LLM_FAILOVER", "1") == "1"
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "1"))
+LLM_RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "20"))
+# Через сколько секунд без ответа запускать параллельный запрос к резервной модели (0 - выключено)
+LLM_HEDGE_DELAY = float(os.getenv("LLM_HEDGE_DELAY", "0"))
+
+def get_failover_models(model: str, prompt: str, posts_text: str) -> List[str]:
+    """Модели для запроса: выбранная и резервные, в контекст которых помещаются данные"""
+    models = [model]
+    if LLM_FAILOVER:
+        for backup in MODEL_EQUIVALENTS.get(model, []):
+            if backup in get_available_models() and \
+                    estimate_tokens(posts_text) <= get_input_token_budget(backup, prompt):
+                models.append(backup)
+    return models
+
+def _retry_delay(attempt: int, retry_after: Optional[float] = None) -> float:
+    """Экспоненциальная задержка со случайным разбросом (full jitter)"""
+    if retry_after is not None:
+        return min(retry_after, LLM_RETRY_MAX_DELAY)
+    return random.uniform(0, min(LLM_RETRY_MAX_DELAY, LLM_RETRY_BASE_DELAY * 2 ** attempt))
+
+class TokenBucket:
+    """Ограничитель частоты запросов (token bucket)
+
+    rate - сколько запросов в секунду пополняется, capacity - допустимый всплеск.
+    Ожидающие запросы обслуживаются по очереди, а не все разом.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(capacity, 1.0)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.waiting = 0
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        self.waiting += 1
+        try:
+            async with self._lock:
+                self._refill()
+                if self.tokens < 1:
+                    await asyncio.sleep((1 - self.tokens) / self.rate)
+                    self._refill()
+                self.tokens -= 1
+        finally:
+            self.waiting -= 1
+
+    def state(self) -> dict:
+        if self.rate > 0:
+            self._refill()
+        return {
+            "rate_per_minute": self.rate * 60,
+            "capacity": self.capacity,
+            "tokens": round(self.tokens, 2),
+            "waiting": self.waiting
+        }
+
+class CircuitBreaker:
+    """Размыкатель: после серии ошибок сервиса запросы к нему сразу отклоняются
+
+    Через reset_timeout секунд пропускается один пробный запрос (half-open):
+    если он успешен, размыкатель снова замыкается.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probe_in_flight = False
+
+    @property
+    def status(self) -> str:
+        if self.opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def before_request(self):
+        """Проверяем, можно ли отправить запрос; иначе сразу выбрасываем ошибку"""
+        status = self.status
+        if status == self.CLOSED:
+            return
+        if status == self.HALF_OPEN and not self.probe_in_flight:
+            self.probe_in_flight = True
+            return
+        retry_in = max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+        raise ProviderError(
+            f"❌ Сервис {self.name} временно недоступен после серии ошибок, повторите через {retry_in:.0f} с",
+            retryable=False
+        )
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probe_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.probe_in_flight or self.failures >= self.failure_threshold:
+            if self.opened_at is None or self.probe_in_flight:
+                logger.warning(f"Размыкатель {self.name} разомкнут после {self.failures} ошибок подряд")
+            self.opened_at = time.monotonic()
+        self.probe_in_flight = False
+
+    def state(self) -> dict:
+        return {"status": self.status, "failures": self.failures}
+
+# Лимиты запросов в минуту (0 - без ограничения) и размер допустимого всплеска
+PROVIDER_RATE_LIMITS = {
+    "monica": float(os.getenv("MONICA_RATE_LIMIT_RPM", "60")),
+    "openrouter": float(os.getenv("OPENROUTER_RATE_LIMIT_RPM", "60"))
+}
+MODEL_RATE_LIMIT_RPM = float(os.getenv("LLM_MODEL_RATE_LIMIT_RPM", "30"))
+LLM_RATE_BURST = float(os.getenv("LLM_RATE_BURST", "5"))
+LLM_BREAKER_THRESHOLD = int(os.getenv("LLM_BREAKER_THRESHOLD", "5"))
+LLM_BREAKER_RESET = float(os.getenv("LLM_BREAKER_RESET", "60"))
+
+provider_limiters: Dict[str, TokenBucket] = {
+    service: TokenBucket(rpm / 60, LLM_RATE_BURST) for service, rpm in PROVIDER_RATE_LIMITS.items()
+}
+model_limiters: Dict[str, TokenBucket] = {
+    model: TokenBucket(MODEL_RATE_LIMIT_RPM / 60, LLM_RATE_BURST) for model in get_available_models()
+}
+provider_breakers: Dict[str, CircuitBreaker] = {
+    service: CircuitBreaker(service, LLM_BREAKER_THRESHOLD, LLM_BREAKER_RESET) for service in PROVIDER_RATE_LIMITS
+}
+
+def get_limiter_state() -> dict:
+    """Текущее состояние ограничителей частоты и размыкателей по сервисам и моделям"""
+    return {
+        "providers": {
+            service: {**provider_limiters[service].state(), "breaker": provider_breakers[service].state()}
+            for service in provider_limiters
+        },
+        "models": {model: limiter.state() for model, limiter in model_limiters.items()}
+    }
+
+async def _provider_completion(model: str, prompt: str, posts_text: str, on_delta=None) -> str:
+    """Один запрос к сервису с учетом размыкателя и ограничителей частоты"""
+    service = get_model_service(model)
+    breaker = provider_breakers[service]
+    breaker.before_request()
+
+    await provider_limiters[service].acquire()
+    await model_limiters[model].acquire()
+    try:
+        if service == "openrouter":
+            response = await _openrouter_completion(model, prompt, posts_text, on_delta)
+        else:
+            response = await _monica_completion(model, prompt, posts_text, on_delta)
+    except ProviderError as e:
+        # Ошибки запроса (400, 401, 403) не говорят ни о сбое, ни о восстановлении сервиса:
+        # состояние размыкателя не меняем, только освобождаем пробный запрос
+        if e.retryable:
+            breaker.record_failure()
+        else:
+            breaker.probe_in_flight = False
+        raise
+    except BaseException:
+        breaker.probe_in_flight = False
+        raise
+    breaker.record_success()
+    return response
+
+async def _completion_with_retries(model: str, prompt: str, posts_text: str, on_delta=None) -> str:
+    """Запрос к одной модели с повтором временных ошибок
+
+    Перед повтором в on_delta передается None: текст, полученный в прерванной
+    попытке, больше не относится к ответу.
+    """
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        if attempt and on_delta:
+            await on_delta(None)
+        try:
+            return await _provider_completion(model, prompt, posts_text, on_delta)
+        except ProviderError as e:
+            if not e.retryable or attempt >= LLM_MAX_RETRIES:
+                raise
+            delay = _retry_delay(attempt, e.retry_after)
+            logger.warning(f"Временная ошибка {model} ({e.status}), повтор через {delay:.1f} с: {e}")
+            await asyncio.sleep(delay)
+
+async def _hedged_completion(primary: str, backup: str, prompt: str, posts_text: str,
+                             on_delta=None) -> Tuple[str, str]:
+    """Запрос к основной модели; если она молчит дольше LLM_HEDGE_DELAY - параллельно к резервной
+
+    Возвращается первый успешный ответ и ответившая модель, второй запрос отменяется.
+    """
+    stream_owner = None
+
+    def gated_delta(model: str):
+        # Пользователю показываем поток только одной из моделей - той, что начала отвечать первой
+        async def on_model_delta(delta: Optional[str]):
+            nonlocal stream_owner
+            if delta is None:
+                # Попытка начата заново - поток может занять другая модель
+                if stream_owner == model:
+                    stream_owner = None
+                    await on_delta(None)
+                return
+            if stream_owner is None:
+                stream_owner = model
+            if stream_owner == model:
+                await on_delta(delta)
+        return on_model_delta if on_delta else None
+
+    tasks = {asyncio.ensure_future(_completion_with_retries(primary, prompt, posts_text, gated_delta(primary))): primary}
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=LLM_HEDGE_DELAY)
+        if not done:
+            logger.info(f"{primary} не ответила за {LLM_HEDGE_DELAY:.0f} с, запускаем резервный запрос к {backup}")
+            tasks[asyncio.ensure_future(_completion_with_retries(backup, prompt, posts_text, gated_delta(backup)))] = backup
+
+        last_error = None
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    logger.info(f"Ответ получен от {tasks[task]}")
+                    return task.result(), tasks[task]
+                last_error = task.exception()
+                logger.warning(f"Запрос к {tasks[task]} завершился ошибкой: {last_error}")
+                # Показанный поток принадлежал упавшему запросу - сбрасываем его
+                if on_delta and stream_owner == tasks[task]:
+                    stream_owner = None
+                    await on_delta(None)
+            # Основная модель упала до истечения задержки - сразу пробуем резервную
+            if not pending and len(tasks) == 1:
+                task = asyncio.ensure_future(_completion_with_retries(backup, prompt, posts_text, gated_delta(backup)))
+                tasks[task] = backup
+                pending = {task}
+        raise last_error
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+async def routed_completion(model: str, prompt: str, posts_text: str, on_delta=None) -> Tuple[str, str]:
+    """Запрос с повторами и переключением на эквивалентную модель другого сервиса
+
+    Возвращает ответ и модель, которая его дала (при сбое - резервную).
+    """
+    candidates = get_failover_models(model, prompt, posts_text)
+    last_error: Optional[Exception] = None
+
+    if LLM_HEDGE_DELAY > 0 and len(candidates) > 1:
+        try:
+            return await _hedged_completion(candidates[0], candidates[1], prompt, posts_text, on_delta)
+        except ProviderError as e:
+            last_error = e
+            candidates = candidates[2:]
+
+    for candidate in candidates:
+        if last_error is not None:
+            logger.warning(f"Переключаемся на резервную модель {candidate} после ошибки: {last_error}")
+            if on_delta:
+                await on_delta(None)
+        try:
+            return await _completion_with_retries(candidate, prompt, posts_text, on_delta), candidate
+        except ProviderError as e:
+            last_error = e
+    raise last_error
+
+class ResponseCache:
+    """Постоянный кэш ответов ИИ в SQLite по хэшу (модель, системный промпт, промпт, данные)
+
+    Записи старше ttl не используются, при превышении max_bytes удаляются
+    давно не использованные записи.
+    """
+
+    def __init__(self, ttl: int = 86400, max_bytes: int = 50 * 1024 * 1024):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    async def init(self):
+        """Создаем таблицу кэша"""
+        def create_table(conn: sqlite3.Connection):
+            conn.execute('''CREATE TABLE IF NOT EXISTS llm_cache
+                            (key TEXT PRIMARY KEY,
+                             model TEXT,
+                             response TEXT,
+                             size INTEGER,
+                             created_at REAL,
+                             last_access REAL)''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_llm_cache_last_access ON llm_cache (last_access)')
+        await db.transaction(create_table)
+
+    @staticmethod
+    def make_key(model: str, prompt: str, posts_text: str) -> str:
+        digest = hashlib.sha256()
+        for part in (model, SYSTEM_PROMPT, prompt, posts_text):
+            digest.update(part.encode('utf-8'))
+            # Разделитель, чтобы ("ab", "c") и ("a", "bc") давали разные ключи
+            digest.update(b"\x00")
+        return digest.hexdigest()
+
+    async def get(self, key: str, count_stats: bool = True) -> Optional[str]:
+        """Ищем ответ по ключу; count_stats=False - повторная проверка, не влияет на статистику"""
+        now = time.time()
+
+        def lookup(conn: sqlite3.Connection) -> Optional[str]:
+            result = conn.execute('SELECT response FROM llm_cache WHERE key = ? AND created_at >= ?',
+                                  (key, now - self.ttl)).fetchone()
+            if result:
+                conn.execute('UPDATE llm_cache SET last_access = ? WHERE key = ?', (now, key))
+                return result[0]
+            return None
+
+        response = await db.transaction(lookup)
+        if not count_stats:
+            return response
+        if response is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return response
+
+    async def put(self, key: str, model: str, response: str):
+        now = time.time()
+
+        def store(conn: sqlite3.Connection):
+            conn.execute('''INSERT OR REPLACE INTO llm_cache (key, model, response, size, created_at, last_access)
+                            VALUES (?, ?, ?, ?, ?, ?)''',
+                         (key, model, response, len(response.encode('utf-8')), now, now))
+            self._evict(conn, now)
+
+        await db.transaction(store)
+
+    def _evict(self, conn: sqlite3.Connection, now: float):
+        """Удаляем устаревшие записи и самые старые по использованию при превышении размера"""
+        conn.execute('DELETE FROM llm_cache WHERE created_at < ?', (now - self.ttl,))
+        excess = conn.execute('SELECT COALESCE(SUM(size), 0) FROM llm_cache').fetchone()[0] - self.max_bytes
+        if excess <= 0:
+            return
+        to_delete = []
+        for key, size in conn.execute('SELECT key, size FROM llm_cache ORDER BY last_access').fetchall():
+            if excess <= 0:
+                break
+            to_delete.append((key,))
+            excess -= size
+        conn.executemany('DELETE FROM llm_cache WHERE key = ?', to_delete)
+        logger.info(f"Из кэша ответов ИИ вытеснено записей: {len(to_delete)}")
+
+    async def stats(self) -> dict:
+        """Статистика кэша: попадания, промахи, количество и размер записей"""
+        entries, size = await db.fetchone('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_cache')
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": entries,
+            "bytes": size
+        }
+
+response_cache = ResponseCache(
+    ttl=int(os.getenv("LLM_CACHE_TTL", "86400")),
+    max_bytes=int(os.getenv("LLM_CACHE_MAX_BYTES", str(50 * 1024 * 1024)))
+)
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "1") == "1"
+
+async def init_response_cache():
+    """Создаем таблицу кэша ответов ИИ (вызывается при инициализации БД)"""
+    await response_cache.init()
+
+async def get_cache_stats() -> dict:
+    """Статистика попаданий в кэш ответов ИИ"""
+    return await response_cache.stats()
+
+async def _cache_get(model: str, prompt: str, posts_text: str, count_stats: bool = True) -> Optional[str]:
+    if not LLM_CACHE_ENABLED:
+        return None
+    try:
+        return await response_cache.get(ResponseCache.make_key(model, prompt, posts_text), count_stats)
+    except sqlite3.Error as e:
+        logger.warning(f"Ошибка чтения кэша ответов ИИ: {e}")
+        return None
+
+async def _cache_put(model: str, prompt: str, posts_text: str, response: str):
+    if not LLM_CACHE_ENABLED or not response:
+        return
+    try:
+        await response_cache.put(ResponseCache.make_key(model, prompt, posts_text), model, response)
+    except sqlite3.Error as e:
+        logger.warning(f"Ошибка записи в кэш ответов ИИ: {e}")
+
+async def request_completion(model: str, prompt: str, posts_text: str, on_delta=None,
+                             count_stats: bool = True) -> str:
+    """Запрос к нужному сервису по модели, без сообщений пользователю
+
+    count_stats=False - кэш уже проверен вызывающим (try_gpt_request),
+    повторная проверка не учитывается в статистике попаданий.
+    """
+    cached = await _cache_get(model, prompt, posts_text, count_stats)
+    if cached is not None:
+        logger.info(f"Ответ {model} взят из кэша")
+        if on_delta:
+            await on_delta(cached)
+        return cached
+
+    response, answered_model = await routed_completion(model, prompt, posts_text, on_delta)
+    # Ответ резервной модели кэшируем под ней, чтобы не выдавать его за ответ запрошенной
+    await _cache_put(answered_model, prompt, posts_text, response)
+    return response
+
+async def summarize_chunks(model: str, prompt: str, chunks: List[str], on_progress=None) -> List[str]:
+    """Этап map: параллельно сжимаем части данных в конспекты"""
+    semaphore = asyncio.Semaphore(max(1, MAP_CONCURRENCY))
+    done = 0
+
+    async def summarize(index: int, chunk: str) -> str:
+        nonlocal done
+        async with semaphore:
+            map_prompt = MAP_PROMPT.format(index=index + 1, total=len(chunks), prompt=prompt)
+            summary = await request_completion(model, map_prompt, chunk)
+        done += 1
+        if on_progress:
+            await on_progress(done, len(chunks))
+        return summary
+
+    return await asyncio.gather(*(summarize(i, chunk) for i, chunk in enumerate(chunks)))
+
+async def reduce_posts_text(model: str, prompt: str, posts_text: str, on_progress=None) -> str:
+    """Сжимаем данные, пока они не поместятся в контекст модели"""
+    budget = get_input_token_budget(model, REDUCE_PROMPT.format(prompt=prompt))
+    while estimate_tokens(posts_text) > budget:
+        chunks = split_into_chunks(posts_text, budget)
+        logger.info(f"Данные не помещаются в контекст {model}: разбиваем на {len(chunks)} частей")
+        summaries = await summarize_chunks(model, prompt, chunks, on_progress)
+        reduced_text = POSTS_SEPARATOR.join(summaries)
+        if len(chunks) == 1 or len(reduced_text) >= len(posts_text):
+            # Модель не смогла сжать данные - обрезаем, чтобы не зациклиться
+            return truncate_to_tokens(reduced_text, budget)
+        posts_text = reduced_text
+    return posts_text
+
 async def try_gpt_request(prompt: str, posts_text: str, user_id: int, bot: Bot, user_data: dict):
-    """Запрос к Monica AI API или OpenRouter API в зависимости от выбранной модели"""
+    """Запрос к Monica AI API или OpenRouter API в зависимости от выбранной модели
+
+    Если данные не помещаются в контекст модели, они разбиваются на части,
+    которые сжимаются параллельно (map), а итоговый запрос идет по конспектам (reduce).
+    """
     service = get_user_model_service(user_id)
-    
-    if service == "monica":
-        return await try_monica_request(prompt, posts_text, user_id, bot, user_data)
-    elif service == "openrouter":
-        return await try_openrouter_request(prompt, posts_text, user_id, bot, user_data)
-    else:
+    if service not in ("monica", "openrouter"):
         error_msg = f"❌ Неизвестный сервис модели: {service}"
         logger.error(error_msg)
         raise Exception(error_msg)
 
-async def try_monica_request(prompt: str, posts_text: str, user_id: int, bot: Bot, user_data: dict):
-    """Запрос к Monica AI API"""
-    status_message = None
-    try:
-        text_length = len(posts_text)
-        selected_model = get_user_model(user_id)
-        model_info = MONICA_MODELS[selected_model]
-        
-        # Отправляем сообщение о начале анализа
+    model = get_user_model(user_id)
+    # Одинаковый запрос (например, повторный анализ той же папки) берем из кэша
+    cached = await _cache_get(model, prompt, posts_text)
+    if cached is not None:
+        # Счетчики берем из памяти, без запроса к БД на каждое попадание
+        logger.info(f"Ответ для пользователя {user_id} взят из кэша "
+                    f"(попаданий: {response_cache.hits}, промахов: {response_cache.misses})")
+        return cached
+    original_prompt, original_posts_text = prompt, posts_text
+
+    if estimate_tokens(posts_text) > get_input_token_budget(model, prompt):
         status_message = await bot.send_message(
             user_id,
-            f"🔄 Начинаю анализ...\n"
-            f"Размер данных: {text_length} символов\n"
-            f"Используем: Monica AI - {model_info['name']}"
+            f"📚 Данных больше, чем помещается в контекст модели {get_model_info(model)['name']}.\n"
+            f"Сначала сжимаю их по частям..."
         )
-        
-        # Загружаем API ключ из .env
-        api_key = os.getenv("MONICA_API_KEY")
-        if not api_key:
-            error_msg = "❌ API ключ Monica не найден в .env файле"
-            logger.error(error_msg)
-            if status_message:
-                await status_message.edit_text(error_msg)
-            raise Exception(error_msg)
-        
-        # Подготавливаем запрос к Monica AI
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key}"
-        }
-        
-        # Подготавливаем сообщения
-        messages = [
-            {
-                "role": "system",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": "Ты мой личный ассистент для анализа данных. Ты всегда отвечаешь кратко и по делу, без лишних слов."
-                    }
-                ]
-            },
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": f"{prompt}\n\nДанные для анализа:\n{posts_text}"
-                    }
-                ]
-            }
-        ]
-        
-        data = {
-            "model": selected_model,
-            "messages": messages
-        }
-        
-        if status_message:
-            await status_message.edit_text(
-                f"🔄 Отправляю запрос к Monica AI...\n"
-                f"Модель: {model_info['name']}\n"
-                f"Размер данных: {text_length} символов\n"
-                f"Ожидаемое время ответа: может занять несколько минут"
-            )
-        
-        # Логируем отправляемые данные для отладки
-        logger.info(f"Отправляем запрос к Monica API, модель: {selected_model}, размер данных: {text_length}")
-        
+
+        async def on_progress(done: int, total: int):
+            try:
+                await status_message.edit_text(f"📚 Сжимаю данные по частям: {done}/{total}")
+            except Exception:
+                pass
+
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    "https://openapi.monica.im/v1/chat/completions",
-                    headers=headers,
-                    json=data,
-                    timeout=None  # Убираем таймаут полностью
-                ) as response:
-                    response_text = await response.text()
-                    logger.info(f"Получен ответ от Monica API, статус: {response.status}")
-                    
-                    if response.status == 200:
-                        try:
-                            result = json.loads(response_text)
-                            # Извлекаем только текстовый ответ
-                            response_text = result['choices'][0]['message']['content']
-                            if status_message:
-                                await status_message.delete()
-                            return response_text
-                        except (json.JSONDecodeError, KeyError, IndexError) as e:
-                            error_msg = f"❌ Ошибка при обработке ответа от Monica AI: {str(e)}, ответ: {response_text[:200]}..."
-                            logger.error(error_msg)
-                            if status_message:
-                                await status_message.edit_text(error_msg)
-                            raise Exception(error_msg)
-                    else:
-                        error_msg = f"❌ Ошибка Monica API ({response.status}): {response_text[:200]}..."
-                        logger.error(error_msg)
-                        if status_message:
-                            await status_message.edit_text(error_msg)
-                        raise Exception(error_msg)
-        except asyncio.TimeoutError:
-            error_msg = f"❌ Превышено время ожидания ответа от Monica AI. Возможно, запрос слишком большой или сервер перегружен."
-            logger.error(error_msg)
-            if status_message:
-                await status_message.edit_text(error_msg)
-            raise Exception(error_msg)
-        except aiohttp.ClientError as e:
-            error_msg = f"❌ Ошибка соединения с Monica AI: {str(e) or 'Неизвестная ошибка соединения'}"
+            posts_text = await reduce_posts_text(model, prompt, posts_text, on_progress)
+        except Exception as e:
+            error_msg = f"❌ Ошибка при сжатии данных: {str(e) or 'Неизвестная ошибка'}"
             logger.error(error_msg)
-            if status_message:
-                await status_message.edit_text(error_msg)
-            raise Exception(error_msg)
-                    
-    except Exception as e:
-        error_msg = f"❌ Неожиданная ошибка при запросе к Monica AI: {str(e) or 'Неизвестная ошибка'}"
-        logger.error(error_msg)
-        # Добавляем трассировку стека для более подробной информации
-        logger.error(f"Трассировка ошибки: {traceback.format_exc()}")
-        
-        if status_message:
             await status_message.edit_text(error_msg)
-        raise Exception(error_msg)
+            raise Exception(error_msg)
+        await status_message.delete()
+        prompt = REDUCE_PROMPT.format(prompt=prompt)
 
-async def try_openrouter_request(prompt: str, posts_text: str, user_id: int, bot: Bot, user_data: dict):
-    """Запрос к OpenRouter API"""
+    if service == "monica":
+        response = await try_monica_request(prompt, posts_text, user_id, bot, user_data)
+    else:
+        response = await try_openrouter_request(prompt, posts_text, user_id, bot, user_data)
+    # После map-reduce итоговый запрос отличается от исходного - кэшируем и по исходному ключу,
+    # если ответила сама модель пользователя (ответ резервной закэширован только под ней)
+    if (prompt, posts_text) != (original_prompt, original_posts_text) and \
+            await _cache_get(model, prompt, posts_text, count_stats=False) == response:
+        await _cache_put(model, original_prompt, original_posts_text, response)
+    return response
+
+class StreamProgress:
+    """Показывает пользователю ответ модели по мере генерации
+
+    Сообщение о статусе обновляется не чаще раза в STREAM_EDIT_INTERVAL секунд,
+    а пока модель молчит - показывается время ожидания (heartbeat).
+    """
+
+    def __init__(self, status_message, header: str):
+        self.status_message = status_message
+        self.header = header
+        self.parts: List[str] = []
+        self.length = 0
+        self.started_at = time.monotonic()
+        self._task: Optional[asyncio.Task] = None
+
+    async def on_delta(self, delta: Optional[str]):
+        """Очередной фрагмент ответа; None - запрос начат заново, прежний текст сбрасывается"""
+        if delta is None:
+            self.parts = []
+            self.length = 0
+            return
+        self.parts.append(delta)
+        self.length += len(delta)
+
+    def _render(self) -> str:
+        elapsed = int(time.monotonic() - self.started_at)
+        if not self.length:
+            return f"{self.header}\n⏳ Ожидаю ответ модели... {elapsed} с"
+        text = "".join(self.parts)
+        self.parts = [text]
+        preview = text[-STREAM_PREVIEW_CHARS:]
+        if len(text) > STREAM_PREVIEW_CHARS:
+            preview = "…" + preview
+        return f"{self.header}\n✍️ Получено {self.length} символов за {elapsed} с\n\n{preview}"
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(STREAM_EDIT_INTERVAL)
+            try:
+                await self.status_message.edit_text(self._render())
+            except Exception as e:
+                # Например, "message is not modified" или ограничение частоты Telegram
+                logger.debug(f"Не удалось обновить сообщение о статусе: {e}")
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+async def _try_provider_request(provider_name: str, prompt: str, posts_text: str, user_id: int, bot: Bot):
+    """Запрос к сервису с сообщениями о статусе для пользователя"""
     status_message = None
+    progress = None
     try:
         text_length = len(posts_text)
         selected_model = get_user_model(user_id)
-        model_info = OPENROUTER_MODELS[selected_model]
-        
+        model_info = get_model_info(selected_model)
+
         # Отправляем сообщение о начале анализа
         status_message = await bot.send_message(
             user_id,
             f"🔄 Начинаю анализ...\n"
             f"Размер данных: {text_length} символов\n"
-            f"Используем: OpenRouter - {model_info['name']}"
+            f"Используем: {provider_name} - {model_info['name']}"
         )
-        
-        # Загружаем API ключ из .env
-        api_key = os.getenv("OPENROUTER_API_KEY")
-        if not api_key:
-            error_msg = "❌ API ключ OpenRouter не найден в .env файле"
-            logger.error(error_msg)
-            if status_message:
-                await status_message.edit_text(error_msg)
-            raise Exception(error_msg)
-        
-        # Подготавливаем запрос к OpenRouter API
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key}",
-            "HTTP-Referer": "https://t.me",  # Указываем источник запроса
-            "X-Title": "Telegram Bot Analyzer"  # Название приложения
-        }
-        
-        # Подготавливаем сообщения
-        messages = [
-            {
-                "role": "system",
-                "content": "Ты мой личный ассистент для анализа данных. Ты всегда отвечаешь кратко и по делу, без лишних слов."
-            },
-            {
-                "role": "user",
-                "content": f"{prompt}\n\nДанные для анализа:\n{posts_text}"
-            }
-        ]
-        
-        data = {
-            "model": selected_model,
-            "messages": messages
-        }
-        
-        if status_message:
-            await status_message.edit_text(
-                f"🔄 Отправляю запрос к OpenRouter...\n"
-                f"Модель: {model_info['name']}\n"
-                f"Размер данных: {text_length} символов\n"
-                f"Ожидаемое время ответа: может занять несколько минут"
-            )
-        
-        # Логируем отправляемые данные для отладки
-        logger.info(f"Отправляем запрос к OpenRouter API, модель: {selected_model}, размер данных: {text_length}")
-        
+        await status_message.edit_text(
+            f"🔄 Отправляю запрос к {provider_name}...\n"
+            f"Модель: {model_info['name']}\n"
+            f"Размер данных: {text_length} символов\n"
+            f"Ожидаемое время ответа: может занять несколько минут"
+        )
+
+        on_delta = None
+        if LLM_STREAMING:
+            progress = StreamProgress(status_message, f"🔄 {provider_name} - {model_info['name']}")
+            progress.start()
+            on_delta = progress.on_delta
+
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    "https://openrouter.ai/api/v1/chat/completions",
-                    headers=headers,
-                    json=data,
-                    timeout=None  # Убираем таймаут полностью
-                ) as response:
-                    response_text = await response.text()
-                    logger.info(f"Получен ответ от OpenRouter API, статус: {response.status}")
-                    
-                    if response.status == 200:
-                        try:
-                            result = json.loads(response_text)
-                            # Извлекаем только текстовый ответ
-                            response_text = result['choices'][0]['message']['content']
-                            if status_message:
-                                await status_message.delete()
-                            return response_text
-                        except (json.JSONDecodeError, KeyError, IndexError) as e:
-                            error_msg = f"❌ Ошибка при обработке ответа от OpenRouter: {str(e)}, ответ: {response_text[:200]}..."
-                            logger.error(error_msg)
-                            if status_message:
-                                await status_message.edit_text(error_msg)
-                            raise Exception(error_msg)
-                    else:
-                        # Обработка специфических ошибок
-                        error_data = json.loads(response_text) if response_text else {}
-                        error_message = error_data.get('error', {}).get('message', 'Неизвестная ошибка')
-                        error_code = error_data.get('error', {}).get('code', response.status)
-                        
-                        # Формируем сообщение об ошибке в зависимости от кода
-                        if error_code == 400:
-                            error_msg = "❌ Некорректный запрос к API. Пожалуйста, попробуйте позже."
-                        elif error_code == 401:
-                            if "No auth credentials found" in error_message:
-                                error_msg = "❌ Ошибка авторизации: API ключ не найден или некорректен."
-                            else:
-                                error_msg = "❌ Ошибка авторизации: закончились кредиты или API ключ устарел."
-                        elif error_code == 403:
-                            error_msg = "❌ Доступ запрещен: контент не прошел модерацию."
-                        elif error_code == 408:
-                            error_msg = "❌ Превышено время ожидания ответа от ИИ. OpenRouter прервал соединение."
-                        elif error_code == 429:
-                            error_msg = "❌ Нет доступа к API. Возможно, вы используете API из неподдерживаемого региона."
-                        elif error_code == 502:
-                            error_msg = "❌ Некорректный ответ от ИИ. Попробуйте повторить запрос."
-                        elif error_code == 503:
-                            error_msg = "❌ Выбранная модель ИИ больше не доступна в OpenRouter."
-                        else:
-                            error_msg = f"❌ Ошибка OpenRouter API ({error_code}): {error_message}"
-                        
-                        logger.error(f"{error_msg}\nПолный ответ: {response_text[:200]}...")
-                        if status_message:
-                            await status_message.edit_text(error_msg)
-                        raise Exception(error_msg)
-                        
-        except asyncio.TimeoutError:
-            error_msg = "❌ Превышено время ожидания ответа от OpenRouter. Возможно, запрос слишком большой или сервер перегружен."
-            logger.error(error_msg)
-            if status_message:
-                await status_message.edit_text(error_msg)
-            raise Exception(error_msg)
-        except aiohttp.ClientError as e:
-            error_msg = f"❌ Ошибка соединения с OpenRouter: {str(e) or 'Неизвестная ошибка соединения'}"
-            logger.error(error_msg)
-            if status_message:
-                await status_message.edit_text(error_msg)
-            raise Exception(error_msg)
-                    
+            # Попадание или промах по этому анализу уже учтен в try_gpt_request
+            response_text = await request_completion(selected_model, prompt, posts_text, on_delta,
+                                                     count_stats=False)
+        finally:
+            if progress:
+                await progress.stop()
+        await status_message.delete()
+        return response_text
+
     except Exception as e:
-        error_msg = f"❌ Неожиданная ошибка при запросе к OpenRouter: {str(e) or 'Неизвестная ошибка'}"
+        error_msg = str(e) if str(e).startswith("❌") else \
+            f"❌ Неожиданная ошибка при запросе к {provider_name}: {str(e) or 'Неизвестная ошибка'}"
         logger.error(error_msg)
         # Добавляем трассировку стека для более подробной информации
         logger.error(f"Трассировка ошибки: {traceback.format_exc()}")
-        
+
         if status_message:
             await status_message.edit_text(error_msg)
         raise Exception(error_msg)
 
+async def try_monica_request(prompt: str, posts_text: str, user_id: int, bot: Bot, user_data: dict):
+    """Запрос к Monica AI API"""
+    return await _try_provider_request("Monica AI", prompt, posts_text, user_id, bot)
+
+async def try_openrouter_request(prompt: str, posts_text: str, user_id: int, bot: Bot, user_data: dict):
+    """Запрос к OpenRouter API"""
+    return await _try_provider_request("OpenRouter", prompt, posts_text, user_id, bot)
+
 # Экспортируем для использования в других модулях
 __all__ = [
     'try_gpt_request',
+    'request_completion',
+    'init_response_cache',
+    'get_cache_stats',
+    'get_limiter_state',
     'get_available_models',
     'get_user_model',
     'user_models',
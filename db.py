@@ -0,0 +1,90 @@
+import asyncio
+import sqlite3
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, List, Optional, Sequence, TypeVar
+
+# Настраиваем логирование
+logger = logging.getLogger(__name__)
+
+DB_PATH = 'bot.db'
+
+T = TypeVar('T')
+
+# Настройки SQLite для долгоживущего соединения
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA foreign_keys=ON"
+)
+
+class Database:
+    """Асинхронный доступ к SQLite через одно постоянное соединение
+
+    Все запросы выполняются в отдельном потоке, поэтому не блокируют цикл
+    событий. Поток один, так что запросы к соединению идут строго по очереди.
+    """
+
+    def __init__(self, path: str = DB_PATH):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def _get_connection(self) -> sqlite3.Connection:
+        # Вызывается только из потока базы данных
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=20, check_same_thread=False)
+            for pragma in PRAGMAS:
+                self._conn.execute(pragma)
+            logger.info(f"Открыто соединение с базой данных {self.path} (WAL)")
+        return self._conn
+
+    async def run(self, func: Callable[[sqlite3.Connection], T]) -> T:
+        """Выполняем func(conn) в потоке базы данных"""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite')
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, lambda: func(self._get_connection()))
+
+    async def transaction(self, func: Callable[[sqlite3.Connection], T]) -> T:
+        """Выполняем func(conn) в одной транзакции: commit при успехе, rollback при ошибке"""
+        def run_in_transaction(conn: sqlite3.Connection) -> T:
+            with conn:
+                return func(conn)
+        return await self.run(run_in_transaction)
+
+    async def execute(self, sql: str, params: Sequence[Any] = ()) -> sqlite3.Cursor:
+        """Выполняем запрос на изменение и фиксируем его"""
+        return await self.transaction(lambda conn: conn.execute(sql, params))
+
+    async def executemany(self, sql: str, seq_of_params: Iterable[Sequence[Any]]) -> sqlite3.Cursor:
+        rows = list(seq_of_params)
+        return await self.transaction(lambda conn: conn.executemany(sql, rows))
+
+    async def fetchone(self, sql: str, params: Sequence[Any] = ()) -> Optional[tuple]:
+        return await self.run(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql: str, params: Sequence[Any] = ()) -> List[tuple]:
+        return await self.run(lambda conn: conn.execute(sql, params).fetchall())
+
+    async def close(self):
+        """Закрываем соединение и поток базы данных"""
+        if self._executor is None:
+            return
+
+        def close_connection(conn: sqlite3.Connection):
+            conn.execute("PRAGMA optimize")
+            conn.close()
+
+        if self._conn is not None:
+            await self.run(close_connection)
+            self._conn = None
+        self._executor.shutdown(wait=True)
+        self._executor = None
+        logger.info("Соединение с базой данных закрыто")
+
+# Общий экземпляр для всего бота
+db = Database()
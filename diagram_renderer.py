@@ -0,0 +1,292 @@
+import io
+import os
+import re
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import aiohttp
+from PIL import Image, ImageDraw, ImageFont
+
+from http_client import get_http_session
+from report_renderer import get_font_path, run_in_render_pool
+
+# Настраиваем логирование
+logger = logging.getLogger(__name__)
+
+# Способы отрисовки Mermaid-диаграмм
+DIAGRAM_BACKEND_KROKI = "kroki"  # сервер Kroki (свой или kroki.io)
+DIAGRAM_BACKEND_LOCAL = "local"  # встроенная отрисовка графа, без сети
+
+DIAGRAM_BACKEND = os.getenv("DIAGRAM_BACKEND", DIAGRAM_BACKEND_KROKI).lower()
+KROKI_URL = os.getenv("KROKI_URL", "https://kroki.io").rstrip('/')
+KROKI_TIMEOUT = float(os.getenv("KROKI_TIMEOUT", "30"))
+
+# Сколько готовых изображений храним в памяти (ключ - хэш кода диаграммы)
+DIAGRAM_CACHE_SIZE = int(os.getenv("DIAGRAM_CACHE_SIZE", "128"))
+
+# Параметры встроенной отрисовки (в пикселях, уже с учетом масштаба)
+LOCAL_SCALE = 2
+FONT_SIZE = 15 * LOCAL_SCALE
+NODE_PADDING = 10 * LOCAL_SCALE
+NODE_MAX_WIDTH = 220 * LOCAL_SCALE
+LAYER_GAP = 50 * LOCAL_SCALE
+NODE_GAP = 30 * LOCAL_SCALE
+CANVAS_MARGIN = 20 * LOCAL_SCALE
+ARROW_SIZE = 7 * LOCAL_SCALE
+
+NODE_FILL = (236, 243, 255)
+NODE_OUTLINE = (90, 120, 190)
+EDGE_COLOR = (90, 90, 90)
+TEXT_COLOR = (30, 30, 30)
+
+# Подмножество Mermaid, которое разрешено в generate_mermaid_diagram:
+# ID["Текст"], ID[Текст], ID("Текст"), ID{"Текст"} и связи ID1 --> ID2
+NODE_RE = re.compile(r'([A-Za-z0-9_]+)\s*(?:\[\s*"?([^"\]]*)"?\s*\]|\(\s*"?([^")]*)"?\s*\)|\{\s*"?([^"}]*)"?\s*\})?')
+EDGE_RE = re.compile(r'\s*(?:-->|---|==>|-\.->)\s*(?:\|[^|]*\|\s*)?')
+SKIP_PREFIXES = ('graph ', 'flowchart ', 'style ', 'classDef ', 'class ', 'linkStyle ', '%%', 'subgraph ')
+
+_cache: "OrderedDict[str, bytes]" = OrderedDict()
+
+def normalize_mermaid(mermaid_code: str) -> str:
+    """Очищаем код от лишних пробелов и переносов строк"""
+    return "\n".join(line.strip() for line in mermaid_code.split("\n") if line.strip())
+
+def parse_mermaid_graph(mermaid_code: str) -> Tuple[Dict[str, str], List[Tuple[str, str]]]:
+    """Разбираем graph TD: ({id: текст узла}, [(откуда, куда)]), порядок узлов - порядок появления"""
+    nodes: Dict[str, str] = {}
+    edges: List[Tuple[str, str]] = []
+    for line in normalize_mermaid(mermaid_code).split("\n"):
+        if line.startswith(SKIP_PREFIXES) or line in ('end', 'graph TD', 'flowchart TD'):
+            continue
+        ids = []
+        for part in EDGE_RE.split(line.rstrip(';')):
+            match = NODE_RE.fullmatch(part.strip())
+            if not match:
+                ids = []
+                break
+            node_id = match.group(1)
+            label = next((text for text in match.groups()[1:] if text is not None), None)
+            if label is not None or node_id not in nodes:
+                nodes[node_id] = (label or node_id).strip()
+            ids.append(node_id)
+        edges.extend(zip(ids, ids[1:]))
+    return nodes, edges
+
+def forward_edges(nodes: List[str], edges: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+    """Связи без обратных: обход в глубину отбрасывает связи, замыкающие цикл"""
+    children: Dict[str, List[str]] = {node: [] for node in nodes}
+    for src, dst in edges:
+        children[src].append(dst)
+    state: Dict[str, int] = {}  # 1 - узел в текущем пути обхода, 2 - обход узла завершен
+    result = []
+    for root in nodes:
+        if root in state:
+            continue
+        state[root] = 1
+        stack = [(root, iter(children[root]))]
+        while stack:
+            node, pending = stack[-1]
+            child = next(pending, None)
+            if child is None:
+                state[node] = 2
+                stack.pop()
+            elif child not in state:
+                result.append((node, child))
+                state[child] = 1
+                stack.append((child, iter(children[child])))
+            elif state[child] == 2:
+                result.append((node, child))
+    return result
+
+def layout_layers(nodes: List[str], edges: List[Tuple[str, str]]) -> List[List[str]]:
+    """Раскладываем узлы по уровням сверху вниз (самый длинный путь от корня)"""
+    edges = forward_edges(nodes, edges)
+    level = {node: 0 for node in nodes}
+    # Граф без циклов, поэтому хватает len(nodes) проходов
+    for _ in range(len(nodes)):
+        changed = False
+        for src, dst in edges:
+            if level[dst] <= level[src]:
+                level[dst] = level[src] + 1
+                changed = True
+        if not changed:
+            break
+
+    layers: List[List[str]] = [[] for _ in range(max(level.values(), default=-1) + 1)]
+    for node in nodes:
+        layers[level[node]].append(node)
+
+    # Узлы уровня упорядочиваем по среднему положению их родителей, чтобы меньше пересечений
+    parents: Dict[str, List[str]] = {node: [] for node in nodes}
+    for src, dst in edges:
+        parents[dst].append(src)
+    for upper, layer in zip(layers, layers[1:]):
+        position = {node: i for i, node in enumerate(upper)}
+        def barycenter(node: str) -> float:
+            ranks = [position[p] for p in parents[node] if p in position]
+            return sum(ranks) / len(ranks) if ranks else float(len(upper))
+        layer.sort(key=barycenter)
+    return [layer for layer in layers if layer]
+
+def wrap_text(draw: ImageDraw.ImageDraw, text: str, font, max_width: int) -> List[str]:
+    lines: List[str] = []
+    current = ''
+    for word in text.split():
+        candidate = f"{current} {word}".strip()
+        if current and draw.textlength(candidate, font=font) > max_width:
+            lines.append(current)
+            current = word
+        else:
+            current = candidate
+    if current:
+        lines.append(current)
+    return lines or ['']
+
+def render_local_png(mermaid_code: str) -> Optional[bytes]:
+    """Рисуем граф из ограниченного подмножества Mermaid без обращения к сети"""
+    nodes, edges = parse_mermaid_graph(mermaid_code)
+    if not nodes:
+        return None
+
+    font = ImageFont.truetype(get_font_path(), FONT_SIZE)
+    measure = ImageDraw.Draw(Image.new('RGB', (1, 1)))
+    line_height = int(FONT_SIZE * 1.25)
+
+    # Размеры блоков узлов
+    texts: Dict[str, List[str]] = {}
+    sizes: Dict[str, Tuple[int, int]] = {}
+    for node, label in nodes.items():
+        texts[node] = wrap_text(measure, label, font, NODE_MAX_WIDTH - 2 * NODE_PADDING)
+        width = max(measure.textlength(line, font=font) for line in texts[node])
+        sizes[node] = (int(width) + 2 * NODE_PADDING, len(texts[node]) * line_height + 2 * NODE_PADDING)
+
+    # Координаты: уровни друг под другом, узлы уровня по центру
+    layers = layout_layers(list(nodes), edges)
+    layer_widths = [sum(sizes[node][0] for node in layer) + NODE_GAP * (len(layer) - 1) for layer in layers]
+    layer_heights = [max(sizes[node][1] for node in layer) for layer in layers]
+    width = max(layer_widths) + 2 * CANVAS_MARGIN
+    height = sum(layer_heights) + LAYER_GAP * (len(layers) - 1) + 2 * CANVAS_MARGIN
+
+    boxes: Dict[str, Tuple[int, int, int, int]] = {}
+    y = CANVAS_MARGIN
+    for layer, layer_width, layer_height in zip(layers, layer_widths, layer_heights):
+        x = (width - layer_width) // 2
+        for node in layer:
+            node_width, node_height = sizes[node]
+            top = y + (layer_height - node_height) // 2
+            boxes[node] = (x, top, x + node_width, top + node_height)
+            x += node_width + NODE_GAP
+        y += layer_height + LAYER_GAP
+
+    image = Image.new('RGB', (width, height), 'white')
+    draw = ImageDraw.Draw(image)
+
+    # Сначала связи, чтобы блоки узлов перекрывали их концы
+    for src, dst in edges:
+        if src == dst:
+            continue
+        sx1, sy1, sx2, sy2 = boxes[src]
+        dx1, dy1, dx2, dy2 = boxes[dst]
+        if dy1 >= sy2:
+            start, end = ((sx1 + sx2) // 2, sy2), ((dx1 + dx2) // 2, dy1)
+        elif dy2 <= sy1:
+            # Обратная связь - снизу вверх
+            start, end = ((sx1 + sx2) // 2, sy1), ((dx1 + dx2) // 2, dy2)
+        else:
+            # Связь внутри уровня - сбоку
+            start, end = (sx2, (sy1 + sy2) // 2), (dx2, (dy1 + dy2) // 2)
+        draw.line([start, end], fill=EDGE_COLOR, width=LOCAL_SCALE)
+        draw_arrow_head(draw, start, end)
+
+    for node, (x1, y1, x2, y2) in boxes.items():
+        draw.rounded_rectangle((x1, y1, x2, y2), radius=6 * LOCAL_SCALE,
+                               fill=NODE_FILL, outline=NODE_OUTLINE, width=LOCAL_SCALE)
+        for i, line in enumerate(texts[node]):
+            line_width = draw.textlength(line, font=font)
+            draw.text(((x1 + x2 - line_width) / 2, y1 + NODE_PADDING + i * line_height),
+                      line, font=font, fill=TEXT_COLOR)
+
+    output = io.BytesIO()
+    image.save(output, format='PNG', optimize=True)
+    return output.getvalue()
+
+def draw_arrow_head(draw: ImageDraw.ImageDraw, start: Tuple[int, int], end: Tuple[int, int]):
+    dx, dy = end[0] - start[0], end[1] - start[1]
+    length = max((dx * dx + dy * dy) ** 0.5, 1)
+    ux, uy = dx / length, dy / length
+    base = (end[0] - ux * ARROW_SIZE * 1.6, end[1] - uy * ARROW_SIZE * 1.6)
+    draw.polygon([
+        end,
+        (base[0] - uy * ARROW_SIZE, base[1] + ux * ARROW_SIZE),
+        (base[0] + uy * ARROW_SIZE, base[1] - ux * ARROW_SIZE)
+    ], fill=EDGE_COLOR)
+
+def upscale_png(image_data: bytes) -> bytes:
+    """Увеличиваем изображение вдвое, чтобы в Telegram оно оставалось читаемым"""
+    try:
+        img = Image.open(io.BytesIO(image_data))
+        img = img.resize((img.size[0] * 2, img.size[1] * 2), Image.Resampling.LANCZOS)
+        output = io.BytesIO()
+        img.save(output, format='PNG', optimize=True)
+        return output.getvalue()
+    except Exception as e:
+        logger.warning(f"Ошибка при обработке изображения через PIL: {str(e)}")
+        return image_data
+
+async def render_kroki_png(mermaid_code: str) -> Optional[bytes]:
+    """Отрисовываем диаграмму на сервере Kroki (KROKI_URL)"""
+    session = get_http_session()
+    async with session.post(
+        f"{KROKI_URL}/mermaid/png",
+        data=mermaid_code.encode('utf-8'),
+        headers={'Content-Type': 'text/plain'},
+        timeout=aiohttp.ClientTimeout(total=KROKI_TIMEOUT)
+    ) as response:
+        if response.status != 200:
+            error_text = await response.text()
+            logger.error(f"Ошибка при получении изображения от Kroki: {response.status}, ответ: {error_text}")
+            return None
+        image_data = await response.read()
+    return await run_in_render_pool(upscale_png, image_data)
+
+def _cache_get(backend: str, mermaid_code: str) -> Tuple[str, Optional[bytes]]:
+    """Ключ кэша и готовое изображение, если диаграмма уже рисовалась этим способом"""
+    key = hashlib.sha256(f"{backend}\n{mermaid_code}".encode('utf-8')).hexdigest()
+    image = _cache.get(key)
+    if image is not None:
+        _cache.move_to_end(key)
+    return key, image
+
+async def render_diagram(mermaid_code: str) -> Optional[bytes]:
+    """Конвертирует Mermaid-код в PNG выбранным способом, повторные диаграммы берутся из кэша"""
+    mermaid_code = normalize_mermaid(mermaid_code)
+    key, image = _cache_get(DIAGRAM_BACKEND, mermaid_code)
+    if image is not None:
+        return image
+
+    if DIAGRAM_BACKEND == DIAGRAM_BACKEND_KROKI:
+        try:
+            image = await render_kroki_png(mermaid_code)
+        except Exception as e:
+            logger.error(f"Kroki недоступен ({KROKI_URL}): {str(e)}")
+        if image is None:
+            logger.info("Рисую диаграмму встроенным способом")
+            # Запасное изображение кэшируем как встроенное, чтобы Kroki попробовать снова
+            key, image = _cache_get(DIAGRAM_BACKEND_LOCAL, mermaid_code)
+            if image is not None:
+                return image
+    if image is None:
+        try:
+            image = await run_in_render_pool(render_local_png, mermaid_code)
+        except Exception as e:
+            logger.error(f"Ошибка при конвертации Mermaid в изображение: {str(e)}")
+            return None
+    if image is None:
+        return None
+
+    _cache[key] = image
+    while len(_cache) > DIAGRAM_CACHE_SIZE:
+        _cache.popitem(last=False)
+    return image
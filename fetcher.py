@@ -0,0 +1,114 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional
+
+# Настраиваем логирование
+logger = logging.getLogger(__name__)
+
+# Типы источников постов
+SOURCE_TELEGRAM = "telegram"
+SOURCE_VK = "vk"
+SOURCE_WEB = "web"
+
+# Ограничения на количество одновременных загрузок для каждого источника
+DEFAULT_SOURCE_LIMITS = {
+    SOURCE_TELEGRAM: int(os.getenv("TELEGRAM_FETCH_CONCURRENCY", "5")),
+    SOURCE_VK: int(os.getenv("VK_FETCH_CONCURRENCY", "3")),
+    SOURCE_WEB: int(os.getenv("WEB_FETCH_CONCURRENCY", "5"))
+}
+
+# Таймаут загрузки одного канала (в секундах)
+DEFAULT_FETCH_TIMEOUT = float(os.getenv("CHANNEL_FETCH_TIMEOUT", "120"))
+
+def get_channel_source(channel_link: str) -> str:
+    """Определяем источник по ссылке на канал"""
+    if channel_link.startswith('https://vk.com/'):
+        return SOURCE_VK
+    if channel_link.startswith(('http://', 'https://')):
+        return SOURCE_WEB
+    return SOURCE_TELEGRAM
+
+class ChannelFetchResult:
+    """Результат загрузки одного канала"""
+
+    def __init__(self, channel: str, source: str, posts=None, error: Optional[str] = None, elapsed: float = 0.0):
+        self.channel = channel
+        self.source = source
+        self.posts = posts
+        self.error = error
+        self.elapsed = elapsed
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def __repr__(self):
+        status = "ok" if self.ok else f"error={self.error!r}"
+        return f"<ChannelFetchResult {self.channel} ({self.source}) {status} {self.elapsed:.2f}s>"
+
+class ChannelFetcher:
+    """Параллельная загрузка каналов с ограничением конкурентности по источникам.
+
+    Семафоры общие для всех вызовов, поэтому одновременные анализы разных
+    пользователей вместе не превышают лимит для Telethon, VK и сайтов.
+    """
+
+    def __init__(self, fetch_func: Callable[..., Awaitable], limits: Optional[Dict[str, int]] = None,
+                 timeout: Optional[float] = DEFAULT_FETCH_TIMEOUT):
+        self.fetch_func = fetch_func
+        self.limits = {**DEFAULT_SOURCE_LIMITS, **(limits or {})}
+        self.timeout = timeout
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+
+    def _get_semaphore(self, source: str) -> asyncio.Semaphore:
+        if source not in self._semaphores:
+            self._semaphores[source] = asyncio.Semaphore(max(1, self.limits.get(source, 1)))
+        return self._semaphores[source]
+
+    async def _fetch_one(self, channel: str, **kwargs) -> ChannelFetchResult:
+        """Загружаем один канал, не выбрасывая исключений наружу"""
+        source = get_channel_source(channel)
+        async with self._get_semaphore(source):
+            start_time = time.monotonic()
+            try:
+                posts = await asyncio.wait_for(self.fetch_func(channel, **kwargs), self.timeout)
+                result = ChannelFetchResult(channel, source, posts=posts)
+            except asyncio.TimeoutError:
+                result = ChannelFetchResult(channel, source, error=f"❌ Превышено время ожидания ({self.timeout:.0f} с)")
+            except Exception as e:
+                result = ChannelFetchResult(channel, source, error=f"❌ {str(e) or type(e).__name__}")
+            result.elapsed = time.monotonic() - start_time
+
+        if result.ok:
+            logger.info(f"Канал {channel} ({source}) загружен за {result.elapsed:.2f} с")
+        else:
+            logger.warning(f"Канал {channel} ({source}) не загружен за {result.elapsed:.2f} с: {result.error}")
+        return result
+
+    async def iter_results(self, channels: List[str], **kwargs):
+        """Отдаем результаты по мере завершения загрузки каналов"""
+        tasks = [asyncio.ensure_future(self._fetch_one(channel, **kwargs)) for channel in channels]
+        start_time = time.monotonic()
+        failed = 0
+        try:
+            for future in asyncio.as_completed(tasks):
+                result = await future
+                if not result.ok:
+                    failed += 1
+                yield result
+        finally:
+            # Если потребитель прервал итерацию - отменяем оставшиеся загрузки
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+            if tasks:
+                logger.info(
+                    f"Загружено каналов: {len(tasks) - failed}/{len(tasks)} "
+                    f"за {time.monotonic() - start_time:.2f} с"
+                )
+
+    async def fetch_all(self, channels: List[str], **kwargs) -> List[ChannelFetchResult]:
+        """Загружаем все каналы и возвращаем результаты в порядке завершения"""
+        return [result async for result in self.iter_results(channels, **kwargs)]
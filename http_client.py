@@ -0,0 +1,55 @@
+import os
+import logging
+from typing import Optional
+
+import aiohttp
+
+# Настраиваем логирование
+logger = logging.getLogger(__name__)
+
+# Настройки пула соединений
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "100"))
+HTTP_LIMIT_PER_HOST = int(os.getenv("HTTP_LIMIT_PER_HOST", "20"))
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", "300"))
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "60"))
+
+# Общая сессия для всех исходящих HTTP-запросов бота
+_session: Optional[aiohttp.ClientSession] = None
+
+def _create_session() -> aiohttp.ClientSession:
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_POOL_LIMIT,
+        limit_per_host=HTTP_LIMIT_PER_HOST,
+        use_dns_cache=True,
+        ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+        keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT
+    )
+    # Общего таймаута нет: ответы ИИ могут идти несколько минут,
+    # таймауты задаются в конкретных запросах
+    return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=None))
+
+async def start_http_session() -> aiohttp.ClientSession:
+    """Создаем общую HTTP-сессию (вызывается при запуске бота)"""
+    global _session
+    if _session is None or _session.closed:
+        _session = _create_session()
+        logger.info(
+            f"HTTP-сессия создана: лимит соединений {HTTP_POOL_LIMIT}, "
+            f"на хост {HTTP_LIMIT_PER_HOST}"
+        )
+    return _session
+
+def get_http_session() -> aiohttp.ClientSession:
+    """Получаем общую HTTP-сессию, создавая ее при первом обращении"""
+    global _session
+    if _session is None or _session.closed:
+        _session = _create_session()
+    return _session
+
+async def close_http_session():
+    """Закрываем общую HTTP-сессию (вызывается при остановке бота)"""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+        logger.info("HTTP-сессия закрыта")
+    _session = None
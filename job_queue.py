@@ -0,0 +1,380 @@
+import os
+import json
+import time
+import uuid
+import zlib
+import asyncio
+import sqlite3
+import logging
+from collections import Counter, deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional
+
+from aiogram import Bot, types
+
+from db import db
+
+# Настраиваем логирование
+logger = logging.getLogger(__name__)
+
+# Сколько анализов выполняется одновременно во всем боте
+ANALYSIS_WORKERS = int(os.getenv("ANALYSIS_WORKERS", "3"))
+# Сколько задач может ждать в очереди
+JOB_QUEUE_MAX_SIZE = int(os.getenv("JOB_QUEUE_MAX_SIZE", "100"))
+# Сколько дней хранить завершенные задачи
+JOB_RETENTION_DAYS = int(os.getenv("JOB_RETENTION_DAYS", "7"))
+
+# Состояния задачи
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+
+# Этапы обработки одной папки (контрольные точки)
+STAGE_FETCHED = "fetched"
+STAGE_LLM_DONE = "llm_done"
+STAGE_RENDERED = "rendered"
+STAGE_DELIVERED = "delivered"
+
+class JobQueueFull(Exception):
+    pass
+
+def _create_tables(conn: sqlite3.Connection):
+    c = conn.cursor()
+
+    # Задачи очереди анализов
+    c.execute('''CREATE TABLE IF NOT EXISTS jobs
+                 (id TEXT PRIMARY KEY,
+                  user_id INTEGER,
+                  kind TEXT,
+                  key TEXT,
+                  title TEXT,
+                  params TEXT,
+                  chat_id INTEGER,
+                  status_message_id INTEGER,
+                  status TEXT,
+                  run_after REAL,
+                  created_at REAL,
+                  updated_at REAL)''')
+    # Колонка появилась позже - добавляем в уже созданную таблицу
+    columns = {row[1] for row in c.execute('PRAGMA table_info(jobs)')}
+    if 'run_after' not in columns:
+        c.execute('ALTER TABLE jobs ADD COLUMN run_after REAL')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at)')
+
+    # Контрольные точки задачи: этап и данные для продолжения (сжатый JSON)
+    c.execute('''CREATE TABLE IF NOT EXISTS job_checkpoints
+                 (job_id TEXT,
+                  step TEXT,
+                  stage TEXT,
+                  data BLOB,
+                  updated_at REAL,
+                  PRIMARY KEY (job_id, step))''')
+
+class Job:
+    """Задача анализа в очереди
+
+    Задача хранится в БД вместе с контрольными точками, поэтому после
+    перезапуска бота продолжается с последнего завершенного этапа.
+    Если задан chat_id, у задачи есть сообщение о статусе с кнопкой отмены,
+    которое обновляется по ходу выполнения.
+    """
+
+    def __init__(self, user_id: int, kind: str, key: str, title: str, params: Optional[dict] = None,
+                 chat_id: Optional[int] = None, id: Optional[str] = None):
+        self.id = id or uuid.uuid4().hex[:12]
+        self.user_id = user_id
+        self.kind = kind
+        self.key = key
+        self.title = title
+        self.params = params or {}
+        self.chat_id = chat_id
+        self.status = JOB_QUEUED
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.status_message_id: Optional[int] = None
+        self.run_after = self.created_at
+        self.resumed = False
+        self._bot: Optional[Bot] = None
+        self._task: Optional[asyncio.Task] = None
+        self._cancel_requested = False
+
+    @property
+    def active(self) -> bool:
+        return self.status in (JOB_QUEUED, JOB_RUNNING)
+
+    def _cancel_keyboard(self) -> types.InlineKeyboardMarkup:
+        keyboard = types.InlineKeyboardMarkup()
+        keyboard.add(types.InlineKeyboardButton("⛔️ Отменить", callback_data=f"cancel_job_{self.id}"))
+        return keyboard
+
+    async def set_status(self, text: str, final: bool = False):
+        """Обновляем сообщение о статусе задачи"""
+        if self.chat_id is None or self._bot is None:
+            return
+        text = f"{self.title}\n{text}"
+        reply_markup = None if final else self._cancel_keyboard()
+        try:
+            if self.status_message_id is None:
+                message = await self._bot.send_message(self.chat_id, text, reply_markup=reply_markup)
+                self.status_message_id = message.message_id
+                await db.execute('UPDATE jobs SET status_message_id = ? WHERE id = ?',
+                                 (self.status_message_id, self.id))
+            else:
+                await self._bot.edit_message_text(text, self.chat_id, self.status_message_id,
+                                                  reply_markup=reply_markup)
+        except Exception as e:
+            # Например, "message is not modified" или сообщение удалено пользователем
+            logger.debug(f"Не удалось обновить статус задачи {self.id}: {e}")
+
+    async def get_checkpoint(self, step: str) -> Optional[Dict[str, Any]]:
+        """Последняя контрольная точка шага: {'stage': ..., <данные>}"""
+        row = await db.fetchone('SELECT stage, data FROM job_checkpoints WHERE job_id = ? AND step = ?',
+                                (self.id, step))
+        if not row:
+            return None
+        stage, data = row
+        checkpoint = json.loads(zlib.decompress(data).decode('utf-8')) if data else {}
+        checkpoint['stage'] = stage
+        return checkpoint
+
+    async def checkpoint(self, step: str, stage: str, **data):
+        """Отмечаем завершение этапа шага и сохраняем данные, нужные для продолжения"""
+        payload = zlib.compress(json.dumps(data, ensure_ascii=False).encode('utf-8'))
+        await db.execute('''INSERT INTO job_checkpoints (job_id, step, stage, data, updated_at)
+                            VALUES (?, ?, ?, ?, ?)
+                            ON CONFLICT (job_id, step) DO UPDATE SET
+                                stage = excluded.stage,
+                                data = excluded.data,
+                                updated_at = excluded.updated_at''',
+                         (self.id, step, stage, payload, time.time()))
+
+    def __repr__(self):
+        return f"<Job {self.id} {self.kind} user={self.user_id} key={self.key!r} {self.status}>"
+
+class JobQueue:
+    """Очередь анализов с пулом воркеров
+
+    Число воркеров ограничивает количество одновременно выполняемых анализов.
+    Одинаковая задача пользователя (тот же key) не ставится в очередь повторно,
+    пока предыдущая не завершилась. Задачи, не завершенные к остановке бота,
+    продолжаются после запуска (resume).
+
+    kind_limits ограничивает число одновременно выполняемых задач одного вида:
+    лишние задачи откладываются, не занимая воркеры, и запускаются по мере
+    завершения предыдущих.
+    """
+
+    def __init__(self, bot: Bot, workers: int = ANALYSIS_WORKERS, max_size: int = JOB_QUEUE_MAX_SIZE,
+                 kind_limits: Optional[Dict[str, int]] = None):
+        self.bot = bot
+        self.workers = max(1, workers)
+        self.max_size = max_size
+        self.kind_limits = kind_limits or {}
+        self._handlers: Dict[str, Callable[[Job], Awaitable]] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        self._jobs: Dict[str, Job] = {}
+        self._running_by_kind: Counter = Counter()
+        self._deferred: Dict[str, Deque[Job]] = {}
+
+    def register(self, kind: str, handler: Callable[[Job], Awaitable]):
+        """Регистрируем обработчик задач вида kind"""
+        self._handlers[kind] = handler
+
+    async def init(self):
+        """Создаем таблицы и удаляем старые завершенные задачи"""
+        await db.transaction(_create_tables)
+        cutoff = time.time() - JOB_RETENTION_DAYS * 86400
+        await db.execute('DELETE FROM jobs WHERE status NOT IN (?, ?) AND updated_at < ?',
+                         (JOB_QUEUED, JOB_RUNNING, cutoff))
+
+    def start(self):
+        """Запускаем воркеры (вызывается при запуске бота)"""
+        if self._workers:
+            return
+        self._queue = asyncio.Queue()
+        self._workers = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        logger.info(f"Очередь анализов запущена: воркеров {self.workers}")
+
+    async def resume(self) -> int:
+        """Возвращаем в очередь задачи, прерванные остановкой бота"""
+        rows = await db.fetchall(
+            'SELECT id, user_id, kind, key, title, params, chat_id, status_message_id, run_after, created_at '
+            'FROM jobs WHERE status IN (?, ?) ORDER BY created_at',
+            (JOB_QUEUED, JOB_RUNNING)
+        )
+        for job_id, user_id, kind, key, title, params, chat_id, status_message_id, run_after, created_at in rows:
+            job = Job(user_id, kind, key, title, json.loads(params), chat_id, id=job_id)
+            job.status_message_id = status_message_id
+            job.created_at = created_at
+            job.run_after = run_after or created_at
+            job.resumed = True
+            job._bot = self.bot
+            self._jobs[job.id] = job
+            self._enqueue(job)
+            await job.set_status("⏳ Бот перезапущен, задача продолжится с места остановки")
+        if rows:
+            logger.info(f"Восстановлено задач из очереди: {len(rows)}")
+        return len(rows)
+
+    async def stop(self):
+        """Останавливаем воркеры
+
+        Выполняющиеся задачи прерываются, но остаются в БД и продолжатся после запуска.
+        """
+        for job in list(self._jobs.values()):
+            if job._task:
+                job._task.cancel()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        logger.info("Очередь анализов остановлена")
+
+    def find_active(self, user_id: int, key: str) -> Optional[Job]:
+        for job in self._jobs.values():
+            if job.user_id == user_id and job.key == key and job.active:
+                return job
+        return None
+
+    def get_user_jobs(self, user_id: int) -> List[Job]:
+        return [job for job in self._jobs.values() if job.user_id == user_id and job.active]
+
+    def position(self, job: Job) -> int:
+        """Позиция задачи в очереди (1 - следующая на выполнение)"""
+        queued = sorted((j for j in self._jobs.values() if j.status == JOB_QUEUED), key=lambda j: j.created_at)
+        return next((i for i, j in enumerate(queued, 1) if j is job), 0)
+
+    def _enqueue(self, job: Job):
+        """Передаем задачу воркерам сразу или в момент run_after"""
+        delay = job.run_after - time.time()
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self._queue.put_nowait, job)
+        else:
+            self._queue.put_nowait(job)
+
+    async def submit(self, job: Job, delay: float = 0, check_size: bool = True) -> Job:
+        """Ставим задачу в очередь, выполнение начнется не раньше чем через delay секунд
+
+        Если такая же задача пользователя уже ждет или выполняется, возвращается она.
+        check_size=False - для задач самого бота (расписание), которые не должны
+        отбрасываться из-за переполнения очереди.
+        """
+        if job.kind not in self._handlers:
+            raise ValueError(f"Нет обработчика для задач вида {job.kind}")
+        if self._queue is None:
+            self.start()
+        existing = self.find_active(job.user_id, job.key)
+        if existing:
+            return existing
+        if check_size and sum(1 for j in self._jobs.values() if j.status == JOB_QUEUED) >= self.max_size:
+            raise JobQueueFull("❌ Очередь анализов переполнена, попробуйте позже")
+
+        now = time.time()
+        job.run_after = now + max(0, delay)
+        await db.execute('''INSERT INTO jobs (id, user_id, kind, key, title, params, chat_id, status,
+                                             run_after, created_at, updated_at)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                         (job.id, job.user_id, job.kind, job.key, job.title,
+                          json.dumps(job.params, ensure_ascii=False), job.chat_id, JOB_QUEUED,
+                          job.run_after, now, now))
+        job._bot = self.bot
+        self._jobs[job.id] = job
+        self._enqueue(job)
+        await job.set_status(f"⏳ В очереди, позиция {self.position(job)}")
+        logger.info(f"Задача поставлена в очередь: {job}")
+        return job
+
+    async def cancel(self, job_id: str, user_id: int) -> bool:
+        """Отменяем задачу пользователя (ожидающую или выполняющуюся)"""
+        job = self._jobs.get(job_id)
+        if not job or job.user_id != user_id or not job.active:
+            return False
+        if job.status == JOB_QUEUED:
+            # Воркер пропустит задачу, когда дойдет до нее
+            await self._finish(job, JOB_CANCELLED)
+            await job.set_status("⛔️ Отменено", final=True)
+        elif job._task:
+            job._cancel_requested = True
+            job._task.cancel()
+        logger.info(f"Задача отменена пользователем: {job}")
+        return True
+
+    async def _set_status(self, job: Job, status: str):
+        job.status = status
+        await db.execute('UPDATE jobs SET status = ?, updated_at = ? WHERE id = ?',
+                         (status, time.time(), job.id))
+
+    async def _finish(self, job: Job, status: str):
+        """Завершаем задачу: контрольные точки больше не нужны"""
+        await self._set_status(job, status)
+        await db.execute('DELETE FROM job_checkpoints WHERE job_id = ?', (job.id,))
+        self._jobs.pop(job.id, None)
+
+    def _limit_reached(self, kind: str) -> bool:
+        limit = self.kind_limits.get(kind)
+        return limit is not None and self._running_by_kind[kind] >= limit
+
+    def _release_deferred(self, kind: str):
+        """Возвращаем в очередь следующую отложенную задачу вида kind, если есть место"""
+        deferred = self._deferred.get(kind)
+        while deferred and not self._limit_reached(kind):
+            job = deferred.popleft()
+            if job.status != JOB_CANCELLED:
+                self._queue.put_nowait(job)
+                return
+
+    async def _worker(self, index: int):
+        while True:
+            job = await self._queue.get()
+            try:
+                if job.status == JOB_CANCELLED:
+                    # Отмененная задача могла быть поднята из отложенных - место отдаем следующей
+                    self._release_deferred(job.kind)
+                    continue
+                if self._limit_reached(job.kind):
+                    # Воркер не ждет: задача вернется в очередь, когда освободится место
+                    self._deferred.setdefault(job.kind, deque()).append(job)
+                    continue
+                self._running_by_kind[job.kind] += 1
+                try:
+                    await self._run(job)
+                finally:
+                    self._running_by_kind[job.kind] -= 1
+                    self._release_deferred(job.kind)
+            except asyncio.CancelledError:
+                # Останавливается сам воркер
+                raise
+            except Exception as e:
+                logger.error(f"Воркер {index}: ошибка задачи {job}: {e}")
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job: Job):
+        handler = self._handlers[job.kind]
+        await self._set_status(job, JOB_RUNNING)
+        job.started_at = time.time()
+        waited = job.started_at - job.created_at
+        await job.set_status("🔄 Продолжаю выполнение..." if job.resumed else "🔄 Выполняется...")
+        logger.info(f"Задача запущена после {waited:.1f} с ожидания: {job}")
+
+        job._task = asyncio.create_task(handler(job))
+        try:
+            await job._task
+            await self._finish(job, JOB_DONE)
+            await job.set_status("✅ Готово", final=True)
+        except asyncio.CancelledError:
+            if not job._cancel_requested:
+                # Бот останавливается: задача остается в БД и продолжится после запуска
+                await job.set_status("⏸ Прервано остановкой бота, продолжится после перезапуска")
+                raise
+            await self._finish(job, JOB_CANCELLED)
+            await job.set_status("⛔️ Отменено", final=True)
+        except Exception as e:
+            await self._finish(job, JOB_FAILED)
+            error_msg = str(e) if str(e).startswith("❌") else f"❌ {str(e) or type(e).__name__}"
+            await job.set_status(error_msg, final=True)
+            logger.error(f"Задача завершилась с ошибкой: {job}: {error_msg}")
+        finally:
+            logger.info(f"Задача {job.id} остановлена через {time.time() - job.started_at:.1f} с ({job.status})")
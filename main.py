@@ -1,5 +1,4 @@
 import os
-import json
 from datetime import datetime, timedelta
 import asyncio
 import logging
@@ -14,31 +13,53 @@ from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from dotenv import load_dotenv
+
+# Загружаем переменные окружения до импорта модулей бота: они читают свои настройки при импорте
+load_dotenv()
+
 from telethon import TelegramClient
 from telethon.tl.functions.messages import GetHistoryRequest
 from telethon.tl.functions.channels import JoinChannelRequest
 from telethon.errors import ChannelPrivateError, UsernameNotOccupiedError
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 import random
-from fpdf import FPDF
-from transliterate import translit
 import platform
-import requests
-from PIL import Image
 import io
-import base64
 from ai_service import (
     try_gpt_request, 
+    request_completion,
+    init_response_cache,
+    get_cache_stats,
+    get_limiter_state,
     get_available_models,
     get_user_model,
+    estimate_tokens,
+    get_input_token_budget,
     user_models,
     MONICA_MODELS,
     OPENROUTER_MODELS
 )
-import aiohttp
-from typing import List, Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 import zlib
 from primervk_AND_pars import VKService, WebParser
+from fetcher import ChannelFetcher, SOURCE_TELEGRAM, SOURCE_VK, SOURCE_WEB
+import post_store
+from http_client import get_http_session, start_http_session, close_http_session
+from db import db
+from post_store import Post, merge_posts, format_posts
+from user_store import UserData
+from report_renderer import (
+    start_report_renderer,
+    stop_report_renderer,
+    render_txt_report,
+    render_pdf_report,
+    report_filename
+)
+from diagram_renderer import render_diagram
+from job_queue import (
+    Job, JobQueue, JobQueueFull,
+    STAGE_FETCHED, STAGE_LLM_DONE, STAGE_RENDERED, STAGE_DELIVERED
+)
 
 # Настраиваем логирование
 logging.basicConfig(
@@ -51,67 +72,127 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Загружаем переменные окружения
-logger.info("Загружаем .env файл...")
-load_dotenv()
 token = os.getenv('BOT_TOKEN')
 logger.info(f"Токен: {token}")
 
 if not token:
     raise ValueError("BOT_TOKEN не найден в .env файле!")
 
-def get_db_connection(max_attempts=5, retry_delay=1):
-    """Получение соединения с базой данных с обработкой блокировки"""
-    attempt = 0
-    while attempt < max_attempts:
-        try:
-            conn = sqlite3.connect('bot.db', timeout=20)  # Увеличиваем timeout
-            return conn
-        except sqlite3.OperationalError as e:
-            if "database is locked" in str(e):
-                attempt += 1
-                if attempt < max_attempts:
-                    time.sleep(retry_delay)
-                    continue
-            raise
-    raise sqlite3.OperationalError("Could not acquire database lock after multiple attempts")
-
-def init_db():
-    """Инициализация базы данных"""
-    conn = get_db_connection()
+def _create_tables(conn: sqlite3.Connection):
     c = conn.cursor()
     
-    try:
-        # Таблица для отчетов
-        c.execute('''CREATE TABLE IF NOT EXISTS reports
-                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                      user_id INTEGER,
-                      folder TEXT,
-                      content TEXT,
-                      created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-        
-        # Таблица для расписания
-        c.execute('''CREATE TABLE IF NOT EXISTS schedules
-                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                      user_id INTEGER,
-                      folder TEXT,
-                      time TEXT,
-                      is_active BOOLEAN DEFAULT 1)''')
-        
-        # Таблица для управления доступом
-        c.execute('''CREATE TABLE IF NOT EXISTS access_control
-                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                      user_id INTEGER,
-                      is_admin BOOLEAN,
-                      added_by INTEGER,
-                      added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-        
-        conn.commit()
-    finally:
-        conn.close()
-
-# Создаем планировщик (но не запускаем)
-scheduler = AsyncIOScheduler(timezone=pytz.UTC)
+    # Таблица для отчетов
+    c.execute('''CREATE TABLE IF NOT EXISTS reports
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  user_id INTEGER,
+                  folder TEXT,
+                  content TEXT,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_reports_user_created ON reports (user_id, created_at)')
+    
+    # Таблица для расписания
+    c.execute('''CREATE TABLE IF NOT EXISTS schedules
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  user_id INTEGER,
+                  folder TEXT,
+                  time TEXT,
+                  is_active BOOLEAN DEFAULT 1)''')
+    
+    # Раньше каждое сохранение добавляло новую строку: оставляем последнюю
+    # для каждой папки и приводим время к виду HH:MM
+    c.execute('''DELETE FROM schedules WHERE id NOT IN (
+                     SELECT MAX(id) FROM schedules GROUP BY user_id, folder)''')
+    for schedule_id, schedule_time in c.execute("SELECT id, time FROM schedules WHERE time NOT GLOB '[0-9][0-9]:[0-9][0-9]'").fetchall():
+        hour, minute = map(int, schedule_time.split(':'))
+        c.execute('UPDATE schedules SET time = ? WHERE id = ?', (f"{hour:02d}:{minute:02d}", schedule_id))
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_schedules_user_folder ON schedules (user_id, folder)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_schedules_active_time ON schedules (time) WHERE is_active = 1')
+    
+    # Таблица для управления доступом
+    c.execute('''CREATE TABLE IF NOT EXISTS access_control
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  user_id INTEGER,
+                  is_admin BOOLEAN,
+                  added_by INTEGER,
+                  added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    
+    # Перед созданием уникального индекса убираем дубликаты пользователей,
+    # оставляя самую раннюю запись с максимальными правами
+    c.execute('''UPDATE access_control SET is_admin = (
+                     SELECT MAX(is_admin) FROM access_control AS other
+                     WHERE other.user_id = access_control.user_id)
+                 WHERE user_id IN (
+                     SELECT user_id FROM access_control GROUP BY user_id HAVING COUNT(*) > 1)''')
+    c.execute('''DELETE FROM access_control WHERE id NOT IN (
+                     SELECT MIN(id) FROM access_control GROUP BY user_id)''')
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_access_control_user ON access_control (user_id)')
+    
+    # Таблица с последним обработанным сообщением канала для каждого расписания
+    c.execute('''CREATE TABLE IF NOT EXISTS channel_state
+                 (user_id INTEGER,
+                  folder TEXT,
+                  channel TEXT,
+                  last_message_id INTEGER,
+                  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  PRIMARY KEY (user_id, folder, channel))''')
+    
+    # Служебное состояние планировщика (например, последняя обработанная минута)
+    c.execute('''CREATE TABLE IF NOT EXISTS scheduler_state
+                 (name TEXT PRIMARY KEY,
+                  value TEXT)''')
+
+def _compress_legacy_reports(conn: sqlite3.Connection) -> int:
+    """Сжимаем отчеты, сохраненные до включения сжатия"""
+    rows = conn.execute("SELECT id, content FROM reports WHERE typeof(content) = 'text'").fetchall()
+    conn.executemany('UPDATE reports SET content = ? WHERE id = ?',
+                     [(compress_report(content), report_id) for report_id, content in rows])
+    return len(rows)
+
+async def init_db():
+    """Инициализация базы данных"""
+    await db.transaction(_create_tables)
+    
+    compressed = await db.transaction(_compress_legacy_reports)
+    if compressed:
+        logger.info(f"Сжато старых отчетов: {compressed}")
+    
+    # Таблицы локального хранилища постов
+    await post_store.init_post_store()
+    
+    # Таблица кэша ответов ИИ
+    await init_response_cache()
+    
+    # Таблицы с папками и настройками пользователей
+    await user_data.init()
+    
+    # Таблицы очереди анализов
+    await analysis_queue.init()
+    
+    # Права доступа держим в памяти
+    await load_access_cache()
+
+# Сколько времени сохраненные посты канала считаются актуальными без обращения к сети
+POST_STORE_MAX_AGE = timedelta(seconds=int(os.getenv('POST_STORE_MAX_AGE', '300')))
+# Сколько сообщений Telegram канала загружается за один раз (новые в приоритете)
+TELEGRAM_FETCH_LIMIT = int(os.getenv('TELEGRAM_FETCH_LIMIT', '1000'))
+
+# Насколько может опоздать запуск задачи планировщика (например, после перезапуска бота)
+SCHEDULER_MISFIRE_GRACE_TIME = int(os.getenv('SCHEDULER_MISFIRE_GRACE_TIME', '600'))
+# В каком окне (в секундах) разносятся анализы, назначенные на одно время
+SCHEDULE_SPREAD_SECONDS = int(os.getenv('SCHEDULE_SPREAD_SECONDS', '300'))
+# Сколько анализов по расписанию может выполняться одновременно
+SCHEDULED_ANALYSIS_CONCURRENCY = int(os.getenv('SCHEDULED_ANALYSIS_CONCURRENCY', '2'))
+
+# Создаем планировщик (но не запускаем).
+# Пропущенные запуски схлопываются в один и выполняются, только если опоздали не сильно
+scheduler = AsyncIOScheduler(
+    timezone=pytz.UTC,
+    job_defaults={
+        'coalesce': True,
+        'misfire_grace_time': SCHEDULER_MISFIRE_GRACE_TIME,
+        'max_instances': 1
+    }
+)
 
 # Декоратор для проверки доступа
 def require_access(func):
@@ -137,28 +218,25 @@ def require_admin(func):
         return await func(message, *args, **kwargs)
     return wrapper
 
+# Кэш прав доступа: {user_id: is_admin}. Загружается при запуске и
+# обновляется при добавлении и удалении пользователей
+access_cache: Dict[int, bool] = {}
+
+async def load_access_cache():
+    """Загружаем права доступа из БД в память"""
+    rows = await db.fetchall('SELECT user_id, is_admin FROM access_control')
+    access_cache.clear()
+    access_cache.update((user_id, bool(is_admin)) for user_id, is_admin in rows)
+    logger.info(f"Загружены права доступа: {len(access_cache)} пользователей")
+
 # Функции для управления доступом
 def is_user_allowed(user_id: int) -> bool:
     """Проверяем, есть ли у пользователя доступ к боту"""
-    conn = get_db_connection()
-    try:
-        c = conn.cursor()
-        c.execute('SELECT 1 FROM access_control WHERE user_id = ?', (user_id,))
-        result = c.fetchone() is not None
-        return result
-    finally:
-        conn.close()
+    return user_id in access_cache
 
 def is_user_admin(user_id: int) -> bool:
     """Проверяем, является ли пользователь администратором"""
-    conn = get_db_connection()
-    try:
-        c = conn.cursor()
-        c.execute('SELECT is_admin FROM access_control WHERE user_id = ?', (user_id,))
-        result = c.fetchone()
-        return result[0] if result else False
-    finally:
-        conn.close()
+    return access_cache.get(user_id, False)
 
 # Инициализируем клиенты
 bot = Bot(token=token, timeout=20)
@@ -168,42 +246,16 @@ dp = Dispatcher(bot, storage=storage)
 # Инициализируем клиент Telethon
 client = TelegramClient('telegram_session', int(os.getenv('API_ID')), os.getenv('API_HASH'))
 
-# Структура для хранения данных
-class UserData:
-    def __init__(self):
-        self.users = {}  # {user_id: {'folders': {}, 'prompts': {}, 'ai_settings': {}, 'vk_groups': [], 'websites': []}}
-        
-    def get_user_data(self, user_id: int) -> dict:
-        """Получаем или создаем данные пользователя"""
-        if str(user_id) not in self.users:
-            self.users[str(user_id)] = {
-                'folders': {},
-                'prompts': {},
-                'ai_settings': {
-                    'provider_index': 0,
-                    'model': get_user_model(user_id)
-                },
-                'vk_groups': [],
-                'websites': []
-            }
-        return self.users[str(user_id)]
-        
-    def save(self):
-        with open('user_data.json', 'w', encoding='utf-8') as f:
-            json.dump({'users': self.users}, f, ensure_ascii=False)
-    
-    @classmethod
-    def load(cls):
-        instance = cls()
-        try:
-            with open('user_data.json', 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                instance.users = data.get('users', {})
-        except FileNotFoundError:
-            pass
-        return instance
+# Папки, промпты и настройки пользователей
+user_data = UserData()
+
+# Виды задач очереди анализов
+JOB_KIND_ANALYSIS = "analysis"
+JOB_KIND_SCHEDULED = "scheduled"
 
-user_data = UserData.load()
+# Очередь анализов с общим ограничением на число одновременных запусков;
+# анализы по расписанию не занимают все воркеры, оставляя место ручным запускам
+analysis_queue = JobQueue(bot, kind_limits={JOB_KIND_SCHEDULED: SCHEDULED_ANALYSIS_CONCURRENCY})
 
 # Состояния для FSM
 class BotStates(StatesGroup):
@@ -221,143 +273,117 @@ class AccessControlStates(StatesGroup):
     waiting_for_user_id = State()
     waiting_for_user_id_remove = State()
 
-def save_report(user_id: int, folder: str, content: str):
-    """Сохраняем отчет в БД"""
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('INSERT INTO reports (user_id, folder, content) VALUES (?, ?, ?)',
-              (user_id, folder, content))
-    conn.commit()
+# Сколько отчетов показывать на одной странице истории
+REPORTS_PAGE_SIZE = int(os.getenv('REPORTS_PAGE_SIZE', '10'))
+
+def compress_report(content: str) -> bytes:
+    """Сжимаем текст отчета для хранения в БД"""
+    return zlib.compress(content.encode('utf-8'), 6)
+
+def decompress_report(content) -> str:
+    """Распаковываем отчет (старые отчеты хранятся несжатым текстом)"""
+    if isinstance(content, bytes):
+        return zlib.decompress(content).decode('utf-8')
+    return content or ""
+
+async def save_report(user_id: int, folder: str, content: str) -> int:
+    """Сохраняем отчет в БД и возвращаем его id"""
+    cursor = await db.execute('INSERT INTO reports (user_id, folder, content) VALUES (?, ?, ?)',
+                              (user_id, folder, compress_report(content)))
+    return cursor.lastrowid
+
+async def get_user_reports(user_id: int, limit: int = REPORTS_PAGE_SIZE, before_id: Optional[int] = None) -> list:
+    """Получаем страницу отчетов пользователя без их содержимого: (id, folder, created_at)
+
+    before_id - курсор: последний отчет предыдущей страницы.
+    """
+    if before_id is None:
+        return await db.fetchall(
+            'SELECT id, folder, created_at FROM reports WHERE user_id = ? '
+            'ORDER BY created_at DESC, id DESC LIMIT ?',
+            (user_id, limit)
+        )
+    return await db.fetchall(
+        'SELECT id, folder, created_at FROM reports WHERE user_id = ? '
+        'AND (created_at, id) < (SELECT created_at, id FROM reports WHERE id = ?) '
+        'ORDER BY created_at DESC, id DESC LIMIT ?',
+        (user_id, before_id, limit)
+    )
 
-def get_user_reports(user_id: int, limit: int = 10) -> list:
-    """Получаем последние отчеты пользователя"""
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('SELECT folder, content, created_at FROM reports WHERE user_id = ? ORDER BY created_at DESC LIMIT ?',
-              (user_id, limit))
-    reports = c.fetchall()
-    return reports
-
-def save_schedule(user_id: int, folder: str, time: str):
-    """Сохраняем расписание в БД"""
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('INSERT INTO schedules (user_id, folder, time) VALUES (?, ?, ?)',
-              (user_id, folder, time))
-    conn.commit()
+async def get_report(user_id: int, report_id: int) -> Optional[Tuple[str, str, str]]:
+    """Получаем отчет пользователя по id: (folder, content, created_at)"""
+    row = await db.fetchone(
+        'SELECT folder, content, created_at FROM reports WHERE id = ? AND user_id = ?',
+        (report_id, user_id)
+    )
+    if not row:
+        return None
+    folder, content, created_at = row
+    return folder, decompress_report(content), created_at
+
+# Ограничение Telegram на длину одного сообщения
+MESSAGE_MAX_LENGTH = 4096
+# Отчеты длиннее этого числа сообщений отправляются файлом
+REPORT_MAX_MESSAGES = int(os.getenv('REPORT_MAX_MESSAGES', '5'))
+
+def split_message(text: str, limit: int = MESSAGE_MAX_LENGTH) -> List[str]:
+    """Режем текст на части не длиннее limit, по возможности по границам строк"""
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind('\n', 0, limit)
+        if cut <= 0:
+            cut = limit
+        chunks.append(text[:cut])
+        text = text[cut:].lstrip('\n')
+    if text:
+        chunks.append(text)
+    return chunks
+
+async def save_schedule(user_id: int, folder: str, time: str):
+    """Сохраняем расписание в БД (у папки одно расписание, новое заменяет старое и включает его)"""
+    await db.execute('''INSERT INTO schedules (user_id, folder, time, is_active) VALUES (?, ?, ?, 1)
+                        ON CONFLICT (user_id, folder) DO UPDATE SET
+                            time = excluded.time,
+                            is_active = 1''',
+                     (user_id, folder, time))
+
+async def get_due_schedules(times: List[str]) -> list:
+    """Получаем активные расписания на указанное время (HH:MM)"""
+    placeholders = ', '.join('?' * len(times))
+    return await db.fetchall(
+        f'SELECT user_id, folder FROM schedules WHERE is_active = 1 AND time IN ({placeholders})',
+        times
+    )
 
-def get_active_schedules() -> list:
-    """Получаем все активные расписания"""
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('SELECT user_id, folder, time FROM schedules WHERE is_active = 1')
-    schedules = c.fetchall()
-    return schedules
-
-def generate_txt_report(content: str, folder: str) -> str:
-    """Генерирует отчет в формате TXT"""
-    filename = f"analysis_{folder}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
-    with open(filename, 'w', encoding='utf-8') as f:
-        f.write(content)
-    return filename
-
-# Определяем путь к шрифту в зависимости от ОС
-def get_font_path():
-    os_type = platform.system().lower()
-    if os_type == 'linux':
-        paths = [
-            "/usr/share/fonts/dejavu-sans-fonts/DejaVuSans.ttf",
-            "/usr/share/fonts/TTF/DejaVuSans.ttf",
-            "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
-        ]
-    elif os_type == 'windows':
-        paths = [
-            "C:\\Windows\\Fonts\\DejaVuSans.ttf",
-            os.path.join(os.getenv('LOCALAPPDATA'), 'Microsoft\\Windows\\Fonts\\DejaVuSans.ttf'),
-            "DejaVuSans.ttf"  # В текущей директории
-        ]
-    else:  # MacOS и другие
-        paths = [
-            "/Library/Fonts/DejaVuSans.ttf",
-            "/System/Library/Fonts/DejaVuSans.ttf",
-            "DejaVuSans.ttf"  # В текущей директории
-        ]
-    
-    # Проверяем наличие файла
-    for path in paths:
-        if os.path.exists(path):
-            return path
-            
-    # Если шрифт не найден - скачиваем
-    logger.info("Шрифт не найден, скачиваю...")
-    try:
-        import requests
-        url = "https://github.com/dejavu-fonts/dejavu-fonts/raw/master/ttf/DejaVuSans.ttf"
-        response = requests.get(url)
-        with open("DejaVuSans.ttf", "wb") as f:
-            f.write(response.content)
-        return "DejaVuSans.ttf"
-    except Exception as e:
-        logger.error(f"Не удалось скачать шрифт: {str(e)}")
-        raise Exception("Не удалось найти или скачать шрифт DejaVuSans.ttf")
-
-def generate_pdf_report(content: str, folder: str) -> str:
-    """Генерирует отчет в формате PDF"""
-    filename = f"analysis_{folder}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
-    
-    # Создаем PDF
-    pdf = FPDF()
-    pdf.add_page()
-    
-    # Добавляем шрифт с поддержкой русского
-    font_path = get_font_path()
-    pdf.add_font('DejaVu', '', font_path, uni=True)
-    pdf.set_font('DejaVu', '', 12)
-    
-    # Настраиваем отступы
-    margin = 20
-    pdf.set_margins(margin, margin, margin)
-    pdf.set_auto_page_break(True, margin)
-    
-    # Пишем заголовок
-    pdf.set_font_size(16)
-    pdf.cell(0, 10, f'Анализ папки: {folder}', 0, 1, 'L')
-    pdf.ln(10)
-    
-    # Возвращаемся к обычному размеру шрифта
-    pdf.set_font_size(12)
-    
-    # Разбиваем контент на строки и обрабатываем форматирование
-    for line in content.split('\n'):
-        if not line.strip():  # Пропускаем пустые строки
-            pdf.ln(5)
-            continue
-        
-        if line.strip().startswith('###'):  # H3 заголовок
-            pdf.set_font_size(14)
-            pdf.cell(0, 10, line.strip().replace('###', '').strip(), 0, 1, 'L')
-            pdf.set_font_size(12)
-            pdf.ln(5)
-        elif line.strip().startswith('####'):  # H4 заголовок
-            pdf.set_font_size(13)
-            pdf.cell(0, 10, line.strip().replace('####', '').strip(), 0, 1, 'L')
-            pdf.set_font_size(12)
-            pdf.ln(5)
-        else:  # Обычный текст
-            pdf.multi_cell(0, 10, line.strip())
-            pdf.ln(5)
-    
-    # Сохраняем PDF
-    try:
-        pdf.output(filename, 'F')
-    except Exception as e:
-        logger.error(f"Ошибка при сохранении PDF: {str(e)}")
-        # Пробуем сохранить с транслитерацией имени файла
-        safe_filename = translit(filename, 'ru', reversed=True)
-        pdf.output(safe_filename, 'F')
-        os.rename(safe_filename, filename)  # Переименовываем обратно
-    
-    return filename
+async def get_user_schedules(user_id: int) -> list:
+    """Получаем расписания пользователя: (id, folder, time, is_active)"""
+    return await db.fetchall(
+        'SELECT id, folder, time, is_active FROM schedules WHERE user_id = ? ORDER BY time, folder',
+        (user_id,)
+    )
+
+async def set_schedule_active(user_id: int, schedule_id: int, is_active: bool) -> bool:
+    """Включаем или выключаем расписание пользователя"""
+    cursor = await db.execute('UPDATE schedules SET is_active = ? WHERE id = ? AND user_id = ?',
+                              (is_active, schedule_id, user_id))
+    return cursor.rowcount > 0
+
+async def get_channel_last_message_id(user_id: int, folder: str, channel: str) -> int:
+    """Получаем ID последнего обработанного сообщения канала"""
+    result = await db.fetchone(
+        'SELECT last_message_id FROM channel_state WHERE user_id = ? AND folder = ? AND channel = ?',
+        (user_id, folder, channel)
+    )
+    return result[0] if result else 0
+
+async def save_channel_last_message_id(user_id: int, folder: str, channel: str, last_message_id: int):
+    """Сохраняем ID последнего обработанного сообщения канала"""
+    await db.execute('''INSERT INTO channel_state (user_id, folder, channel, last_message_id, updated_at)
+                        VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+                        ON CONFLICT (user_id, folder, channel) DO UPDATE SET
+                            last_message_id = MAX(last_message_id, excluded.last_message_id),
+                            updated_at = CURRENT_TIMESTAMP''',
+                     (user_id, folder, channel, last_message_id))
 
 @dp.message_handler(commands=['start'])
 @require_access
@@ -391,21 +417,44 @@ async def cmd_start(message: types.Message, state: FSMContext = None, **kwargs):
 @dp.message_handler(commands=['init_admin'])
 async def cmd_init_admin(message: types.Message):
     """Инициализация первого администратора"""
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('SELECT COUNT(*) FROM access_control')
-    count = c.fetchone()[0]
+    count = (await db.fetchone('SELECT COUNT(*) FROM access_control'))[0]
     
     if count == 0:
         # Если нет пользователей, добавляем первого админа
-        c.execute('INSERT INTO access_control (user_id, is_admin, added_by) VALUES (?, 1, ?)',
-                 (message.from_user.id, message.from_user.id))
-        conn.commit()
+        await db.execute('INSERT INTO access_control (user_id, is_admin, added_by) VALUES (?, 1, ?)',
+                         (message.from_user.id, message.from_user.id))
+        access_cache[message.from_user.id] = True
         await message.answer("✅ Вы успешно зарегистрированы как администратор!")
     else:
         await message.answer("❌ Администратор уже инициализирован")
-    
-    conn.close()
+
+@dp.message_handler(commands=['ai_stats'])
+@require_admin
+async def cmd_ai_stats(message: types.Message, state: FSMContext = None, **kwargs):
+    """Статистика кэша ответов ИИ и состояние ограничителей запросов"""
+    stats = await get_cache_stats()
+    text = (
+        f"🧠 Кэш ответов ИИ:\n\n"
+        f"✅ Попаданий: {stats['hits']}\n"
+        f"❌ Промахов: {stats['misses']}\n"
+        f"📈 Доля попаданий: {stats['hit_rate']:.0%}\n"
+        f"📦 Записей: {stats['entries']} ({stats['bytes'] / 1024:.0f} КБ)\n\n"
+        f"🚦 Сервисы ИИ:\n"
+    )
+    breaker_icons = {"closed": "🟢", "half_open": "🟡", "open": "🔴"}
+    limiter_state = get_limiter_state()
+    for service, state in limiter_state['providers'].items():
+        breaker = state['breaker']
+        text += (
+            f"{breaker_icons.get(breaker['status'], '⚪️')} {service}: "
+            f"{state['tokens']:.1f}/{state['capacity']:.0f} токенов, "
+            f"{state['rate_per_minute']:.0f}/мин, в очереди {state['waiting']}, "
+            f"ошибок подряд {breaker['failures']}\n"
+        )
+    busy_models = {model: state for model, state in limiter_state['models'].items() if state['waiting']}
+    for model, state in busy_models.items():
+        text += f"⏳ {model}: в очереди {state['waiting']}\n"
+    await message.answer(text)
 
 @dp.message_handler(lambda message: message.text == "👥 Управление доступом")
 @require_admin
@@ -420,7 +469,7 @@ async def access_control_menu(message: types.Message, state: FSMContext = None,
 
 @dp.callback_query_handler(lambda c: c.data == "list_users")
 async def list_users(callback_query: types.CallbackQuery):
-    users = get_allowed_users(callback_query.from_user.id)
+    users = await get_allowed_users(callback_query.from_user.id)
     if not users:
         await callback_query.message.answer("Список пользователей пуст")
         return
@@ -442,9 +491,10 @@ async def create_folder(message: types.Message):
 async def process_folder_name(message: types.Message, state: FSMContext):
     folder_name = message.text
     await state.update_data(current_folder=folder_name)
-    user_data.get_user_data(message.from_user.id)['folders'][folder_name] = []
-    user_data.get_user_data(message.from_user.id)['prompts'][folder_name] = "Проанализируй посты и составь краткий отчет"
-    user_data.save()
+    user = await user_data.get_user_data(message.from_user.id)
+    if folder_name in user['folders']:
+        await message.answer(f"Папка {folder_name} уже есть - новые каналы будут добавлены к ее каналам.")
+    await user_data.add_folder(message.from_user.id, folder_name)
     
     await BotStates.waiting_for_channels.set()
     await message.answer(
@@ -477,19 +527,19 @@ async def process_channels(message: types.Message, state: FSMContext):
         valid_channels.append(channel)
     
     if valid_channels:
-        user_data.get_user_data(message.from_user.id)['folders'][folder_name].extend(valid_channels)
-        user_data.save()
+        await user_data.add_channels(message.from_user.id, folder_name, valid_channels)
         await message.answer(f"✅ Каналы добавлены в папку {folder_name}")
 
 @dp.message_handler(lambda message: message.text == "📋 Список папок")
 @require_access
 async def list_folders(message: types.Message, state: FSMContext = None):
-    if not user_data.get_user_data(message.from_user.id)['folders']:
+    user = await user_data.get_user_data(message.from_user.id)
+    if not user['folders']:
         await message.answer("Пока нет созданных папок")
         return
 
     keyboard = types.InlineKeyboardMarkup(row_width=1)
-    for folder in user_data.get_user_data(message.from_user.id)['folders']:
+    for folder in user['folders']:
         keyboard.add(
             types.InlineKeyboardButton(
                 f"📁 {folder}",
@@ -510,7 +560,7 @@ async def edit_folder_menu(callback_query: types.CallbackQuery):
     keyboard = types.InlineKeyboardMarkup(row_width=2)
     
     # Добавляем кнопки для каждого канала
-    channels = user_data.get_user_data(callback_query.from_user.id)['folders'][folder]
+    channels = (await user_data.get_user_data(callback_query.from_user.id))['folders'][folder]
     for channel in channels:
         keyboard.add(
             types.InlineKeyboardButton(
@@ -548,12 +598,10 @@ async def add_channels_start(callback_query: types.CallbackQuery, state: FSMCont
 @dp.callback_query_handler(lambda c: c.data.startswith('delete_folder_'))
 async def delete_folder(callback_query: types.CallbackQuery):
     folder = callback_query.data.replace('delete_folder_', '')
-    user = user_data.get_user_data(callback_query.from_user.id)
+    user = await user_data.get_user_data(callback_query.from_user.id)
     
     if folder in user['folders']:
-        del user['folders'][folder]
-        del user['prompts'][folder]
-        user_data.save()
+        await user_data.delete_folder(callback_query.from_user.id, folder)
         
         await callback_query.message.edit_text(f"✅ Папка {folder} удалена")
         
@@ -575,12 +623,13 @@ async def back_to_folders(callback_query: types.CallbackQuery):
 
 @dp.message_handler(lambda message: message.text == "✏️ Изменить промпт")
 async def edit_prompt_start(message: types.Message):
-    if not user_data.get_user_data(message.from_user.id)['folders']:
+    user = await user_data.get_user_data(message.from_user.id)
+    if not user['folders']:
         await message.answer("Сначала создай хотя бы одну папку!")
         return
 
     keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    for folder in user_data.get_user_data(message.from_user.id)['folders']:
+    for folder in user['folders']:
         keyboard.add(folder)
     keyboard.add("🔙 Назад")
     
@@ -594,7 +643,8 @@ async def process_folder_selection(message: types.Message, state: FSMContext):
         await back_to_main_menu(message, state)
         return
 
-    if message.text not in user_data.get_user_data(message.from_user.id)['folders']:
+    user = await user_data.get_user_data(message.from_user.id)
+    if message.text not in user['folders']:
         await message.answer("Такой папки нет. Попробуй еще раз")
         return
 
@@ -602,7 +652,7 @@ async def process_folder_selection(message: types.Message, state: FSMContext):
     await BotStates.waiting_for_prompt.set()
     await message.answer(
         f"Текущий промпт для папки {message.text}:\n"
-        f"{user_data.get_user_data(message.from_user.id)['prompts'][message.text]}\n\n"
+        f"{user['prompts'][message.text]}\n\n"
         "Введи новый промпт:"
     )
 
@@ -611,8 +661,7 @@ async def process_new_prompt(message: types.Message, state: FSMContext):
     data = await state.get_data()
     folder = data['selected_folder']
     
-    user_data.get_user_data(message.from_user.id)['prompts'][folder] = message.text
-    user_data.save()
+    await user_data.set_prompt(message.from_user.id, folder, message.text)
     
     keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True)
     buttons = [
@@ -751,92 +800,217 @@ async def no_action(callback_query: types.CallbackQuery):
     # Просто отвечаем на callback_query, чтобы убрать часы загрузки
     await callback_query.answer()
 
-async def get_channel_posts(channel_link: str, hours: int = 24) -> str:
-    """Получаем посты из канала за последние hours часов"""
-    posts_text = ""
-    try:
-        if channel_link.startswith('https://vk.com/'):
-            # Обработка групп ВКонтакте
+async def iter_channel_posts(channel_link: str, hours: int = 24,
+                             watermark_key: Optional[Tuple[int, str]] = None,
+                             max_age: timedelta = POST_STORE_MAX_AGE):
+    """Асинхронно отдаем посты канала за последние hours часов в порядке публикации
+
+    Посты сохраняются в локальное хранилище, из сети догружается только то,
+    чего еще нет на диске или синхронизировано раньше max_age. Если передан
+    watermark_key (user_id, folder), для Telegram отдаются только сообщения
+    новее последнего обработанного для этого расписания. Саму отметку здесь
+    не сдвигаем - это делает задача после доставки отчета.
+    """
+    since = datetime.now(pytz.UTC) - timedelta(hours=hours)
+    if channel_link.startswith('https://vk.com/'):
+        # Обработка групп ВКонтакте
+        covered, fresh = await post_store.is_window_cached(SOURCE_VK, channel_link, since, max_age)
+        if not fresh:
             group_id = channel_link.split('/')[-1]
             vk_token = os.getenv('VK_TOKEN')
             if not vk_token:
-                return "❌ VK_TOKEN не найден в .env файле"
+                raise Exception("VK_TOKEN не найден в .env файле")
             
             vk_service = VKService(vk_token)
-            posts = vk_service.get_group_posts(group_id, count=100)
+            try:
+                # vk_api синхронный - выполняем в отдельном потоке, чтобы не блокировать цикл событий
+                posts = await asyncio.to_thread(vk_service.get_group_posts, group_id, count=100, raise_errors=True)
+            except Exception:
+                # Загрузка не удалась - период не отмечаем синхронизированным, отдаем то, что уже на диске
+                posts = None
             
-            for post in posts:
-                post_date = datetime.fromtimestamp(post['date'])
-                if datetime.now() - post_date <= timedelta(hours=hours):
-                    posts_text += f"{post.get('text', '')}\n\n"
+            if posts is not None:
+                await post_store.save_posts(
+                    Post(SOURCE_VK, channel_link, post['id'], datetime.fromtimestamp(post['date'], pytz.UTC),
+                         post.get('text', ''), post.get('views', {}).get('count'))
+                    for post in posts
+                )
+                # Закрепленный пост может быть сколь угодно старым - границу берем по обычным
+                dates = [datetime.fromtimestamp(post['date'], pytz.UTC) for post in posts if not post.get('is_pinned')]
+                # Если пришло меньше запрошенного - более старых постов в группе нет
+                if len(posts) >= 100 and dates:
+                    synced_from = min(dates)
+                else:
+                    synced_from = datetime.fromtimestamp(0, pytz.UTC)
+                await post_store.mark_synced(SOURCE_VK, channel_link, synced_from)
         
-        elif channel_link.startswith(('http://', 'https://')):
-            # Парсинг веб-сайтов
+        async for post in post_store.iter_posts(SOURCE_VK, channel_link, since):
+            yield post
+    
+    elif channel_link.startswith(('http://', 'https://')):
+        # Парсинг веб-сайтов: храним последний снимок страницы
+        covered, fresh = await post_store.is_window_cached(SOURCE_WEB, channel_link, since, max_age)
+        if not fresh:
             web_parser = WebParser()
-            posts_text = web_parser.parse_website(channel_link)
+            page_text = await asyncio.to_thread(web_parser.parse_website, channel_link)
+            if page_text:
+                page = Post(SOURCE_WEB, channel_link, zlib.crc32(page_text.encode('utf-8')),
+                            datetime.now(pytz.UTC), page_text)
+                await post_store.save_posts([page])
+                await post_store.mark_synced(SOURCE_WEB, channel_link, datetime.fromtimestamp(0, pytz.UTC))
+                yield page
+            return
         
-        else:
-            # Обработка Telegram каналов
-            try:
-                entity = await client.get_entity(channel_link)
-                posts = []
-                
-                async for message in client.iter_messages(entity, limit=100):
-                    message_date = message.date.replace(tzinfo=None)
-                    if datetime.now() - message_date <= timedelta(hours=hours):
-                        if message.text:
-                            posts.append(message.text)
-                
-                posts_text = "\n\n".join(posts)
+        snapshots = [post async for post in post_store.iter_posts(SOURCE_WEB, channel_link, datetime.fromtimestamp(0, pytz.UTC))]
+        if snapshots:
+            yield snapshots[-1]
+    
+    else:
+        # Обработка Telegram каналов
+        covered, fresh = await post_store.is_window_cached(SOURCE_TELEGRAM, channel_link, since, max_age)
+        if not fresh:
+            entity = await client.get_entity(channel_link)
+            # Если период уже на диске - догружаем только новые сообщения
+            fetch_min_id = await post_store.get_max_message_id(SOURCE_TELEGRAM, channel_link) if covered else 0
+            posts = []
+            fetched = 0
+            synced_from = since
             
-            except (ChannelPrivateError, UsernameNotOccupiedError) as e:
-                return f"❌ Ошибка при получении постов: {str(e)}"
+            # Сервер отдает сообщения новее fetch_min_id от новых к старым, не больше TELEGRAM_FETCH_LIMIT
+            async for message in client.iter_messages(entity, limit=TELEGRAM_FETCH_LIMIT, min_id=fetch_min_id):
+                if message.date < since:
+                    break
+                fetched += 1
+                synced_from = message.date
+                if message.text:
+                    posts.append(Post(SOURCE_TELEGRAM, channel_link, message.id, message.date,
+                                      message.text, message.views))
             
+            if fetched < TELEGRAM_FETCH_LIMIT:
+                synced_from = since
+            else:
+                # Уперлись в лимит - на диске период только от самого старого загруженного сообщения
+                logger.warning(f"Канал {channel_link}: загружено {fetched} сообщений (лимит), "
+                               f"период с {synced_from:%Y-%m-%d %H:%M} UTC")
+            await post_store.save_posts(posts)
+            await post_store.mark_synced(SOURCE_TELEGRAM, channel_link, synced_from)
+        
+        min_id = await get_channel_last_message_id(*watermark_key, channel_link) if watermark_key else 0
+        async for post in post_store.iter_posts(SOURCE_TELEGRAM, channel_link, since, min_id=min_id):
+            yield post
+
+async def get_channel_posts(channel_link: str, hours: int = 24,
+                            watermark_key: Optional[Tuple[int, str]] = None,
+                            max_age: timedelta = POST_STORE_MAX_AGE) -> List[Post]:
+    """Получаем посты из канала за последние hours часов"""
+    try:
+        return [post async for post in iter_channel_posts(channel_link, hours, watermark_key, max_age)]
+    except (ChannelPrivateError, UsernameNotOccupiedError) as e:
+        raise Exception(f"Канал недоступен: {str(e)}")
     except Exception as e:
-        logger.error(f"Ошибка при получении постов: {e}")
-        return f"❌ Ошибка при получении постов: {str(e)}"
+        logger.error(f"Ошибка при получении постов из {channel_link}: {e}")
+        raise
+
+# Параллельная загрузка каналов с лимитами для Telethon, VK и сайтов
+channel_fetcher = ChannelFetcher(get_channel_posts)
+
+@dp.message_handler(commands=['search'])
+@require_access
+async def cmd_search(message: types.Message, state: FSMContext = None, **kwargs):
+    """Поиск по сохраненным постам каналов пользователя"""
+    query = message.get_args().strip()
+    if not query:
+        await message.answer("Использование: /search <слова для поиска>")
+        return
     
-    return posts_text
+    user = await user_data.get_user_data(message.from_user.id)
+    channels = sorted({channel for folder_channels in user['folders'].values() for channel in folder_channels})
+    results = await post_store.search_posts(query, channels=channels, limit=10)
+    if not results:
+        await message.answer("Ничего не найдено в сохраненных постах")
+        return
+    
+    text = f"🔎 Результаты по запросу «{query}»:\n\n"
+    for channel, date, snippet in results:
+        text += f"📢 {channel} ({date.strftime('%Y-%m-%d %H:%M')})\n{snippet}\n\n"
+    await message.answer(text[:4096])
 
-@dp.message_handler(lambda message: message.text == "📊 История отчетов")
-async def show_reports(message: types.Message):
-    reports = get_user_reports(message.from_user.id)
+async def build_reports_page(user_id: int, before_id: Optional[int] = None):
+    """Формируем текст и клавиатуру страницы истории отчетов"""
+    reports = await get_user_reports(user_id, before_id=before_id)
     if not reports:
-        await message.answer("У вас пока нет сохраненных отчетов")
-        return
+        return None, None
         
-    text = "📊 Последние отчеты:\n\n"
-    for folder, content, created_at in reports:
+    text = "📊 Последние отчеты:\n\n" if before_id is None else "📊 Более ранние отчеты:\n\n"
+    for _, folder, created_at in reports:
         dt = datetime.fromisoformat(created_at.replace('Z', '+00:00'))
         text += f"📁 {folder} ({dt.strftime('%Y-%m-%d %H:%M')})\n"
         
     keyboard = types.InlineKeyboardMarkup(row_width=1)
-    for folder, _, _ in reports:
+    for report_id, folder, created_at in reports:
+        dt = datetime.fromisoformat(created_at.replace('Z', '+00:00'))
         keyboard.add(types.InlineKeyboardButton(
-            f"📄 Отчет по {folder}",
-            callback_data=f"report_{folder}"
+            f"📄 Отчет по {folder} ({dt.strftime('%d.%m %H:%M')})",
+            callback_data=f"report_{report_id}"
         ))
+    
+    # Полная страница - возможно, есть более ранние отчеты
+    if len(reports) == REPORTS_PAGE_SIZE:
+        keyboard.add(types.InlineKeyboardButton(
+            "⬇️ Более ранние",
+            callback_data=f"reports_before_{reports[-1][0]}"
+        ))
+    return text, keyboard
+
+@dp.message_handler(lambda message: message.text == "📊 История отчетов")
+async def show_reports(message: types.Message):
+    text, keyboard = await build_reports_page(message.from_user.id)
+    if not text:
+        await message.answer("У вас пока нет сохраненных отчетов")
+        return
         
     await message.answer(text, reply_markup=keyboard)
 
+@dp.callback_query_handler(lambda c: c.data.startswith('reports_before_'))
+async def show_reports_page(callback_query: types.CallbackQuery):
+    before_id = int(callback_query.data.replace('reports_before_', ''))
+    text, keyboard = await build_reports_page(callback_query.from_user.id, before_id)
+    if not text:
+        await callback_query.answer("Более ранних отчетов нет")
+        return
+    
+    await callback_query.message.edit_text(text, reply_markup=keyboard)
+    await callback_query.answer()
+
 @dp.callback_query_handler(lambda c: c.data.startswith('report_'))
 async def show_report_content(callback_query: types.CallbackQuery):
-    folder = callback_query.data.replace('report_', '')
-    reports = get_user_reports(callback_query.from_user.id)
-    
-    for rep_folder, content, created_at in reports:
-        if rep_folder == folder:
-            dt = datetime.fromisoformat(created_at.replace('Z', '+00:00'))
-            await callback_query.message.answer(
-                f"📊 Отчет по папке {folder}\n"
-                f"📅 {dt.strftime('%Y-%m-%d %H:%M')}\n\n"
-                f"{content}"
-            )
-            break
+    report_id = callback_query.data.replace('report_', '')
+    # Старые кнопки содержали имя папки вместо id отчета
+    report = await get_report(callback_query.from_user.id, int(report_id)) if report_id.isdigit() else None
+    if not report:
+        await callback_query.answer("❌ Отчет не найден, откройте историю отчетов заново")
+        return
+    
+    folder, content, created_at = report
+    dt = datetime.fromisoformat(created_at.replace('Z', '+00:00'))
+    header = f"📊 Отчет по папке {folder}\n📅 {dt.strftime('%Y-%m-%d %H:%M')}"
+    chunks = split_message(f"{header}\n\n{content}")
+    
+    if len(chunks) > REPORT_MAX_MESSAGES:
+        # Слишком длинный отчет отправляем файлом
+        document = io.BytesIO(content.encode('utf-8'))
+        await callback_query.message.answer_document(
+            types.InputFile(document, filename=f"report_{report_id}.txt"),
+            caption=header
+        )
+    else:
+        for chunk in chunks:
+            await callback_query.message.answer(chunk)
+    await callback_query.answer()
 
 @dp.message_handler(lambda message: message.text == "⏰ Настроить расписание")
 async def setup_schedule_start(message: types.Message):
-    user = user_data.get_user_data(message.from_user.id)
+    user = await user_data.get_user_data(message.from_user.id)
     if not user['folders']:
         await message.answer("Сначала создайте хотя бы одну папку!")
         return
@@ -852,6 +1026,44 @@ async def setup_schedule_start(message: types.Message):
         reply_markup=keyboard
     )
 
+def build_schedules_keyboard(schedules: list) -> types.InlineKeyboardMarkup:
+    keyboard = types.InlineKeyboardMarkup(row_width=1)
+    for schedule_id, folder, schedule_time, is_active in schedules:
+        if is_active:
+            keyboard.add(types.InlineKeyboardButton(
+                f"⏸ {folder} в {schedule_time} - выключить",
+                callback_data=f"schedule_off_{schedule_id}"
+            ))
+        else:
+            keyboard.add(types.InlineKeyboardButton(
+                f"▶️ {folder} в {schedule_time} - включить",
+                callback_data=f"schedule_on_{schedule_id}"
+            ))
+    return keyboard
+
+@dp.message_handler(commands=['schedules'])
+@require_access
+async def cmd_schedules(message: types.Message, state: FSMContext = None, **kwargs):
+    """Список расписаний пользователя с включением и выключением"""
+    schedules = await get_user_schedules(message.from_user.id)
+    if not schedules:
+        await message.answer("У вас пока нет расписаний. Используйте '⏰ Настроить расписание'")
+        return
+    
+    await message.answer("⏰ Ваши расписания (время UTC):", reply_markup=build_schedules_keyboard(schedules))
+
+@dp.callback_query_handler(lambda c: c.data.startswith(('schedule_on_', 'schedule_off_')))
+async def toggle_schedule(callback_query: types.CallbackQuery):
+    action, schedule_id = callback_query.data.replace('schedule_', '').split('_', 1)
+    is_active = action == 'on'
+    if not await set_schedule_active(callback_query.from_user.id, int(schedule_id), is_active):
+        await callback_query.answer("❌ Расписание не найдено")
+        return
+    
+    schedules = await get_user_schedules(callback_query.from_user.id)
+    await callback_query.message.edit_reply_markup(reply_markup=build_schedules_keyboard(schedules))
+    await callback_query.answer("▶️ Расписание включено" if is_active else "⏸ Расписание выключено")
+
 @dp.message_handler(state=BotStates.waiting_for_schedule_folder)
 async def process_schedule_folder(message: types.Message, state: FSMContext):
     if message.text == "🔙 Назад":
@@ -859,7 +1071,7 @@ async def process_schedule_folder(message: types.Message, state: FSMContext):
         await back_to_main_menu(message, state)
         return
         
-    user = user_data.get_user_data(message.from_user.id)
+    user = await user_data.get_user_data(message.from_user.id)
     if message.text not in user['folders']:
         await message.answer("Такой папки нет. Попробуйте еще раз")
         return
@@ -889,26 +1101,14 @@ async def process_schedule_time(message: types.Message, state: FSMContext):
     data = await state.get_data()
     folder = data['schedule_folder']
     
-    # Сохраняем расписание
-    save_schedule(message.from_user.id, folder, message.text)
-    
-    # Добавляем задачу в планировщик
+    # Сохраняем расписание: диспетчер прочитает его из БД в нужную минуту
     hour, minute = map(int, message.text.split(':'))
-    job_id = f"analysis_{message.from_user.id}_{folder}"
-    
-    scheduler.add_job(
-        run_scheduled_analysis,
-        'cron',
-        hour=hour,
-        minute=minute,
-        id=job_id,
-        replace_existing=True,
-        args=[message.from_user.id, folder]
-    )
+    await save_schedule(message.from_user.id, folder, f"{hour:02d}:{minute:02d}")
     
     await state.finish()
     await message.answer(
-        f"✅ Расписание установлено! Папка {folder} будет анализироваться ежедневно в {message.text}",
+        f"✅ Расписание установлено! Папка {folder} будет анализироваться ежедневно в {message.text}\n"
+        f"Включить или выключить расписания можно командой /schedules",
         reply_markup=types.ReplyKeyboardMarkup(resize_keyboard=True).add(*[
             "📁 Создать папку",
             "📋 Список папок",
@@ -920,37 +1120,218 @@ async def process_schedule_time(message: types.Message, state: FSMContext):
         ])
     )
 
-async def run_scheduled_analysis(user_id: int, folder: str):
-    """Запуск анализа по расписанию"""
+async def collect_posts_text(channels: List[str], chat_id: Optional[int] = None,
+                             watermarks: Optional[Dict[str, int]] = None, **fetch_kwargs) -> str:
+    """Загружаем каналы параллельно и склеиваем их посты в один текст, новые сверху
+
+    Если задан chat_id, о недоступных каналах сообщаем пользователю. В словарь
+    watermarks записывается последний полученный id сообщения каждого
+    Telegram канала.
+    """
+    channel_posts = []
+    valid_channels = [channel for channel in channels if is_valid_channel(channel)]
+    # Каналы загружаются параллельно, результаты приходят по мере готовности
+    async for result in channel_fetcher.iter_results(valid_channels, **fetch_kwargs):
+        if result.ok and result.posts:
+            channel_posts.append(result.posts)
+            if watermarks is not None:
+                message_ids = [post.id for post in result.posts if post.source == SOURCE_TELEGRAM]
+                if message_ids:
+                    watermarks[result.channel] = max(message_ids)
+        elif chat_id is None:
+            continue
+        elif result.ok:
+            await bot.send_message(chat_id, f"⚠️ Не удалось получить посты из канала {result.channel}")
+        else:
+            await bot.send_message(
+                chat_id,
+                f"⚠️ Не удалось получить посты из канала {result.channel} "
+                f"({result.elapsed:.1f} с): {result.error}"
+            )
+    
+    if not channel_posts:
+        return ""
+    # Сливаем посты каналов в один поток по дате, новые сверху
+    all_posts = merge_posts(*(reversed(posts) for posts in channel_posts), reverse=True)
+    return "\n\n---\n\n".join(format_posts(all_posts))
+
+async def load_checkpointed_report(user_id: int, checkpoint: dict) -> str:
+    """Текст отчета, сохраненного на этапе llm_done"""
+    report = await get_report(user_id, checkpoint['report_id'])
+    if not report:
+        raise Exception("❌ Сохраненный отчет не найден")
+    return report[1]
+
+# За какой период берутся посты при анализе по расписанию
+SCHEDULED_ANALYSIS_HOURS = 24
+
+async def run_scheduled_analysis(user_id: int, folder: str, fetched_at: Optional[datetime] = None,
+                                 delay: float = 0):
+    """Запуск анализа по расписанию: ставим задачу в общую очередь анализов
+
+    fetched_at - когда каналы папки были загружены общим пакетом расписания,
+    delay - через сколько секунд начать анализ.
+    """
+    job = Job(
+        user_id,
+        kind=JOB_KIND_SCHEDULED,
+        key=f"scheduled:{folder}",
+        title=f"⏰ Автоматический анализ папки {folder}",
+        params={'folder': folder, 'fetched_at': fetched_at.isoformat() if fetched_at else None}
+    )
+    try:
+        await analysis_queue.submit(job, delay=delay, check_size=False)
+    except JobQueueFull as e:
+        logger.error(f"Автоматический анализ папки {folder} пользователя {user_id} пропущен: {e}")
+
+# Выполняющиеся пакеты расписания (ссылки нужны, чтобы задачи не собрал сборщик мусора)
+schedule_batches = set()
+# Последняя минута, отданная пакету: в БД она попадает только после постановки анализов в очередь
+last_dispatched_minute: Optional[datetime] = None
+
+def schedule_jitter(user_id: int, folder: str) -> float:
+    """Сдвиг запуска анализа внутри окна SCHEDULE_SPREAD_SECONDS
+
+    Сдвиг постоянный для папки, поэтому отчет приходит примерно в одно и то же время.
+    """
+    if SCHEDULE_SPREAD_SECONDS <= 0:
+        return 0
+    return zlib.crc32(f"{user_id}:{folder}".encode('utf-8')) % SCHEDULE_SPREAD_SECONDS
+
+async def get_last_dispatch() -> Optional[datetime]:
+    row = await db.fetchone("SELECT value FROM scheduler_state WHERE name = 'last_dispatch'")
+    return datetime.fromisoformat(row[0]) if row else None
+
+async def save_last_dispatch(minute: datetime):
+    # Пакеты могут завершиться не по порядку - отметку только сдвигаем вперед
+    await db.execute('''INSERT INTO scheduler_state (name, value) VALUES ('last_dispatch', ?)
+                        ON CONFLICT (name) DO UPDATE SET value = MAX(value, excluded.value)''',
+                     (minute.isoformat(),))
+
+async def dispatch_due_schedules():
+    """Запускаем анализы, время которых пришлось на текущую минуту (вызывается раз в минуту)
+
+    Минуты, пропущенные из-за перезапуска или задержки, догоняются, но не дальше
+    SCHEDULER_MISFIRE_GRACE_TIME; каждая папка при этом запускается один раз.
+    """
+    global last_dispatched_minute
+    now = datetime.now(pytz.UTC).replace(second=0, microsecond=0)
+    last = await get_last_dispatch()
+    if last_dispatched_minute and (not last or last_dispatched_minute > last):
+        last = last_dispatched_minute
+    start = now
+    if last:
+        start = max(last + timedelta(minutes=1), now - timedelta(seconds=SCHEDULER_MISFIRE_GRACE_TIME))
+    if start > now:
+        return
+    
+    minutes = []
+    minute = start
+    while minute <= now:
+        minutes.append(minute.strftime('%H:%M'))
+        minute += timedelta(minutes=1)
+    if len(minutes) > 1:
+        logger.info(f"Догоняем пропущенные минуты расписания: {len(minutes) - 1}")
+    
+    # Из БД читаются только наступившие расписания
+    due = await get_due_schedules(minutes)
+    last_dispatched_minute = now
+    if not due:
+        await save_last_dispatch(now)
+        return
+    # Пакет может загружаться дольше минуты - не задерживаем следующий запуск диспетчера
+    task = asyncio.create_task(run_schedule_batch(due, now, start - timedelta(minutes=1)))
+    schedule_batches.add(task)
+    task.add_done_callback(schedule_batches.discard)
+
+async def run_schedule_batch(due: List[Tuple[int, str]], dispatch_minute: datetime,
+                             previous_minute: datetime):
+    """Анализ пакета расписаний, наступивших одновременно
+
+    Каждый уникальный канал загружается один раз на весь пакет, после чего
+    анализы пользователей читают посты из локального хранилища. Минута
+    dispatch_minute отмечается обработанной, когда все анализы уже в очереди:
+    если бот упадет раньше, после перезапуска пакет будет запущен снова. При
+    ошибке диспетчер возвращается к previous_minute и повторяет минуты пакета.
+    """
+    global last_dispatched_minute
     try:
-        user = user_data.get_user_data(user_id)
-        channels = user['folders'][folder]
+        folders = {}
+        for user_id, folder in due:
+            user = await user_data.get_user_data(user_id)
+            if folder in user['folders']:
+                folders[(user_id, folder)] = [channel for channel in user['folders'][folder] if is_valid_channel(channel)]
+            else:
+                logger.warning(f"Папка {folder} пользователя {user_id} из расписания не найдена")
         
-        all_posts = []
-        for channel in channels:
-            if not is_valid_channel(channel):
-                continue
-                
-            posts = await get_channel_posts(channel)
-            if posts:
-                all_posts.extend(posts)
-                
-        if not all_posts:
-            logger.error(f"Не удалось получить посты для автоматического анализа папки {folder}")
-            return
-            
-        posts_text = "\n\n---\n\n".join([
-            f"[{post['date']}]\n{post['text']}" for post in all_posts
-        ])
-        prompt = user['prompts'][folder]
+        subscriptions = sum(len(channels) for channels in folders.values())
+        unique_channels = sorted({channel for channels in folders.values() for channel in channels})
+        fetched_at = datetime.now(pytz.UTC)
+        loaded = 0
+        async for result in channel_fetcher.iter_results(unique_channels, hours=SCHEDULED_ANALYSIS_HOURS):
+            if result.ok:
+                loaded += 1
+        logger.info(
+            f"Пакет расписания: анализов {len(folders)}, загружено уникальных каналов "
+            f"{loaded}/{len(unique_channels)} (подписок {subscriptions})"
+        )
         
-        response = await try_gpt_request(prompt, posts_text, user_id, bot, user_data)
+        # Анализы разносятся по окну, чтобы не упираться одновременно в API моделей
+        for user_id, folder in folders:
+            await run_scheduled_analysis(user_id, folder, fetched_at, delay=schedule_jitter(user_id, folder))
+        await save_last_dispatch(dispatch_minute)
+    except Exception as e:
+        logger.error(f"Ошибка при запуске пакета расписания: {str(e)}")
+        # Уже поставленные анализы повторно не добавятся: очередь не принимает дубликаты задач
+        if last_dispatched_minute is not None and last_dispatched_minute > previous_minute:
+            last_dispatched_minute = previous_minute
+
+async def run_scheduled_analysis_job(job: Job):
+    """Анализ по расписанию (выполняется воркером очереди)
+
+    Загруженные посты и готовый отчет сохраняются в контрольных точках:
+    после перезапуска бота повторно выполняются только незавершенные этапы.
+    """
+    user_id = job.user_id
+    folder = job.params['folder']
+    try:
+        user = await user_data.get_user_data(user_id)
+        checkpoint = await job.get_checkpoint(folder) or {}
+        stage = checkpoint.get('stage')
         
-        # Сохраняем отчет
-        save_report(user_id, folder, response)
+        if stage is None:
+            # Каналы уже загружены общим пакетом расписания - читаем их из хранилища,
+            # даже если задача простояла в очереди дольше обычного срока актуальности
+            fetch_kwargs = {}
+            if job.params.get('fetched_at'):
+                fetched_at = datetime.fromisoformat(job.params['fetched_at'])
+                fetch_kwargs['max_age'] = datetime.now(pytz.UTC) - fetched_at + POST_STORE_MAX_AGE
+            # По расписанию берем только сообщения, появившиеся после прошлого запуска
+            watermarks = {}
+            posts_text = await collect_posts_text(user['folders'][folder], hours=SCHEDULED_ANALYSIS_HOURS,
+                                                  watermarks=watermarks, watermark_key=(user_id, folder),
+                                                  **fetch_kwargs)
+            if not posts_text:
+                logger.error(f"Не удалось получить посты для автоматического анализа папки {folder}")
+                return
+            # Отметку о прочитанных сообщениях сдвигаем только после доставки отчета
+            checkpoint = {'posts_text': posts_text, 'watermarks': watermarks}
+            await job.checkpoint(folder, STAGE_FETCHED, **checkpoint)
+            stage = STAGE_FETCHED
         
-        # Логируем успешное завершение отчета
-        logger.info("отчет удался")
+        if stage == STAGE_FETCHED:
+            prompt = user['prompts'][folder]
+            response = await try_gpt_request(prompt, checkpoint['posts_text'], user_id, bot, user_data)
+            
+            # Сохраняем отчет
+            report_id = await save_report(user_id, folder, response)
+            # Отметки каналов нужны до доставки - переносим их в новую контрольную точку
+            checkpoint = {key: value for key, value in checkpoint.items() if key not in ('stage', 'posts_text')}
+            checkpoint['report_id'] = report_id
+            await job.checkpoint(folder, STAGE_LLM_DONE, **checkpoint)
+            
+            # Логируем успешное завершение отчета
+            logger.info("отчет удался")
         
         # Отправляем уведомление пользователю
         await bot.send_message(
@@ -958,15 +1339,20 @@ async def run_scheduled_analysis(user_id: int, folder: str):
             f"✅ Автоматический анализ папки {folder} завершен!\n"
             f"Используйте '📊 История отчетов' чтобы просмотреть результат."
         )
+        for channel, message_id in checkpoint.get('watermarks', {}).items():
+            await save_channel_last_message_id(user_id, folder, channel, message_id)
+        await job.checkpoint(folder, STAGE_DELIVERED)
         
     except Exception as e:
         error_msg = f"❌ Ошибка при автоматическом анализе: {str(e)}"
         logger.error(error_msg)
-        await message.answer(error_msg)
+        await bot.send_message(user_id, error_msg)
+        # Задача должна завершиться с ошибкой; отметки каналов не сдвинуты, посты войдут в следующий запуск
+        raise
 
 @dp.message_handler(lambda message: message.text == "🔄 Запустить анализ")
 async def start_analysis(message: types.Message):
-    user = user_data.get_user_data(message.from_user.id)
+    user = await user_data.get_user_data(message.from_user.id)
     if not user['folders']:
         await message.answer("Сначала создайте хотя бы одну папку!")
         return
@@ -1052,121 +1438,200 @@ async def choose_period(callback_query: types.CallbackQuery):
         reply_markup=keyboard
     )
 
-@dp.callback_query_handler(lambda c: c.data.startswith('analyze_'))
-async def process_analysis_choice(callback_query: types.CallbackQuery):
-    # Парсим параметры из callback_data
-    params = callback_query.data.replace('analyze_', '').split('_')
-    if len(params) != 3:  # folder_hours_format
-        await callback_query.message.answer("❌ Ошибка в параметрах анализа")
-        return
-        
-    choice, hours, report_format = params
-    hours = int(hours)
-    user = user_data.get_user_data(callback_query.from_user.id)
+async def render_report_file(response: str, folder: str, report_format: str,
+                             chat_id: int) -> Tuple[Optional[types.InputFile], str]:
+    """Формируем отчет выбранного формата в памяти: (файл для отправки, итоговый формат)"""
+    if report_format == 'txt':
+        document = await render_txt_report(response, folder)
+        return types.InputFile(document, filename=report_filename(folder, 'txt')), report_format
     
-    await callback_query.message.edit_text("Начинаю анализ... Это может занять некоторое время")
+    try:
+        document = await render_pdf_report(response, folder)
+        return types.InputFile(document, filename=report_filename(folder, 'pdf')), report_format
+    except Exception as pdf_error:
+        logger.error(f"Ошибка при создании PDF: {str(pdf_error)}")
+        await bot.send_message(chat_id, "⚠️ Не удалось создать PDF версию отчета. Создаю TXT версию вместо PDF...")
+        
+        try:
+            document = await render_txt_report(response, folder)
+            await bot.send_message(chat_id, "✅ Отчет успешно создан в формате TXT")
+            return types.InputFile(document, filename=report_filename(folder, 'txt')), 'txt'
+        except Exception as txt_error:
+            logger.error(f"Ошибка при создании TXT: {str(txt_error)}")
+            await bot.send_message(chat_id, "❌ Не удалось создать отчет ни в каком формате")
+            return None, report_format
+
+async def run_analysis_job(job: Job):
+    """Анализ папок пользователя (выполняется воркером очереди)
+
+    Каждая папка проходит этапы fetched → llm_done → rendered → delivered.
+    После перезапуска бота уже выполненные этапы не повторяются.
+    """
+    user_id = job.user_id
+    chat_id = job.chat_id
+    choice = job.params['choice']
+    hours = job.params['hours']
+    report_format = job.params['report_format']
+    user = await user_data.get_user_data(user_id)
     
     if choice == 'all':
-        folders = user['folders'].items()
+        folders = list(user['folders'].items())
     else:
         folders = [(choice, user['folders'][choice])]
     
+    failed_folders = []
     for folder, channels in folders:
-        await callback_query.message.answer(f"Анализирую папку {folder}...")
-        
-        all_posts = []
-        for channel in channels:
-            if not is_valid_channel(channel):
-                continue
-                
-            posts = await get_channel_posts(channel, hours=hours)
-            if posts:
-                all_posts.extend(posts)
-            else:
-                await callback_query.message.answer(f"⚠️ Не удалось получить посты из канала {channel}")
-        
-        if not all_posts:
-            await callback_query.message.answer(f"❌ Не удалось получить посты из каналов в папке {folder}")
+        checkpoint = await job.get_checkpoint(folder) or {}
+        stage = checkpoint.get('stage')
+        if stage == STAGE_DELIVERED:
             continue
-            
-        # Сортируем посты по дате
-        all_posts.sort(key=lambda x: x['date'], reverse=True)
-        posts_text = "\n\n---\n\n".join([
-            f"[{post['date']}]\n{post['text']}" for post in all_posts
-        ])
-        
-        prompt = user['prompts'][folder]
-        temp_img = None  # Инициализируем переменную
+        diagram_task = None
         
         try:
-            response = await try_gpt_request(prompt, posts_text, callback_query.from_user.id, bot, user_data)
+            if stage is None:
+                await job.set_status(f"📥 Загружаю каналы папки {folder}...")
+                posts_text = await collect_posts_text(channels, chat_id, hours=hours)
+                if not posts_text:
+                    await bot.send_message(chat_id, f"❌ Не удалось получить посты из каналов в папке {folder}")
+                    failed_folders.append(folder)
+                    continue
+                checkpoint = {'posts_text': posts_text}
+                await job.checkpoint(folder, STAGE_FETCHED, **checkpoint)
+                stage = STAGE_FETCHED
+            
+            if stage == STAGE_FETCHED:
+                await job.set_status(f"🧠 Анализирую папку {folder}...")
+                prompt = user['prompts'][folder]
+                if DIAGRAM_MODE == DIAGRAM_MODE_INLINE:
+                    prompt = build_inline_diagram_prompt(prompt)
+                response = await try_gpt_request(prompt, checkpoint['posts_text'],
+                                                 user_id, bot, user_data)
+                mermaid_code = None
+                if DIAGRAM_MODE == DIAGRAM_MODE_INLINE:
+                    response, mermaid_code = split_inline_diagram(response)
+                
+                # Сохраняем отчет в БД, дальше достаточно его id (и диаграммы, если она пришла с отчетом)
+                checkpoint = {'report_id': await save_report(user_id, folder, response)}
+                if mermaid_code:
+                    checkpoint['mermaid'] = mermaid_code
+                await job.checkpoint(folder, STAGE_LLM_DONE, **checkpoint)
+                stage = STAGE_LLM_DONE
+            else:
+                response = await load_checkpointed_report(user_id, checkpoint)
             
-            # Сохраняем отчет в БД
-            save_report(callback_query.from_user.id, folder, response)
+            # Быстрая модель строит диаграмму, пока формируется и отправляется отчет
+            if DIAGRAM_MODE == DIAGRAM_MODE_CONCURRENT:
+                diagram_model = DIAGRAM_MODEL if DIAGRAM_MODEL in get_available_models() else None
+                diagram_task = asyncio.create_task(generate_mermaid_diagram(response, user_id, diagram_model))
             
-            # Генерируем отчет в выбранном формате
-            if report_format == 'txt':
-                filename = generate_txt_report(response, folder)
-            else:  # pdf
-                try:
-                    filename = generate_pdf_report(response, folder)
-                except Exception as pdf_error:
-                    logger.error(f"Ошибка при создании PDF: {str(pdf_error)}")
-                    await callback_query.message.answer("⚠️ Не удалось создать PDF версию отчета. Создаю TXT версию вместо PDF...")
-                    
-                    try:
-                        filename = generate_txt_report(response, folder)
-                        report_format = 'txt'
-                        await callback_query.message.answer("✅ Отчет успешно создан в формате TXT")
-                    except Exception as txt_error:
-                        logger.error(f"Ошибка при создании TXT: {str(txt_error)}")
-                        await callback_query.message.answer("❌ Не удалось создать отчет ни в каком формате")
-                        return
+            # Файл отчета формируется в памяти, поэтому после перезапуска собираем его заново
+            # в том же формате (PDF мог быть заменен на TXT)
+            await job.set_status(f"📄 Формирую отчет по папке {folder}...")
+            document, file_format = await render_report_file(response, folder,
+                                                             checkpoint.get('format', report_format), chat_id)
+            if not document:
+                failed_folders.append(folder)
+                continue
+            if stage == STAGE_LLM_DONE:
+                checkpoint = {key: value for key, value in checkpoint.items() if key != 'stage'}
+                checkpoint['format'] = file_format
+                await job.checkpoint(folder, STAGE_RENDERED, **checkpoint)
             
             # Отправляем файл
-            with open(filename, 'rb') as f:
-                await callback_query.message.answer_document(
-                    f,
-                    caption=f"✅ Анализ для папки {folder} ({report_format.upper()})"
-                )
+            await bot.send_document(
+                chat_id,
+                document,
+                caption=f"✅ Анализ для папки {folder} ({file_format.upper()})"
+            )
             
-            # Генерируем Mermaid-диаграмму после успешного создания отчета
+            # Mermaid-диаграмма: из ответа с отчетом, из параллельного запроса или отдельным запросом
             try:
-                mermaid_code = await generate_mermaid_diagram(response, callback_query.from_user.id)
+                mermaid_code = checkpoint.get('mermaid')
+                if diagram_task:
+                    await job.set_status(f"📊 Строю диаграмму для папки {folder}...")
+                    mermaid_code = await diagram_task
+                elif DIAGRAM_MODE == DIAGRAM_MODE_SEPARATE:
+                    await job.set_status(f"📊 Строю диаграмму для папки {folder}...")
+                    mermaid_code = await generate_mermaid_diagram(response, user_id)
                 if mermaid_code:
                     # Конвертируем в изображение
-                    diagram_image = await convert_mermaid_to_image(mermaid_code)
+                    diagram_image = await render_diagram(mermaid_code)
                     if diagram_image:
-                        # Сохраняем изображение во временный файл
-                        temp_img = f"diagram_{folder}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.png"
-                        with open(temp_img, 'wb') as f:
-                            f.write(diagram_image)
-                        
-                        # Отправляем диаграмму
-                        with open(temp_img, 'rb') as f:
-                            await callback_query.message.answer_photo(
-                                f,
-                                caption="📊 Визуализация основных моментов анализа"
-                            )
+                        # Отправляем диаграмму прямо из памяти
+                        await bot.send_photo(
+                            chat_id,
+                            types.InputFile(io.BytesIO(diagram_image), filename=f"diagram_{folder}.png"),
+                            caption="📊 Визуализация основных моментов анализа"
+                        )
             except Exception as diagram_error:
                 logger.error(f"Ошибка при создании диаграммы: {str(diagram_error)}")
                 # Продолжаем работу даже если диаграмма не создалась
             
-            # Удаляем временные файлы
-            os.remove(filename)
-            if temp_img and os.path.exists(temp_img):
-                os.remove(temp_img)
+            await job.checkpoint(folder, STAGE_DELIVERED)
             
         except Exception as e:
             error_msg = f"❌ Ошибка при анализе папки {folder}: {str(e)}"
             logger.error(error_msg)
-            await callback_query.message.answer(error_msg)
-            
-            # Удаляем временные файлы в случае ошибки
-            if temp_img and os.path.exists(temp_img):
-                os.remove(temp_img)
+            await bot.send_message(chat_id, error_msg)
+            failed_folders.append(folder)
+        finally:
+            # Отчет не отправлен или анализ отменен - диаграмма больше не нужна
+            if diagram_task and not diagram_task.done():
+                diagram_task.cancel()
+    
+    # Не все папки доставлены - задача завершается с ошибкой, а не "Готово"
+    if failed_folders:
+        raise Exception(f"❌ Не удалось проанализировать папки: {', '.join(failed_folders)}")
+    await bot.send_message(chat_id, "✅ Анализ завершен!")
+
+analysis_queue.register(JOB_KIND_ANALYSIS, run_analysis_job)
+analysis_queue.register(JOB_KIND_SCHEDULED, run_scheduled_analysis_job)
+
+@dp.callback_query_handler(lambda c: c.data.startswith('analyze_'))
+async def process_analysis_choice(callback_query: types.CallbackQuery):
+    # Парсим параметры из callback_data
+    params = callback_query.data.replace('analyze_', '').split('_')
+    if len(params) != 3:  # folder_hours_format
+        await callback_query.message.answer("❌ Ошибка в параметрах анализа")
+        return
+        
+    choice, hours, report_format = params
+    hours = int(hours)
+    user_id = callback_query.from_user.id
+    user = await user_data.get_user_data(user_id)
+    if choice != 'all' and choice not in user['folders']:
+        await callback_query.answer("❌ Папка не найдена")
+        return
+    
+    # Анализ выполняется в очереди, обработчик сразу освобождается
+    title = f"🔄 Анализ {'всех папок' if choice == 'all' else f'папки {choice}'} за {hours} ч"
+    job = Job(
+        user_id,
+        kind=JOB_KIND_ANALYSIS,
+        key=f"analysis:{choice}:{hours}:{report_format}",
+        title=title,
+        params={'choice': choice, 'hours': hours, 'report_format': report_format},
+        chat_id=callback_query.message.chat.id
+    )
+    try:
+        queued = await analysis_queue.submit(job)
+    except JobQueueFull as e:
+        await callback_query.answer(str(e), show_alert=True)
+        return
     
-    await callback_query.message.answer("✅ Анализ завершен!")
+    if queued is not job:
+        await callback_query.answer("⏳ Этот анализ уже выполняется", show_alert=True)
+        return
+    await callback_query.message.edit_text("Анализ поставлен в очередь. Это может занять некоторое время")
+    await callback_query.answer()
+
+@dp.callback_query_handler(lambda c: c.data.startswith('cancel_job_'))
+async def cancel_analysis_job(callback_query: types.CallbackQuery):
+    job_id = callback_query.data.replace('cancel_job_', '')
+    if await analysis_queue.cancel(job_id, callback_query.from_user.id):
+        await callback_query.answer("⛔️ Анализ отменен")
+    else:
+        await callback_query.answer("Анализ уже завершен")
 
 @dp.message_handler(lambda message: message.text == "🔙 Назад", state="*")
 async def back_to_main_menu(message: types.Message, state: FSMContext):
@@ -1201,7 +1666,7 @@ async def remove_channel(callback_query: types.CallbackQuery):
             await callback_query.answer("Отменено")
             return
             
-        user = user_data.get_user_data(callback_query.from_user.id)
+        user = await user_data.get_user_data(callback_query.from_user.id)
         
         logger.info(f"Попытка удаления канала {channel} из папки {folder}")
         logger.info(f"Доступные папки: {list(user['folders'].keys())}")
@@ -1218,8 +1683,7 @@ async def remove_channel(callback_query: types.CallbackQuery):
             return
             
         # Удаляем канал
-        user['folders'][folder].remove(channel)
-        user_data.save()
+        await user_data.remove_channel(callback_query.from_user.id, folder, channel)
         
         logger.info(f"Канал {channel} успешно удален из папки {folder}")
         
@@ -1256,43 +1720,34 @@ async def remove_channel(callback_query: types.CallbackQuery):
         logger.error(f"Ошибка при удалении канала: {str(e)}")
         await callback_query.answer("❌ Произошла ошибка при удалении канала")
 
-def add_user_access(admin_id: int, user_id: int, is_admin: bool = False) -> bool:
+async def add_user_access(admin_id: int, user_id: int, is_admin: bool = False) -> bool:
     """Добавляем пользователя в список разрешенных"""
     if not is_user_admin(admin_id):
         return False
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute('INSERT INTO access_control (user_id, is_admin, added_by) VALUES (?, ?, ?)',
-                 (user_id, is_admin, admin_id))
-        conn.commit()
-        conn.close()
-        return True
+        await db.execute('INSERT INTO access_control (user_id, is_admin, added_by) VALUES (?, ?, ?)',
+                         (user_id, is_admin, admin_id))
     except sqlite3.IntegrityError:
+        # Пользователь уже есть в списке
         return False
+    access_cache[user_id] = is_admin
+    return True
 
-def remove_user_access(admin_id: int, user_id: int) -> bool:
+async def remove_user_access(admin_id: int, user_id: int) -> bool:
     """Удаляем пользователя из списка разрешенных"""
     if not is_user_admin(admin_id):
         return False
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('DELETE FROM access_control WHERE user_id = ? AND user_id != ?', (user_id, admin_id))
-    affected = c.rowcount
-    conn.commit()
-    conn.close()
-    return affected > 0
+    cursor = await db.execute('DELETE FROM access_control WHERE user_id = ? AND user_id != ?', (user_id, admin_id))
+    if cursor.rowcount > 0:
+        access_cache.pop(user_id, None)
+        return True
+    return False
 
-def get_allowed_users(admin_id: int) -> list:
+async def get_allowed_users(admin_id: int) -> list:
     """Получаем список разрешенных пользователей"""
     if not is_user_admin(admin_id):
         return []
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('SELECT user_id, is_admin, added_at FROM access_control')
-    users = c.fetchall()
-    conn.close()
-    return users
+    return await db.fetchall('SELECT user_id, is_admin, added_at FROM access_control')
 
 @dp.callback_query_handler(lambda c: c.data == "add_user")
 async def add_user_start(callback_query: types.CallbackQuery):
@@ -1333,7 +1788,7 @@ async def process_add_user(message: types.Message, state: FSMContext):
         data = await state.get_data()
         is_admin = data.get('adding_user_type') == 'admin'
         
-        if add_user_access(message.from_user.id, user_id, is_admin):
+        if await add_user_access(message.from_user.id, user_id, is_admin):
             keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True)
             buttons = [
                 "📁 Создать папку",
@@ -1361,7 +1816,7 @@ async def process_add_user(message: types.Message, state: FSMContext):
 
 @dp.callback_query_handler(lambda c: c.data == "remove_user")
 async def remove_user_start(callback_query: types.CallbackQuery):
-    users = get_allowed_users(callback_query.from_user.id)
+    users = await get_allowed_users(callback_query.from_user.id)
     if not users:
         await callback_query.message.answer("Список пользователей пуст")
         return
@@ -1383,7 +1838,7 @@ async def remove_user_start(callback_query: types.CallbackQuery):
 @dp.callback_query_handler(lambda c: c.data.startswith("remove_user_"))
 async def process_remove_user(callback_query: types.CallbackQuery):
     user_id = int(callback_query.data.replace("remove_user_", ""))
-    if remove_user_access(callback_query.from_user.id, user_id):
+    if await remove_user_access(callback_query.from_user.id, user_id):
         await callback_query.message.edit_text(f"✅ Пользователь {user_id} удален")
     else:
         await callback_query.message.edit_text("❌ Не удалось удалить пользователя")
@@ -1412,33 +1867,33 @@ async def get_free_proxies() -> List[str]:
         "https://www.proxy-list.download/api/v1/get?type=http"
     ]
     
-    async with aiohttp.ClientSession() as session:
-        for api in proxy_apis:
-            try:
-                async with session.get(api, timeout=10) as response:
-                    if response.status == 200:
-                        if 'proxyfreeonly.com' in api:
-                            # Специальная обработка для proxyfreeonly.com
-                            data = await response.json()
-                            for proxy in data:
-                                if proxy.get('protocols') and proxy.get('ip') and proxy.get('port'):
-                                    for protocol in proxy['protocols']:
-                                        proxy_str = f"{protocol}://{proxy['ip']}:{proxy['port']}"
-                                        if proxy.get('anonymityLevel') == 'elite' and proxy.get('upTime', 0) > 80:
-                                            proxies.append(proxy_str)
-                        else:
-                            # Обработка других API
-                            text = await response.text()
-                            proxy_list = [
-                                f"http://{proxy.strip()}" 
-                                for proxy in text.split('\n') 
-                                if proxy.strip() and ':' in proxy
-                            ]
-                            proxies.extend(proxy_list)
+    session = get_http_session()
+    for api in proxy_apis:
+        try:
+            async with session.get(api, timeout=10) as response:
+                if response.status == 200:
+                    if 'proxyfreeonly.com' in api:
+                        # Специальная обработка для proxyfreeonly.com
+                        data = await response.json()
+                        for proxy in data:
+                            if proxy.get('protocols') and proxy.get('ip') and proxy.get('port'):
+                                for protocol in proxy['protocols']:
+                                    proxy_str = f"{protocol}://{proxy['ip']}:{proxy['port']}"
+                                    if proxy.get('anonymityLevel') == 'elite' and proxy.get('upTime', 0) > 80:
+                                        proxies.append(proxy_str)
+                    else:
+                        # Обработка других API
+                        text = await response.text()
+                        proxy_list = [
+                            f"http://{proxy.strip()}" 
+                            for proxy in text.split('\n') 
+                            if proxy.strip() and ':' in proxy
+                        ]
+                        proxies.extend(proxy_list)
                             
-            except Exception as e:
-                logger.warning(f"Ошибка при получении прокси из {api}: {str(e)}")
-                continue
+        except Exception as e:
+            logger.warning(f"Ошибка при получении прокси из {api}: {str(e)}")
+            continue
     
     return list(set(proxies))  # Убираем дубликаты
 
@@ -1463,20 +1918,20 @@ class ProxyManager:
                 
         try:
             start_time = time.time()
-            async with aiohttp.ClientSession() as session:
-                async with session.get(
-                    'https://api.ipify.org?format=json',
-                    proxy=proxy,
-                    timeout=5
-                ) as response:
-                    if response.status == 200:
-                        response_time = time.time() - start_time
-                        self.working_proxies[proxy] = {
-                            'last_check': datetime.now(),
-                            'response_time': response_time
-                        }
-                        return True
-                    return False
+            session = get_http_session()
+            async with session.get(
+                'https://api.ipify.org?format=json',
+                proxy=proxy,
+                timeout=5
+            ) as response:
+                if response.status == 200:
+                    response_time = time.time() - start_time
+                    self.working_proxies[proxy] = {
+                        'last_check': datetime.now(),
+                        'response_time': response_time
+                    }
+                    return True
+                return False
         except Exception as e:
             self.failed_proxies.add(proxy)
             if proxy in self.working_proxies:
@@ -1532,93 +1987,106 @@ class ProxyManager:
         }
         logger.info(f"Кэш прокси обновлен. Получено {len(self.proxies)} прокси")
 
-async def convert_mermaid_to_image(mermaid_code: str) -> Optional[bytes]:
-    """Конвертирует Mermaid-код в изображение через Kroki"""
-    try:
-        # Кодируем диаграмму в base64 и сжимаем
-        import zlib
-        import base64
-        
-        # Очищаем код от лишних пробелов и переносов строк
-        mermaid_code = "\n".join(line.strip() for line in mermaid_code.split("\n") if line.strip())
-        
-        # Кодируем и сжимаем данные
-        deflated = zlib.compress(mermaid_code.encode('utf-8'))
-        encoded = base64.urlsafe_b64encode(deflated).decode('ascii')
-        
-        # Формируем URL для запроса к Kroki
-        url = f"https://kroki.io/mermaid/png/{encoded}"
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    image_data = await response.read()
-                    
-                    # Улучшаем качество изображения с помощью PIL
-                    try:
-                        img = Image.open(io.BytesIO(image_data))
-                        
-                        # Увеличиваем размер изображения
-                        new_size = (img.size[0] * 2, img.size[1] * 2)
-                        img = img.resize(new_size, Image.Resampling.LANCZOS)
-                        
-                        # Улучшаем качество
-                        output = io.BytesIO()
-                        img.save(output, format='PNG', quality=95, optimize=True)
-                        return output.getvalue()
-                    except Exception as e:
-                        logger.warning(f"Ошибка при обработке изображения через PIL: {str(e)}")
-                        return image_data
-                else:
-                    error_text = await response.text()
-                    logger.error(f"Ошибка при получении изображения от Kroki: {response.status}, ответ: {error_text}")
-                    return None
-    except Exception as e:
-        logger.error(f"Ошибка при конвертации Mermaid в изображение: {str(e)}")
+# Как строится диаграмма к отчету:
+# separate - отдельным запросом к модели пользователя после отправки отчета
+# inline - в том же запросе, что и отчет (ответ делится на отчет и Mermaid-код)
+# concurrent - запросом к быстрой модели DIAGRAM_MODEL параллельно с формированием отчета
+# off - без диаграмм
+DIAGRAM_MODE_SEPARATE = 'separate'
+DIAGRAM_MODE_INLINE = 'inline'
+DIAGRAM_MODE_CONCURRENT = 'concurrent'
+DIAGRAM_MODE_OFF = 'off'
+DIAGRAM_MODE = os.getenv('DIAGRAM_MODE', DIAGRAM_MODE_SEPARATE).lower()
+DIAGRAM_MODEL = os.getenv('DIAGRAM_MODEL', 'claude-3-haiku-20240307')
+
+MERMAID_RULES = (
+    "Следуй этим правилам СТРОГО:\n"
+    "1. Начни с 'graph TD'\n"
+    "2. Используй только латинские буквы и цифры для ID узлов\n"
+    "3. Каждый узел должен иметь уникальный ID\n"
+    "4. Максимум 10 узлов\n"
+    "5. Используй только простые стрелки '-->' для связей\n"
+    "6. Текст узлов должен быть кратким, на русском языке\n"
+    "7. Не используй HTML-теги или спецсимволы\n"
+    "8. Формат узла: ID[\"Текст узла\"]\n"
+    "9. Формат связи: ID1 --> ID2\n\n"
+    "Пример правильного кода:\n"
+    "graph TD\n"
+    "    A[\"Главная тема\"] --> B[\"Подтема 1\"]\n"
+    "    A --> C[\"Подтема 2\"]\n"
+    "    B --> D[\"Вывод 1\"]\n"
+    "    C --> E[\"Вывод 2\"]\n"
+)
+
+# Разделы ответа, когда отчет и диаграмма запрашиваются одним запросом
+DIAGRAM_SECTION_MARKER = "===ДИАГРАММА==="
+INLINE_DIAGRAM_PROMPT = (
+    "{prompt}\n\n"
+    "После отчета добавь отдельной строкой {marker}, а за ней простую Mermaid-диаграмму "
+    "основных моментов отчета в блоке ```mermaid. {rules}"
+)
+MERMAID_BLOCK_RE = re.compile(r'```mermaid\s*\n(.*?)```', re.S)
+
+def build_inline_diagram_prompt(prompt: str) -> str:
+    """Промпт анализа, в ответ на который модель вернет и отчет, и диаграмму"""
+    return INLINE_DIAGRAM_PROMPT.format(prompt=prompt, marker=DIAGRAM_SECTION_MARKER, rules=MERMAID_RULES)
+
+def split_inline_diagram(response: str) -> Tuple[str, Optional[str]]:
+    """Делим ответ на текст отчета и Mermaid-код (None, если диаграммы нет)"""
+    if DIAGRAM_SECTION_MARKER in response:
+        report, diagram = response.rsplit(DIAGRAM_SECTION_MARKER, 1)
+    else:
+        # Модель могла не поставить разделитель - ищем последний блок mermaid
+        blocks = list(MERMAID_BLOCK_RE.finditer(response))
+        if not blocks:
+            return response, None
+        report = response[:blocks[-1].start()] + response[blocks[-1].end():]
+        diagram = blocks[-1].group(1)
+    mermaid_code = clean_mermaid_code(diagram)
+    return report.strip(), mermaid_code
+
+def clean_mermaid_code(mermaid_code: str) -> Optional[str]:
+    """Очищаем ответ модели до Mermaid-кода"""
+    # Очищаем код от markdown обрамления
+    mermaid_code = mermaid_code.replace("```mermaid", "").replace("```", "").strip()
+    if not mermaid_code:
         return None
+    
+    # Проверяем, что код начинается с graph TD
+    if not mermaid_code.startswith("graph TD"):
+        mermaid_code = "graph TD\n" + mermaid_code
+        
+    # Добавляем отступы для лучшей читаемости
+    return "\n".join(
+        "    " + line if line.strip() and not line.strip().startswith("graph") else line
+        for line in mermaid_code.split("\n")
+    )
+
+async def generate_mermaid_diagram(analysis_text: str, user_id: int, model: Optional[str] = None) -> Optional[str]:
+    """Генерирует Mermaid-диаграмму на основе анализа
 
-async def generate_mermaid_diagram(analysis_text: str, user_id: int) -> Optional[str]:
-    """Генерирует Mermaid-диаграмму на основе анализа"""
+    Без model запрос идет к модели пользователя, иначе - к указанной модели
+    без сообщений пользователю о ходе запроса. Если отчет не помещается
+    в контекст указанной модели, диаграмму строит модель пользователя.
+    """
     try:
-        prompt = (
+        instructions = (
             "На основе следующего анализа создай простую Mermaid-диаграмму. "
-            "Следуй этим правилам СТРОГО:\n"
-            "1. Начни с 'graph TD'\n"
-            "2. Используй только латинские буквы и цифры для ID узлов\n"
-            "3. Каждый узел должен иметь уникальный ID\n"
-            "4. Максимум 10 узлов\n"
-            "5. Используй только простые стрелки '-->' для связей\n"
-            "6. Текст узлов должен быть кратким, на русском языке\n"
-            "7. Не используй HTML-теги или спецсимволы\n"
-            "8. Формат узла: ID[\"Текст узла\"]\n"
-            "9. Формат связи: ID1 --> ID2\n\n"
-            "Пример правильного кода:\n"
-            "graph TD\n"
-            "    A[\"Главная тема\"] --> B[\"Подтема 1\"]\n"
-            "    A --> C[\"Подтема 2\"]\n"
-            "    B --> D[\"Вывод 1\"]\n"
-            "    C --> E[\"Вывод 2\"]\n\n"
-            f"Анализ:\n{analysis_text}"
+            f"{MERMAID_RULES}\n"
+            "Анализ:\n"
         )
+        prompt = instructions + analysis_text
         
-        mermaid_code = await try_gpt_request(prompt, "", user_id, bot, user_data)
+        if model:
+            if estimate_tokens(analysis_text) > get_input_token_budget(model, instructions):
+                logger.info(f"Отчет не помещается в контекст {model}, диаграмму строит модель отчета")
+                model = get_user_model(user_id)
+            mermaid_code = await request_completion(model, prompt, "")
+        else:
+            mermaid_code = await try_gpt_request(prompt, "", user_id, bot, user_data)
         if not mermaid_code:
             return None
-            
-        # Очищаем код от markdown обрамления
-        mermaid_code = mermaid_code.replace("```mermaid", "").replace("```", "").strip()
-        
-        # Проверяем, что код начинается с graph TD
-        if not mermaid_code.startswith("graph TD"):
-            mermaid_code = "graph TD\n" + mermaid_code
-            
-        # Добавляем отступы для лучшей читаемости
-        mermaid_code = "\n".join(
-            "    " + line if line.strip() and not line.strip().startswith("graph") else line
-            for line in mermaid_code.split("\n")
-        )
-        
-        return mermaid_code
+        return clean_mermaid_code(mermaid_code)
     except Exception as e:
         logger.error(f"Ошибка при генерации Mermaid-диаграммы: {str(e)}")
         return None
@@ -1626,28 +2094,32 @@ async def generate_mermaid_diagram(analysis_text: str, user_id: int) -> Optional
 async def main():
     try:
         # Инициализируем базу данных
-        init_db()
+        await init_db()
+        
+        # Находим шрифт для PDF-отчетов и загружаем его метрики один раз
+        await start_report_renderer()
+        
+        # Общая HTTP-сессия с пулом соединений для ИИ, Kroki и прокси
+        await start_http_session()
         
         # Запускаем клиент Telethon
         await client.start()
         
+        # Запускаем воркеры очереди анализов и продолжаем прерванные задачи
+        analysis_queue.start()
+        await analysis_queue.resume()
+        
         # Запускаем планировщик
         scheduler.start()
         
-        # Восстанавливаем сохраненные расписания
-        for user_id, folder, time in get_active_schedules():
-            hour, minute = map(int, time.split(':'))
-            job_id = f"analysis_{user_id}_{folder}"
-            scheduler.add_job(
-                run_scheduled_analysis,
-                'cron',
-                hour=hour,
-                minute=minute,
-                id=job_id,
-                replace_existing=True,
-                args=[user_id, folder]
-            )
-            logger.info(f"Восстановлено расписание: {job_id} в {time}")
+        # Диспетчер расписаний: раз в минуту запускает наступившие анализы одним пакетом
+        scheduler.add_job(
+            dispatch_due_schedules,
+            'cron',
+            minute='*',
+            id='schedule_dispatcher',
+            replace_existing=True
+        )
         
         # Получаем инфу о боте с обработкой таймаута
         try:
@@ -1664,12 +2136,21 @@ async def main():
         logger.error(f"Ошибка при запуске бота: {str(e)}")
         raise
     finally:
+        # Останавливаем запуск новых анализов и отменяем текущие
+        scheduler.shutdown()
+        for task in list(schedule_batches):
+            task.cancel()
+        await asyncio.gather(*schedule_batches, return_exceptions=True)
+        await analysis_queue.stop()
+        await stop_report_renderer()
+        
         # Закрываем все соединения
         await dp.storage.close()
         await dp.storage.wait_closed()
         await bot.session.close()
+        await close_http_session()
         await client.disconnect()
-        scheduler.shutdown()
+        await db.close()
 
 if __name__ == '__main__':
     # Настраиваем политику событийного цикла
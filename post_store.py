@@ -0,0 +1,206 @@
+import heapq
+import sqlite3
+import logging
+from datetime import datetime, timedelta
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+import pytz
+
+from db import db
+
+# Настраиваем логирование
+logger = logging.getLogger(__name__)
+
+# Сколько постов читается из БД за один запрос при потоковой выдаче
+POSTS_PAGE_SIZE = 500
+
+# Формат дат в БД: UTC, сравнивается как строка
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+class Post:
+    """Пост из канала Telegram, группы VK или страницы сайта"""
+    __slots__ = ('source', 'channel', 'id', 'date', 'text', 'views')
+
+    def __init__(self, source: str, channel: str, id: int, date: datetime, text: str, views: Optional[int] = None):
+        self.source = source
+        self.channel = channel
+        self.id = id
+        self.date = date
+        self.text = text
+        self.views = views
+
+    @property
+    def key(self) -> Tuple[str, str, int]:
+        return (self.source, self.channel, self.id)
+
+    def format(self) -> str:
+        """Текст поста для передачи в ИИ"""
+        return f"[{self.date.strftime('%Y-%m-%d %H:%M')}] {self.channel}\n{self.text}"
+
+    def __repr__(self):
+        return f"<Post {self.source}:{self.channel}:{self.id} {self.date:%Y-%m-%d %H:%M}>"
+
+def merge_posts(*streams: Iterable[Post], reverse: bool = False) -> Iterator[Post]:
+    """Сливаем отсортированные по дате потоки постов в один, убирая дубликаты
+
+    Каждый поток должен быть отсортирован в том же направлении (reverse),
+    тогда слияние идет лениво, без сортировки всего списка в памяти.
+    """
+    seen = set()
+    for post in heapq.merge(*streams, key=lambda post: post.date, reverse=reverse):
+        if post.key in seen:
+            continue
+        seen.add(post.key)
+        yield post
+
+def format_posts(posts: Iterable[Post]) -> Iterator[str]:
+    """Отдаем посты по одному в текстовом виде"""
+    for post in posts:
+        yield post.format()
+
+def to_db_date(dt: datetime) -> str:
+    """Переводим дату в строку UTC для хранения в БД"""
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(pytz.UTC).replace(tzinfo=None)
+    return dt.strftime(DATE_FORMAT)
+
+def from_db_date(value: str) -> datetime:
+    """Переводим строку из БД в дату UTC"""
+    return pytz.UTC.localize(datetime.strptime(value, DATE_FORMAT))
+
+def _create_tables(conn: sqlite3.Connection):
+    c = conn.cursor()
+    # Посты всех источников
+    c.execute('''CREATE TABLE IF NOT EXISTS posts
+                 (source TEXT NOT NULL,
+                  channel TEXT NOT NULL,
+                  message_id INTEGER NOT NULL,
+                  date TIMESTAMP NOT NULL,
+                  text TEXT NOT NULL,
+                  views INTEGER,
+                  PRIMARY KEY (source, channel, message_id))''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_posts_channel_date ON posts (source, channel, date)')
+
+    # Полнотекстовый индекс по тексту постов (external content)
+    c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts
+                 USING fts5(text, content='posts', content_rowid='rowid')''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS posts_ai AFTER INSERT ON posts BEGIN
+                     INSERT INTO posts_fts (rowid, text) VALUES (new.rowid, new.text);
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS posts_ad AFTER DELETE ON posts BEGIN
+                     INSERT INTO posts_fts (posts_fts, rowid, text) VALUES ('delete', old.rowid, old.text);
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS posts_au AFTER UPDATE OF text ON posts BEGIN
+                     INSERT INTO posts_fts (posts_fts, rowid, text) VALUES ('delete', old.rowid, old.text);
+                     INSERT INTO posts_fts (rowid, text) VALUES (new.rowid, new.text);
+                 END''')
+
+    # Непрерывный период канала, который лежит на диске: от synced_from до synced_at
+    # (загрузка всегда идет до текущего момента, поэтому время загрузки - конец периода)
+    c.execute('''CREATE TABLE IF NOT EXISTS channel_sync
+                 (source TEXT NOT NULL,
+                  channel TEXT NOT NULL,
+                  synced_from TIMESTAMP NOT NULL,
+                  synced_at TIMESTAMP NOT NULL,
+                  PRIMARY KEY (source, channel))''')
+
+async def init_post_store():
+    """Создаем таблицы хранилища постов и полнотекстовый индекс"""
+    await db.transaction(_create_tables)
+
+async def save_posts(posts: Iterable[Post]) -> int:
+    """Сохраняем посты, существующие обновляем"""
+    rows = [
+        (post.source, post.channel, post.id, to_db_date(post.date), post.text, post.views)
+        for post in posts
+    ]
+    if not rows:
+        return 0
+    await db.executemany('''INSERT INTO posts (source, channel, message_id, date, text, views)
+                            VALUES (?, ?, ?, ?, ?, ?)
+                            ON CONFLICT (source, channel, message_id) DO UPDATE SET
+                                text = excluded.text,
+                                views = excluded.views
+                            WHERE posts.text != excluded.text OR posts.views IS NOT excluded.views''',
+                         rows)
+    return len(rows)
+
+async def get_max_message_id(source: str, channel: str) -> int:
+    """ID самого нового сохраненного поста канала"""
+    result = await db.fetchone('SELECT MAX(message_id) FROM posts WHERE source = ? AND channel = ?',
+                               (source, channel))
+    return result[0] or 0
+
+async def get_sync_state(source: str, channel: str) -> Optional[Tuple[datetime, datetime]]:
+    """Возвращаем (synced_from, synced_at) канала или None, если канал не загружался"""
+    result = await db.fetchone('SELECT synced_from, synced_at FROM channel_sync WHERE source = ? AND channel = ?',
+                               (source, channel))
+    return (from_db_date(result[0]), from_db_date(result[1])) if result else None
+
+async def mark_synced(source: str, channel: str, synced_from: datetime):
+    """Отмечаем, что период канала от synced_from до текущего момента лежит на диске
+
+    Если загруженный период не стыкуется с сохраненным (между ними был перерыв),
+    старый период не продлеваем: непрерывно на диске лежит только новый.
+    """
+    await db.execute('''INSERT INTO channel_sync (source, channel, synced_from, synced_at)
+                        VALUES (?, ?, ?, ?)
+                        ON CONFLICT (source, channel) DO UPDATE SET
+                            synced_from = CASE WHEN excluded.synced_from <= synced_at
+                                               THEN MIN(synced_from, excluded.synced_from)
+                                               ELSE excluded.synced_from END,
+                            synced_at = excluded.synced_at''',
+                     (source, channel, to_db_date(synced_from), to_db_date(datetime.now(pytz.UTC))))
+
+async def is_window_cached(source: str, channel: str, since: datetime, max_age: timedelta) -> Tuple[bool, bool]:
+    """Проверяем, покрывает ли диск период с since: (покрыт, свежий)"""
+    state = await get_sync_state(source, channel)
+    if not state:
+        return False, False
+    synced_from, synced_at = state
+    covered = synced_from <= since
+    return covered, covered and datetime.now(pytz.UTC) - synced_at <= max_age
+
+async def iter_posts(source: str, channel: str, since: datetime, min_id: int = 0):
+    """Асинхронно отдаем посты канала с since (и новее min_id) в порядке публикации
+
+    Посты читаются страницами по POSTS_PAGE_SIZE, поэтому в памяти не лежит
+    вся история канала сразу.
+    """
+    cursor_date, cursor_id = to_db_date(since), -1
+    while True:
+        rows = await db.fetchall('''SELECT message_id, date, text, views FROM posts
+                                    WHERE source = ? AND channel = ? AND message_id > ?
+                                      AND (date > ? OR (date = ? AND message_id > ?))
+                                    ORDER BY date, message_id
+                                    LIMIT ?''',
+                                 (source, channel, min_id, cursor_date, cursor_date, cursor_id, POSTS_PAGE_SIZE))
+        for message_id, date, text, views in rows:
+            yield Post(source, channel, message_id, from_db_date(date), text, views)
+        if len(rows) < POSTS_PAGE_SIZE:
+            return
+        cursor_id, cursor_date = rows[-1][0], rows[-1][1]
+
+def _build_fts_query(query: str) -> str:
+    """Экранируем слова запроса, чтобы пользовательский ввод не ломал синтаксис FTS5"""
+    return " ".join('"' + term.replace('"', '""') + '"' for term in query.split())
+
+async def search_posts(query: str, channels: Optional[List[str]] = None, limit: int = 10) -> List[Tuple[str, datetime, str]]:
+    """Полнотекстовый поиск по сохраненным постам: (channel, date, snippet)"""
+    fts_query = _build_fts_query(query)
+    if not fts_query:
+        return []
+    sql = '''SELECT p.channel, p.date, snippet(posts_fts, 0, '«', '»', '…', 16)
+             FROM posts_fts JOIN posts p ON p.rowid = posts_fts.rowid
+             WHERE posts_fts MATCH ?'''
+    params: list = [fts_query]
+    if channels is not None:
+        if not channels:
+            return []
+        sql += f" AND p.channel IN ({', '.join('?' for _ in channels)})"
+        params.extend(channels)
+    sql += ' ORDER BY p.date DESC LIMIT ?'
+    params.append(limit)
+
+    rows = await db.fetchall(sql, params)
+    return [(channel, from_db_date(date), snippet) for channel, date, snippet in rows]
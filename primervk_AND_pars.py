@@ -15,8 +15,12 @@ class VKService:
         self.vk_session = vk_api.VkApi(token=token)
         self.vk = self.vk_session.get_api()
     
-    def get_group_posts(self, group_id: str, count: int = 100) -> List[Dict]:
-        """Получение постов из группы ВКонтакте"""
+    def get_group_posts(self, group_id: str, count: int = 100, raise_errors: bool = False) -> List[Dict]:
+        """Получение постов из группы ВКонтакте
+
+        При ошибке возвращается пустой список, а с raise_errors=True ошибка
+        пробрасывается, чтобы ее можно было отличить от пустой группы.
+        """
         try:
             # Убираем минус из ID группы если он есть
             group_id = group_id.lstrip('-')
@@ -26,6 +30,8 @@ class VKService:
             return posts['items']
         except Exception as e:
             logger.error(f"Ошибка при получении постов из ВК: {e}")
+            if raise_errors:
+                raise
             return []
 
 class WebParser:
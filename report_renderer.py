@@ -0,0 +1,443 @@
+import io
+import os
+import asyncio
+import logging
+import platform
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional, Tuple, TypeVar
+
+from fpdf import FPDF
+
+# Настраиваем логирование
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+# Количество потоков для формирования отчетов
+REPORT_RENDER_WORKERS = int(os.getenv("REPORT_RENDER_WORKERS", "2"))
+
+FONT_FAMILY = 'DejaVu'
+MONO_FONT_FAMILY = 'DejaVuMono'
+FONT_FILE = 'DejaVuSans.ttf'
+FONT_URL = "https://github.com/dejavu-fonts/dejavu-fonts/raw/master/ttf/{}"
+
+# Шрифты отчета: (семейство, стиль) -> файл. Если жирного или моноширинного
+# начертания нет, вместо него используется обычный шрифт
+REPORT_FONTS = {
+    (FONT_FAMILY, ''): FONT_FILE,
+    (FONT_FAMILY, 'B'): 'DejaVuSans-Bold.ttf',
+    (MONO_FONT_FAMILY, ''): 'DejaVuSansMono.ttf'
+}
+
+# Размеры шрифта (pt) и высота строки (мм) для элементов отчета
+TITLE_SIZE = 16
+HEADING_SIZES = {1: 16, 2: 14, 3: 13, 4: 12}
+BODY_SIZE = 11
+CODE_SIZE = 9
+TABLE_SIZE = 9
+LINE_HEIGHT = 5.5
+CODE_LINE_HEIGHT = 4.5
+TABLE_LINE_HEIGHT = 4.5
+PAGE_MARGIN = 20
+
+# Разметка Markdown, которую выдают модели
+HEADING_RE = re.compile(r'^(#{1,6})\s+(.*?)\s*#*$')
+BULLET_RE = re.compile(r'^(\s*)(?:[-*+•]|(\d+)[.)])\s+(.*)$')
+TABLE_SEPARATOR_RE = re.compile(r'^\|?\s*:?-{2,}:?\s*(\|\s*:?-{2,}:?\s*)*\|?$')
+RULE_RE = re.compile(r'^(\*\s*){3,}$|^(-\s*){3,}$|^(_\s*){3,}$')
+INLINE_RE = re.compile(r'(\*\*.+?\*\*|__.+?__|`[^`]+`)')
+ITALIC_RE = re.compile(r'(?<![*\w])\*(?!\s)(.+?)(?<!\s)\*(?![*\w])')
+LINK_RE = re.compile(r'\[([^\]]+)\]\(([^)\s]+)\)')
+
+def _font_dirs() -> List[str]:
+    """Каталоги, в которых ищем шрифты, в зависимости от ОС"""
+    os_type = platform.system().lower()
+    if os_type == 'linux':
+        dirs = [
+            "/usr/share/fonts/dejavu-sans-fonts",
+            "/usr/share/fonts/dejavu-sans-mono-fonts",
+            "/usr/share/fonts/TTF",
+            "/usr/share/fonts/truetype/dejavu"
+        ]
+    elif os_type == 'windows':
+        dirs = [
+            "C:\\Windows\\Fonts",
+            os.path.join(os.getenv('LOCALAPPDATA', ''), 'Microsoft\\Windows\\Fonts')
+        ]
+    else:  # MacOS и другие
+        dirs = [
+            "/Library/Fonts",
+            "/System/Library/Fonts"
+        ]
+    # Скачанные шрифты лежат в текущей директории
+    return dirs + ['']
+
+# Определяем путь к шрифту (один раз за время работы бота)
+@lru_cache(maxsize=None)
+def get_font_path(filename: str = FONT_FILE) -> str:
+    # Проверяем наличие файла
+    for directory in _font_dirs():
+        path = os.path.join(directory, filename)
+        if os.path.exists(path):
+            return path
+
+    # Если шрифт не найден - скачиваем
+    logger.info(f"Шрифт {filename} не найден, скачиваю...")
+    try:
+        import requests
+        response = requests.get(FONT_URL.format(filename), timeout=60)
+        response.raise_for_status()
+        with open(filename, "wb") as f:
+            f.write(response.content)
+        return filename
+    except Exception as e:
+        logger.error(f"Не удалось скачать шрифт {filename}: {str(e)}")
+        raise Exception(f"❌ Не удалось найти или скачать шрифт {filename}")
+
+def parse_inline(text: str) -> List[Tuple[str, str]]:
+    """Разбиваем строку на фрагменты: ('' - обычный текст, 'B' - жирный, 'code' - код)"""
+    text = LINK_RE.sub(r'\1 (\2)', text)
+    runs = []
+    for part in INLINE_RE.split(text):
+        if not part:
+            continue
+        if part.startswith(('**', '__')) and len(part) > 4:
+            runs.append(('B', part[2:-2]))
+        elif part.startswith('`') and len(part) > 2:
+            runs.append(('code', part[1:-1]))
+        else:
+            # Курсива в шрифтах нет - оставляем только текст
+            runs.append(('', ITALIC_RE.sub(r'\1', part)))
+    return runs
+
+def plain_text(text: str) -> str:
+    """Текст строки без разметки (для ячеек таблиц)"""
+    return ''.join(run for _, run in parse_inline(text))
+
+def split_table_row(line: str) -> List[str]:
+    cells = line.strip().strip('|').split('|')
+    return [plain_text(cell.strip()) for cell in cells]
+
+class GlyphSubset(list):
+    """Список символов документа, которые попадут в подмножество шрифта
+
+    fpdf добавляет в него код каждого выведенного символа, а при сохранении
+    проверяет вхождение для всех 65536 символов шрифта. Обычный список растет
+    с каждой страницей и делает сохранение квадратичным, поэтому здесь
+    повторы отбрасываются, а вхождение проверяется по множеству.
+    """
+
+    def __init__(self, codes=()):
+        super().__init__()
+        self._codes = set()
+        for code in codes:
+            self.append(code)
+
+    def append(self, code):
+        if code not in self._codes:
+            self._codes.add(code)
+            super().append(code)
+
+    def __contains__(self, code) -> bool:
+        return code in self._codes
+
+    def __delitem__(self, index):
+        removed = self[index]
+        super().__delitem__(index)
+        self._codes.difference_update(removed if isinstance(index, slice) else [removed])
+
+class ReportPDF(FPDF):
+    """PDF-отчет из Markdown, который выдают модели
+
+    Понимает заголовки, списки, жирный текст, таблицы и блоки кода.
+    Метрики шрифтов разбираются один раз на процесс: fpdf при каждом
+    add_font заново читает TTF-файл (или его .pkl-кэш, если рядом со
+    шрифтом можно писать), поэтому разобранные метрики хранятся в памяти
+    и копируются в каждый новый документ. Копируется только список
+    использованных символов - в PDF попадают лишь эти глифы шрифта.
+
+    Класс опирается на внутренние поля fpdf 1.7.2 (fonts, font_files,
+    unifontsubset), поэтому версия закреплена в requirements.txt.
+    """
+
+    _font_lock = threading.Lock()
+    _font_entries: Optional[Dict[str, tuple]] = None
+
+    def __init__(self):
+        super().__init__()
+        self.add_report_fonts()
+        self.set_margins(PAGE_MARGIN, PAGE_MARGIN, PAGE_MARGIN)
+        self.set_auto_page_break(True, PAGE_MARGIN)
+        self.set_font(FONT_FAMILY, '', BODY_SIZE)
+
+    @classmethod
+    def preload_fonts(cls) -> Dict[str, tuple]:
+        """Находим шрифты и разбираем их метрики (вызывается при запуске бота)"""
+        if cls._font_entries is not None:
+            return cls._font_entries
+        with cls._font_lock:
+            if cls._font_entries is None:
+                regular_path = get_font_path(FONT_FILE)
+                pdf = FPDF()
+                entries = {}
+                for (family, style), filename in REPORT_FONTS.items():
+                    try:
+                        font_path = get_font_path(filename)
+                    except Exception as e:
+                        logger.warning(f"Вместо шрифта {filename} используется {regular_path}: {str(e)}")
+                        font_path = regular_path
+                    pdf.add_font(family, style, font_path, uni=True)
+                    fontkey = family.lower() + style
+                    font = pdf.fonts[fontkey]
+                    entries[fontkey] = (
+                        {**font, 'subset': list(font['subset'])},
+                        dict(pdf.font_files[fontkey]),
+                        font_path
+                    )
+                cls._font_entries = entries
+                logger.info(f"Шрифты для PDF-отчетов загружены: {', '.join(entry[2] for entry in entries.values())}")
+        return cls._font_entries
+
+    def add_report_fonts(self):
+        """Подключаем шрифты DejaVu без повторного разбора TTF"""
+        for fontkey, (font, font_file, font_path) in self.preload_fonts().items():
+            if fontkey in self.fonts:
+                continue
+            self.fonts[fontkey] = {**font, 'i': len(self.fonts) + 1, 'subset': GlyphSubset(font['subset'])}
+            self.font_files[fontkey] = dict(font_file)
+            self.font_files[font_path] = {'type': "TTF"}
+
+    def normalize_text(self, txt):
+        # Символы вне таблицы шрифта (эмодзи) fpdf не может записать в PDF
+        txt = super().normalize_text(txt)
+        limit = len(self.current_font['cw']) if self.unifontsubset else 0
+        if limit and txt and ord(max(txt)) >= limit:
+            txt = ''.join(c for c in txt if ord(c) < limit)
+        return txt
+
+    def footer(self):
+        self.set_y(-PAGE_MARGIN + 5)
+        self.set_font(FONT_FAMILY, '', 8)
+        self.set_text_color(128)
+        self.cell(0, 5, str(self.page_no()), 0, 0, 'C')
+        self.set_text_color(0)
+
+    @property
+    def content_width(self) -> float:
+        return self.w - self.l_margin - self.r_margin
+
+    def write_runs(self, runs: List[Tuple[str, str]], size: float, height: float, bold: bool = False):
+        """Выводим фрагменты текста с переносом строк"""
+        for style, text in runs:
+            if style == 'code':
+                self.set_font(MONO_FONT_FAMILY, '', size - 1)
+            else:
+                self.set_font(FONT_FAMILY, 'B' if bold else style, size)
+            self.write(height, text)
+        self.set_font(FONT_FAMILY, '', BODY_SIZE)
+        self.ln(height)
+
+    def heading(self, level: int, text: str):
+        size = HEADING_SIZES.get(level, BODY_SIZE + 1)
+        self.ln(2)
+        self.write_runs(parse_inline(text), size, size * 0.5, bold=True)
+        self.ln(1)
+
+    def paragraph(self, text: str):
+        self.write_runs(parse_inline(text), BODY_SIZE, LINE_HEIGHT)
+        self.ln(1.5)
+
+    def bullet(self, text: str, level: int, number: Optional[str] = None):
+        marker = f"{number}." if number else '•'
+        indent = PAGE_MARGIN + 5 * level
+        marker_width = max(5, self.get_string_width(marker) + 2)
+        self.set_x(indent)
+        self.cell(marker_width, LINE_HEIGHT, marker)
+        # Перенесенные строки пункта выравниваем по тексту, а не по маркеру
+        self.set_left_margin(indent + marker_width)
+        self.write_runs(parse_inline(text), BODY_SIZE, LINE_HEIGHT)
+        self.set_left_margin(PAGE_MARGIN)
+        self.ln(0.5)
+
+    def rule(self):
+        self.ln(2)
+        self.set_draw_color(180)
+        self.line(self.l_margin, self.get_y(), self.w - self.r_margin, self.get_y())
+        self.set_draw_color(0)
+        self.ln(3)
+
+    def code_block(self, lines: List[str]):
+        self.set_font(MONO_FONT_FAMILY, '', CODE_SIZE)
+        self.set_fill_color(242)
+        code = '\n'.join(line.replace('\t', '    ') for line in lines) or ' '
+        self.multi_cell(0, CODE_LINE_HEIGHT, code, 0, 'L', 1)
+        self.set_font(FONT_FAMILY, '', BODY_SIZE)
+        self.ln(2)
+
+    def table(self, rows: List[List[str]]):
+        """Таблица: первая строка - заголовок, ширина колонок по содержимому"""
+        columns = max(len(row) for row in rows)
+        rows = [row + [''] * (columns - len(row)) for row in rows]
+        padding = 1.5
+
+        # Естественная ширина колонок, при нехватке места - пропорционально ей
+        self.set_font(FONT_FAMILY, 'B', TABLE_SIZE)
+        natural = [max(self.get_string_width(row[i]) for row in rows) + 2 * padding + 1
+                   for i in range(columns)]
+        width = self.content_width
+        if sum(natural) > width:
+            min_width = width / columns / 2
+            natural = [max(min_width, width * w / sum(natural)) for w in natural]
+            natural = [w * width / sum(natural) for w in natural]
+
+        header, body = rows[0], rows[1:]
+        self.table_row(header, natural, padding, bold=True)
+        for row in body:
+            if self.table_row_height(row, natural, padding) + self.get_y() > self.page_break_trigger:
+                self.add_page()
+                self.table_row(header, natural, padding, bold=True)
+            self.table_row(row, natural, padding)
+        self.set_font(FONT_FAMILY, '', BODY_SIZE)
+        self.ln(3)
+
+    def table_row_height(self, row: List[str], widths: List[float], padding: float, bold: bool = False) -> float:
+        self.set_font(FONT_FAMILY, 'B' if bold else '', TABLE_SIZE)
+        lines = max(len(self.multi_cell(w - 2 * padding, TABLE_LINE_HEIGHT, text, split_only=True))
+                    for text, w in zip(row, widths))
+        return lines * TABLE_LINE_HEIGHT + 2 * padding
+
+    def table_row(self, row: List[str], widths: List[float], padding: float, bold: bool = False):
+        height = self.table_row_height(row, widths, padding, bold)
+        if self.get_y() + height > self.page_break_trigger:
+            self.add_page()
+        self.set_font(FONT_FAMILY, 'B' if bold else '', TABLE_SIZE)
+        self.set_fill_color(230)
+        self.set_draw_color(160)
+        x, y = self.l_margin, self.get_y()
+        for text, w in zip(row, widths):
+            self.rect(x, y, w, height, 'DF' if bold else 'D')
+            self.set_xy(x + padding, y + padding)
+            self.multi_cell(w - 2 * padding, TABLE_LINE_HEIGHT, text, 0, 'L')
+            x += w
+        self.set_draw_color(0)
+        self.set_xy(self.l_margin, y + height)
+
+    def render_markdown(self, content: str):
+        """Разбираем Markdown построчно и выводим блоки по мере чтения"""
+        lines = content.replace('\r', '').split('\n')
+        paragraph: List[str] = []
+
+        def flush_paragraph():
+            if paragraph:
+                self.paragraph(' '.join(paragraph))
+                paragraph.clear()
+
+        i = 0
+        while i < len(lines):
+            line = lines[i]
+            stripped = line.strip()
+
+            if stripped.startswith('```'):
+                flush_paragraph()
+                code = []
+                i += 1
+                while i < len(lines) and not lines[i].strip().startswith('```'):
+                    code.append(lines[i])
+                    i += 1
+                self.code_block(code)
+            elif stripped.startswith('|') and stripped.count('|') >= 2:
+                flush_paragraph()
+                self.ln(1)
+                rows = []
+                while i < len(lines) and lines[i].strip().startswith('|'):
+                    if not TABLE_SEPARATOR_RE.match(lines[i].strip()):
+                        rows.append(split_table_row(lines[i]))
+                    i += 1
+                self.table(rows)
+                continue
+            elif not stripped:
+                flush_paragraph()
+            elif HEADING_RE.match(stripped):
+                flush_paragraph()
+                hashes, text = HEADING_RE.match(stripped).groups()
+                self.heading(len(hashes), text)
+            elif RULE_RE.match(stripped):
+                flush_paragraph()
+                self.rule()
+            elif BULLET_RE.match(line):
+                flush_paragraph()
+                indent, number, text = BULLET_RE.match(line).groups()
+                self.bullet(text, len(indent.expandtabs(4)) // 2, number)
+            else:
+                paragraph.append(stripped)
+            i += 1
+        flush_paragraph()
+
+def report_filename(folder: str, report_format: str) -> str:
+    """Имя файла отчета, под которым он будет отправлен пользователю"""
+    return f"analysis_{folder}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{report_format}"
+
+def generate_txt_report(content: str, folder: str) -> io.BytesIO:
+    """Генерирует отчет в формате TXT"""
+    return io.BytesIO(content.encode('utf-8'))
+
+def generate_pdf_report(content: str, folder: str) -> io.BytesIO:
+    """Генерирует отчет в формате PDF"""
+    pdf = ReportPDF()
+    pdf.add_page()
+
+    # Пишем заголовок
+    pdf.set_font(FONT_FAMILY, 'B', TITLE_SIZE)
+    pdf.multi_cell(0, 8, f'Анализ папки: {folder}', 0, 'L')
+    pdf.set_font(FONT_FAMILY, '', BODY_SIZE)
+    pdf.ln(4)
+
+    pdf.render_markdown(content)
+
+    # fpdf отдает документ строкой, байты PDF хранятся в ней как latin-1
+    return io.BytesIO(pdf.output(dest='S').encode('latin-1'))
+
+# Пул потоков для формирования отчетов и диаграмм. Процессы не используются: при запуске
+# они заново импортировали бы main.py вместе с ботом и сессией Telethon
+_executor: Optional[ThreadPoolExecutor] = None
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=REPORT_RENDER_WORKERS, thread_name_prefix='report')
+    return _executor
+
+async def start_report_renderer():
+    """Находим шрифты и загружаем их метрики заранее (вызывается при запуске бота)"""
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(_get_executor(), ReportPDF.preload_fonts)
+    except Exception as e:
+        # Без шрифта PDF не соберется, но TXT-отчеты работают
+        logger.error(f"Не удалось подготовить шрифт для PDF: {str(e)}")
+
+async def run_in_render_pool(func: Callable[..., T], *args) -> T:
+    """Выполняем func(*args) в пуле формирования, не блокируя цикл событий"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), func, *args)
+
+async def render_txt_report(content: str, folder: str) -> io.BytesIO:
+    """Формируем TXT-отчет в пуле"""
+    return await run_in_render_pool(generate_txt_report, content, folder)
+
+async def render_pdf_report(content: str, folder: str) -> io.BytesIO:
+    """Формируем PDF-отчет в пуле"""
+    return await run_in_render_pool(generate_pdf_report, content, folder)
+
+async def stop_report_renderer():
+    """Дожидаемся формирования начатых отчетов и останавливаем пул"""
+    global _executor
+    if _executor is None:
+        return
+    executor, _executor = _executor, None
+    await asyncio.get_running_loop().run_in_executor(None, executor.shutdown)
+    logger.info("Пул формирования отчетов остановлен")
@@ -0,0 +1,190 @@
+import os
+import json
+import sqlite3
+import logging
+from typing import Dict, List
+
+from db import db
+from ai_service import get_user_model
+
+# Настраиваем логирование
+logger = logging.getLogger(__name__)
+
+# Старый файл с данными всех пользователей (переносится в БД при первом запуске)
+LEGACY_USER_DATA_FILE = 'user_data.json'
+
+DEFAULT_PROMPT = "Проанализируй посты и составь краткий отчет"
+
+def _create_tables(conn: sqlite3.Connection):
+    c = conn.cursor()
+
+    # Общие настройки пользователя
+    c.execute('''CREATE TABLE IF NOT EXISTS user_profiles
+                 (user_id INTEGER PRIMARY KEY,
+                  ai_settings TEXT,
+                  vk_groups TEXT,
+                  websites TEXT)''')
+
+    # Папки пользователя с промптами (порядок папок - порядок вставки)
+    c.execute('''CREATE TABLE IF NOT EXISTS user_folders
+                 (user_id INTEGER,
+                  folder TEXT,
+                  prompt TEXT,
+                  PRIMARY KEY (user_id, folder))''')
+
+    # Каналы в папках
+    c.execute('''CREATE TABLE IF NOT EXISTS folder_channels
+                 (user_id INTEGER,
+                  folder TEXT,
+                  channel TEXT,
+                  PRIMARY KEY (user_id, folder, channel))''')
+
+def _default_user(user_id: int) -> dict:
+    return {
+        'folders': {},
+        'prompts': {},
+        'ai_settings': {
+            'provider_index': 0,
+            'model': get_user_model(user_id)
+        },
+        'vk_groups': [],
+        'websites': []
+    }
+
+def _ensure_profile(conn: sqlite3.Connection, user_id: int, user: dict):
+    conn.execute('''INSERT OR IGNORE INTO user_profiles (user_id, ai_settings, vk_groups, websites)
+                    VALUES (?, ?, ?, ?)''',
+                 (user_id, json.dumps(user['ai_settings'], ensure_ascii=False),
+                  json.dumps(user['vk_groups'], ensure_ascii=False),
+                  json.dumps(user['websites'], ensure_ascii=False)))
+
+def _insert_user(conn: sqlite3.Connection, user_id: int, user: dict):
+    """Записываем все данные пользователя (используется при переносе из JSON)"""
+    _ensure_profile(conn, user_id, user)
+    for folder, channels in user.get('folders', {}).items():
+        conn.execute('INSERT OR REPLACE INTO user_folders (user_id, folder, prompt) VALUES (?, ?, ?)',
+                     (user_id, folder, user.get('prompts', {}).get(folder, DEFAULT_PROMPT)))
+        conn.executemany('INSERT OR IGNORE INTO folder_channels (user_id, folder, channel) VALUES (?, ?, ?)',
+                         [(user_id, folder, channel) for channel in channels])
+
+def _migrate_legacy_file(conn: sqlite3.Connection) -> int:
+    """Переносим user_data.json в таблицы, если они еще пустые"""
+    if not os.path.exists(LEGACY_USER_DATA_FILE):
+        return 0
+    if conn.execute('SELECT 1 FROM user_profiles LIMIT 1').fetchone():
+        return 0
+
+    with open(LEGACY_USER_DATA_FILE, 'r', encoding='utf-8') as f:
+        users = json.load(f).get('users', {})
+
+    with conn:
+        for user_id, user in users.items():
+            user = {**_default_user(int(user_id)), **user}
+            _insert_user(conn, int(user_id), user)
+    return len(users)
+
+class UserData:
+    """Данные пользователей: папки, промпты и настройки.
+
+    Хранятся в таблицах SQLite и загружаются в память по одному пользователю
+    при первом обращении. Каждое изменение записывается отдельной
+    транзакцией и затрагивает только строки этого пользователя.
+    """
+
+    def __init__(self):
+        self.users: Dict[int, dict] = {}  # {user_id: {'folders': {}, 'prompts': {}, 'ai_settings': {}, 'vk_groups': [], 'websites': []}}
+
+    async def init(self):
+        """Создаем таблицы и переносим данные из старого JSON-файла"""
+        await db.transaction(_create_tables)
+        migrated = await db.run(_migrate_legacy_file)
+        if migrated:
+            os.replace(LEGACY_USER_DATA_FILE, LEGACY_USER_DATA_FILE + '.migrated')
+            logger.info(f"Данные {migrated} пользователей перенесены из {LEGACY_USER_DATA_FILE} в БД")
+
+    @staticmethod
+    def _load_user(conn: sqlite3.Connection, user_id: int) -> dict:
+        user = _default_user(user_id)
+        profile = conn.execute('SELECT ai_settings, vk_groups, websites FROM user_profiles WHERE user_id = ?',
+                               (user_id,)).fetchone()
+        if profile:
+            ai_settings, vk_groups, websites = profile
+            user['ai_settings'] = json.loads(ai_settings) if ai_settings else user['ai_settings']
+            user['vk_groups'] = json.loads(vk_groups) if vk_groups else []
+            user['websites'] = json.loads(websites) if websites else []
+
+        for folder, prompt in conn.execute(
+            'SELECT folder, prompt FROM user_folders WHERE user_id = ? ORDER BY rowid', (user_id,)
+        ):
+            user['folders'][folder] = []
+            user['prompts'][folder] = prompt
+
+        for folder, channel in conn.execute(
+            'SELECT folder, channel FROM folder_channels WHERE user_id = ? ORDER BY rowid', (user_id,)
+        ):
+            if folder in user['folders']:
+                user['folders'][folder].append(channel)
+        return user
+
+    async def get_user_data(self, user_id: int) -> dict:
+        """Получаем данные пользователя, при первом обращении загружая их из БД"""
+        user = self.users.get(user_id)
+        if user is None:
+            loaded = await db.run(lambda conn: self._load_user(conn, user_id))
+            # Пока шла загрузка, данные мог загрузить другой обработчик
+            user = self.users.setdefault(user_id, loaded)
+        return user
+
+    async def add_folder(self, user_id: int, folder: str, prompt: str = DEFAULT_PROMPT):
+        """Создаем папку (существующая папка с тем же именем сохраняет свои каналы и промпт)"""
+        user = await self.get_user_data(user_id)
+        if folder in user['folders']:
+            return
+
+        def write(conn: sqlite3.Connection):
+            _ensure_profile(conn, user_id, user)
+            conn.execute('INSERT OR IGNORE INTO user_folders (user_id, folder, prompt) VALUES (?, ?, ?)',
+                         (user_id, folder, prompt))
+
+        await db.transaction(write)
+        user['folders'][folder] = []
+        user['prompts'][folder] = prompt
+
+    async def add_channels(self, user_id: int, folder: str, channels: List[str]):
+        """Добавляем каналы в папку, уже добавленные пропускаем"""
+        user = await self.get_user_data(user_id)
+        new_channels = [channel for channel in dict.fromkeys(channels) if channel not in user['folders'][folder]]
+        if not new_channels:
+            return
+        await db.executemany('INSERT OR IGNORE INTO folder_channels (user_id, folder, channel) VALUES (?, ?, ?)',
+                             [(user_id, folder, channel) for channel in new_channels])
+        user['folders'][folder].extend(new_channels)
+
+    async def remove_channel(self, user_id: int, folder: str, channel: str):
+        """Удаляем канал из папки"""
+        user = await self.get_user_data(user_id)
+        await db.execute('DELETE FROM folder_channels WHERE user_id = ? AND folder = ? AND channel = ?',
+                         (user_id, folder, channel))
+        if channel in user['folders'].get(folder, []):
+            user['folders'][folder].remove(channel)
+
+    async def delete_folder(self, user_id: int, folder: str):
+        """Удаляем папку вместе с ее каналами, расписанием и отметками прочитанных сообщений"""
+        user = await self.get_user_data(user_id)
+
+        def write(conn: sqlite3.Connection):
+            conn.execute('DELETE FROM folder_channels WHERE user_id = ? AND folder = ?', (user_id, folder))
+            conn.execute('DELETE FROM user_folders WHERE user_id = ? AND folder = ?', (user_id, folder))
+            conn.execute('DELETE FROM schedules WHERE user_id = ? AND folder = ?', (user_id, folder))
+            conn.execute('DELETE FROM channel_state WHERE user_id = ? AND folder = ?', (user_id, folder))
+
+        await db.transaction(write)
+        user['folders'].pop(folder, None)
+        user['prompts'].pop(folder, None)
+
+    async def set_prompt(self, user_id: int, folder: str, prompt: str):
+        """Меняем промпт папки"""
+        user = await self.get_user_data(user_id)
+        await db.execute('UPDATE user_folders SET prompt = ? WHERE user_id = ? AND folder = ?',
+                         (prompt, user_id, folder))
+        user['prompts'][folder] = prompt